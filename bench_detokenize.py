@@ -0,0 +1,67 @@
+"""
+Per-token detokenization cost of a streamed completion.
+
+Streams the tokens of a text through LlamaStreamDetokenizer, the way
+_create_completion emits them, once with a direct llama_token_to_piece call
+per token and once through the lazily filled piece table of the model.
+Only the vocabulary is loaded.
+
+	python bench_detokenize.py --model models/llama-3-8b.gguf --repeat 20
+"""
+
+import argparse
+import ctypes
+from time import perf_counter
+
+import llama_cpp
+from llama_cpp.llama_tokenizer import LlamaTokenizer, LlamaStreamDetokenizer
+
+TEXT = """The quick brown fox jumps over the lazy dog. Größe, naïve café, 東京, 😀.
+def main():
+	for i in range(10):
+		print(f"{i}: {i ** 2}")
+"""
+
+
+class CTypesTokenizer:
+	"""Detokenizes with one llama_token_to_piece call per token, no table."""
+	def __init__(self, model):
+		self.model = model
+		self.buffer = (ctypes.c_char * 64)()
+
+	def detokenize(self, tokens, prev_tokens=None):
+		output = b""
+		for token in tokens:
+			n = llama_cpp.llama_token_to_piece(self.model, token, self.buffer, len(self.buffer), False)
+			output += bytes(self.buffer[:n])
+		return output
+
+
+def bench_stream(tokenizer, tokens):
+	start = perf_counter()
+	detokenizer = LlamaStreamDetokenizer(tokenizer)
+	for token in tokens:
+		detokenizer.push(token)
+	return perf_counter() - start, bytes(detokenizer.text)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument("--model", type=str, required=True)
+	parser.add_argument("--repeat", type=int, default=20)
+	args = parser.parse_args()
+
+	llama = llama_cpp.Llama(model_path=args.model, vocab_only=True, verbose=False)
+	tokens = llama.tokenize((TEXT * args.repeat).encode("utf-8"), add_bos=False)
+
+	before, text_before = bench_stream(CTypesTokenizer(llama.model), tokens)
+	after, text_after = bench_stream(LlamaTokenizer(llama), tokens)
+	assert text_before == text_after
+
+	pieces = llama._model.pieces()
+	print(f"n_tokens = {len(tokens)}")
+	print(f"per-token detokenize, ctypes     : {before / len(tokens) * 1e6:9.3f} us")
+	print(f"per-token detokenize, piece table: {after / len(tokens) * 1e6:9.3f} us")
+	print(f"piece table: hits = {pieces.n_hits}, misses = {pieces.n_misses}, hit rate = {pieces.hit_rate:.1%}")
+	print(f"piece table: time in llama.cpp = {pieces.t_misses * 1e3:.3f} ms, saved = {pieces.time_saved * 1e3:.3f} ms")
+	print(f"speedup: {before / after:.1f}x")
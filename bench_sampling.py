@@ -0,0 +1,59 @@
+"""
+Per-token sampling overhead of the interactive runner in llamacpp_chat.py.
+
+Compares building the candidate list the old way, one llama_token_data per
+vocab entry and token, against refilling the reusable NumPy candidate buffer
+from _internals.py. No model is needed, the logits are random and the
+greedy pick is done on the prepared buffer so both paths do the same work.
+
+	python bench_sampling.py --n-vocab 128256 --n-tokens 50
+"""
+
+import argparse
+import ctypes
+from time import perf_counter
+
+import numpy as np
+
+import llama_cpp
+from llama_cpp._internals import _LlamaTokenDataArray
+
+
+def bench_list(logits, n_vocab, n_tokens):
+	start = perf_counter()
+	for _ in range(n_tokens):
+		_arr = (llama_cpp.llama_token_data * n_vocab)(*[
+			llama_cpp.llama_token_data(token_id, logits[token_id], 0.0)
+			for token_id in range(n_vocab)
+		])
+		candidates = llama_cpp.llama_token_data_array(_arr, len(_arr), False)
+		candidates_data = np.ctypeslib.as_array(candidates.data, shape=(candidates.size,))
+		int(candidates_data["logit"].argmax())
+	return (perf_counter() - start) / n_tokens
+
+
+def bench_buffer(logits, n_vocab, n_tokens):
+	candidates = _LlamaTokenDataArray(n_vocab=n_vocab)
+	start = perf_counter()
+	for _ in range(n_tokens):
+		candidates.copy_logits(np.ctypeslib.as_array(logits, shape=(n_vocab,)))
+		llama_cpp.byref(candidates.candidates)
+		int(candidates.candidates_data["logit"].argmax())
+	return (perf_counter() - start) / n_tokens
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument("--n-vocab", type=int, default=128256)
+	parser.add_argument("--n-tokens", type=int, default=20)
+	args = parser.parse_args()
+
+	_logits = np.random.default_rng(0).standard_normal(args.n_vocab).astype(np.single)
+	logits = _logits.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+	before = bench_list(logits, args.n_vocab, args.n_tokens)
+	after = bench_buffer(logits, args.n_vocab, args.n_tokens)
+	print(f"n_vocab = {args.n_vocab}, n_tokens = {args.n_tokens}")
+	print(f"per-token candidates, python list : {before * 1e3:9.3f} ms")
+	print(f"per-token candidates, numpy buffer: {after * 1e3:9.3f} ms")
+	print(f"speedup: {before / after:.1f}x")
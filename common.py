@@ -19,6 +19,13 @@ class GptParams:
     n_keep: int = 0
     n_gpu_layers: int = 0
 
+    # what a sequence drops once it fills the context: "shift" keeps n_keep tokens and drops half of the rest,
+    # "sink" keeps n_sink tokens and a sliding window, grp_attn_n > 1 uses self-extend instead
+    ctx_policy: str = "shift"
+    n_sink: int = 4
+    grp_attn_n: int = 1
+    grp_attn_w: int = 512
+
     ignore_eos: bool = False
     logit_bias: dict[int, float] = field(default_factory=dict)
     top_k: int = 40
@@ -85,6 +92,10 @@ def gpt_params_parse(argv = None):
     parser.add_argument("-b", "--batch_size", type=int, default=8, help="batch size for prompt processing",dest="n_batch")
     parser.add_argument("--keep", type=int, default=0, help="number of tokens to keep from the initial prompt",dest="n_keep")
     parser.add_argument("-ngl","--n_gpu_layers",type=int, default=0, help="number of layers offload to gpu",dest="n_gpu_layers")
+    parser.add_argument("--ctx-policy", type=str, default="shift", choices=["shift", "sink"], help="how a sequence makes room once it fills the context",dest="ctx_policy")
+    parser.add_argument("--sink", type=int, default=4, help="number of attention sink tokens kept by --ctx-policy sink",dest="n_sink")
+    parser.add_argument("-gan", "--grp-attn-n", type=int, default=1, help="group-attention factor for self-extend (1 = disabled)",dest="grp_attn_n")
+    parser.add_argument("-gaw", "--grp-attn-w", type=int, default=512, help="group-attention width for self-extend",dest="grp_attn_w")
 
     parser.add_argument(
         "-l",
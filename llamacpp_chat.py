@@ -11,12 +11,18 @@ Quirks:
    shows it the expected format.
 """
 
+import codecs
 import ctypes
 import sys
 from time import time
 from os import cpu_count, path
 
+import numpy as np
+
 import llama_cpp
+from llama_cpp._internals import _LlamaTokenDataArray, _LlamaPieceTable
+from llama_cpp.llama_stop_matcher import StopMatcher
+from llama_cpp.llama_context_policy import LlamaShiftPolicy, LlamaAttentionSinkPolicy, LlamaSelfExtendPolicy
 from common import GptParams, gpt_params_parse, gpt_random_prompt
 import util
 
@@ -25,6 +31,8 @@ class LLaMAInteract:
 	def __init__(self, params: GptParams) -> None:
 		self.round=0
 		self.n_past_list=[]
+		# context policy of each sequence, shifting one sequence leaves the others alone
+		self.context_policies = {}
 		# input args
 		self.params = params
 		if self.params.path_session is None:
@@ -62,7 +70,8 @@ specified) expect poor results""", file=sys.stderr)
 		self.first_antiprompt = []
 		self.remaining_tokens = self.params.n_predict
 		self.output_echo = self.params.input_echo
-		self.multibyte_fix = []
+		# holds back incomplete multi-byte UTF8 until the rest of it arrives
+		self.utf8_decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
 
 		# model load
 		self.lparams = llama_cpp.llama_model_default_params()
@@ -115,6 +124,12 @@ specified) expect poor results""", file=sys.stderr)
 
 		# create internal context
 		self.n_ctx = llama_cpp.llama_n_ctx(self.ctx)
+		self.n_vocab = llama_cpp.llama_n_vocab(self.model)
+
+		# candidate buffer reused for every sampled token
+		self.candidates = _LlamaTokenDataArray(n_vocab=self.n_vocab)
+		# token -> piece, filled as tokens are printed
+		self.pieces = _LlamaPieceTable(self.model, self.n_vocab)
 
 		# Add a space in front of the first character to match OG llama tokenizer behavior
 		self.params.prompt = " " + self.params.prompt
@@ -179,11 +194,12 @@ specified) expect poor results""", file=sys.stderr)
 
 		# in instruct mode, we inject a prefix and a suffix to each input by the user
 		self.antiecho = None
+		self.antiecho_buffer = []
 		if (self.params.instruct):
 			self.params.interactive_start = True
 			_ptn = self._tokenize(self.params.instruct_inp_prefix.strip(), False)
 			self.first_antiprompt.append(_ptn)
-			self.antiecho = util.IterSearch(_ptn)
+			self.antiecho = StopMatcher([_ptn])
 
 		# enable interactive mode if reverse prompt or interactive start is specified
 		if (len(self.params.antiprompt) != 0 or self.params.interactive_start):
@@ -241,6 +257,8 @@ n_keep = {self.params.n_keep}
 		# determine antiprompt tokens
 		for i in self.params.antiprompt:
 			self.first_antiprompt.append(self._tokenize(i, False))
+		# fed with every token appended to last_n_tokens
+		self.antiprompt_matcher = StopMatcher(self.first_antiprompt)
 
 		self.last_n_tokens = [0]*self.n_ctx #TODO: deque doesnt support slices
 
@@ -266,12 +284,28 @@ n_keep = {self.params.n_keep}
 	def use_antiprompt(self):
 		return len(self.first_antiprompt) > 0
 
+	def context_policy(self, seq_id):
+		"""the context policy holding the state of a sequence"""
+		if seq_id not in self.context_policies:
+			if self.params.grp_attn_n > 1:
+				policy = LlamaSelfExtendPolicy(ga_n=self.params.grp_attn_n, ga_w=self.params.grp_attn_w)
+			elif self.params.ctx_policy == "sink":
+				policy = LlamaAttentionSinkPolicy(n_sink=self.params.n_sink)
+			else:
+				policy = LlamaShiftPolicy(n_keep=self.params.n_keep)
+			self.context_policies[seq_id] = policy
+		return self.context_policies[seq_id]
+
 	# generate tokens
 	def generate(self, seq_id):
 		# seq_id = self.round % 2
 		if self.n_past:
 			self.n_past_list.append(self.n_past)
-			llama_cpp.llama_kv_cache_seq_cp(self.ctx, 0, seq_id,-1,self.n_past_list[0])
+			first = self.context_policy(0)
+			llama_cpp.llama_kv_cache_seq_cp(self.ctx, 0, seq_id,-1,first.pos(self.n_past_list[0]))
+			if seq_id != 0 and seq_id not in self.context_policies:
+				self.context_policies[seq_id] = first.copy()
+		policy = self.context_policy(seq_id)
 		print(f"round {self.round}, seq_id: {seq_id}, n_past: {self.n_past}", file=sys.stderr)
 
 		while self.remaining_tokens > 0 or self.params.interactive or self.params.n_predict == -1:
@@ -285,20 +319,11 @@ n_keep = {self.params.n_keep}
 				if (self.n_past + len(self.embd) > self.n_ctx):
 					print("hit ctx limit.", file=sys.stderr)
 					print(f"n_past: {self.n_past}.", file=sys.stderr)
-					n_left = self.n_past - self.params.n_keep
-					self.n_past = self.params.n_keep
-					print(f"n_past: {self.n_past}.", file=sys.stderr)
-
-					# insert n_left/2 tokens at the start of embd from last_n_tokens
-					_insert = self.last_n_tokens[
-						self.n_ctx - int(n_left/2) - len(self.embd):-len(self.embd)
-					]
-					#self.embd = _insert + self.embd
 					self.params.path_session = ""
-					llama_cpp.llama_kv_cache_seq_rm(self.ctx, -1, self.n_past, int(n_left/2)+self.n_past)
-					llama_cpp.llama_kv_cache_seq_add(self.ctx, -1, int(n_left/2)+self.n_past, self.n_ctx, -int(n_left/2))
-					self.n_past = int(n_left/2)+self.n_past
-					print(f"reset n_past to {self.n_past}.", file=sys.stderr)
+					# only the kv cache of this sequence is shifted
+					start, end = policy.make_room(self.ctx, seq_id, self.n_past, len(self.embd), self.n_ctx)
+					self.n_past -= end - start
+					print(f"dropped tokens {start} to {end}, reset n_past to {self.n_past}.", file=sys.stderr)
 
 				# try to reuse a matching prefix from the loaded session instead of re-eval (via n_past)
 				if self.n_session_consumed < len(self.session_tokens):
@@ -339,7 +364,8 @@ n_keep = {self.params.n_keep}
 					if (n_eval+i>=len(self.embd)):
 						n_eval = len(self.embd)-i						
 					_arr = (llama_cpp.llama_token * n_eval)(*self.embd[i:i + n_eval])
-					if (llama_cpp.llama_decode(self.ctx, llama_cpp.llama_batch_get_one(_arr, n_eval, i+self.n_past,seq_id))): 
+					policy.before_decode(self.ctx, seq_id, i+self.n_past)
+					if (llama_cpp.llama_decode(self.ctx, llama_cpp.llama_batch_get_one(_arr, n_eval, policy.pos(i+self.n_past),seq_id))): 
 						print(f"failed to eval")
 						return
 					#self.n_past += n_eval
@@ -350,7 +376,7 @@ n_keep = {self.params.n_keep}
 
 			self.n_past += len(self.embd)
 			#print(f"n_past: {self.n_past}.", file=sys.stderr)
-			llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, self.n_past, -1)
+			llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, policy.pos(self.n_past), -1)
 			
 			self.embd = []
 			if len(self.embd_inp) <= self.input_consumed: #&& !is_interacting
@@ -370,21 +396,20 @@ n_keep = {self.params.n_keep}
 
 				id = 0
 
-				logits = llama_cpp.llama_get_logits(self.ctx)#[: rows * cols]
-				n_vocab = llama_cpp.llama_n_vocab(self.model)
+				logits = np.ctypeslib.as_array(
+					llama_cpp.llama_get_logits(self.ctx), shape=(self.n_vocab,)
+				)
+				self.candidates.copy_logits(logits)
+				candidates_logit = self.candidates.candidates_data["logit"]
+				candidates_p = llama_cpp.byref(self.candidates.candidates)
 
 				# Apply params.logit_bias map
 				for key, value in self.params.logit_bias.items():
-					logits[key] += value
-
-				_arr = (llama_cpp.llama_token_data * n_vocab)(*[
-					llama_cpp.llama_token_data(token_id, logits[token_id], 0.0)
-					for token_id in range(n_vocab)
-				])
-				candidates_p = llama_cpp.byref(llama_cpp.llama_token_data_array(_arr, len(_arr), False))#llama_cpp.ctypes.pointer(llama_cpp.llama_token_data_array(_arr, len(_arr), False))
+					candidates_logit[key] += value
 
 				# Apply penalties
-				nl_logit = logits[llama_cpp.llama_token_nl(self.ctx)]
+				nl_token = llama_cpp.llama_token_nl(self.model)
+				nl_logit = candidates_logit[nl_token]
 				last_n_repeat = min(len(self.last_n_tokens), repeat_last_n, self.n_ctx)
 
 				_arr = (llama_cpp.llama_token * last_n_repeat)(*self.last_n_tokens[len(self.last_n_tokens) - last_n_repeat:])
@@ -404,7 +429,7 @@ n_keep = {self.params.n_keep}
 				# 	last_n_repeat, llama_cpp.c_float(self.params.frequency_penalty), llama_cpp.c_float(self.params.presence_penalty))
 
 				if not self.params.penalize_nl:
-					logits[llama_cpp.llama_token_nl()] = nl_logit
+					candidates_logit[nl_token] = nl_logit
 				
 				if self.params.temp <= 0:
 					# Greedy sampling
@@ -431,6 +456,7 @@ n_keep = {self.params.n_keep}
 
 				self.last_n_tokens.pop(0)
 				self.last_n_tokens.append(id)
+				self.antiprompt_matcher.step(id)
 
 				# replace end of text token with newline token when in interactive mode
 				if (id == llama_cpp.llama_token_eos(self.ctx) and self.params.interactive and not self.params.instruct):
@@ -459,6 +485,7 @@ n_keep = {self.params.n_keep}
 					self.embd.append(self.embd_inp[self.input_consumed])
 					self.last_n_tokens.pop(0)
 					self.last_n_tokens.append(self.embd_inp[self.input_consumed])
+					self.antiprompt_matcher.step(self.embd_inp[self.input_consumed])
 					self.input_consumed += 1
 					if len(self.embd) >= self.params.n_batch:
 						break
@@ -467,7 +494,7 @@ n_keep = {self.params.n_keep}
 			if self.output_echo:
 				for id in self.embd:
 					if self.antiecho != None:
-						for r in self.antiecho(id):
+						for r in self.filter_antiecho(id):
 							yield r
 					else:
 						yield id
@@ -479,10 +506,7 @@ n_keep = {self.params.n_keep}
 			if (self.params.interactive and len(self.embd_inp) <= self.input_consumed):
 				# if antiprompt is present, stop
 				if (self.use_antiprompt()):
-					if True in [
-						i == self.last_n_tokens[-len(i):] 
-						for i in self.first_antiprompt
-					]:
+					if self.antiprompt_matcher.at_match:
 						break
 
 				# if we are using instruction mode, and we have processed the initial prompt
@@ -517,13 +541,20 @@ n_keep = {self.params.n_keep}
 		llama_cpp.llama_free(self.ctx)
 		self.set_color(util.CONSOLE_COLOR_DEFAULT)
 
+	# hold back tokens that may start the instruct prefix, drop it once complete
+	def filter_antiecho(self, id):
+		self.antiecho_buffer.append(id)
+		n = self.antiecho.step(id)
+		if n > 0:
+			del self.antiecho_buffer[-n:]
+			self.antiecho.reset()
+		n_ready = len(self.antiecho_buffer) - self.antiecho.partial
+		ready = self.antiecho_buffer[:n_ready]
+		del self.antiecho_buffer[:n_ready]
+		return ready
+
 	def token_to_str(self, token_id: int) -> bytes:
-		size = 32
-		buffer = (ctypes.c_char * size)()
-		n = llama_cpp.llama_token_to_piece(
-			self.model, llama_cpp.llama_token(token_id), buffer, size, False)
-		assert n <= size
-		return bytes(buffer[:n])
+		return self.pieces[token_id]
 
 	# return past text
 	def past(self):
@@ -542,29 +573,9 @@ n_keep = {self.params.n_keep}
 	def output(self):
 		self.remaining_tokens = self.params.n_predict
 		for id in self.generate(0):
-			cur_char = self.token_to_str(id)
-
-			# Add remainder of missing bytes
-			if None in self.multibyte_fix:
-				self.multibyte_fix[self.multibyte_fix.index(None)] = cur_char
-
-			# Return completed utf char
-			if len(self.multibyte_fix) > 0 and not None in self.multibyte_fix:
-				yield (b"".join(self.multibyte_fix)).decode("utf8")
-				self.multibyte_fix = []
-				continue
-
-			# Contains multi-byte UTF8
-			for num, pattern in [(2, 192), (3, 224), (4, 240)]:
-				# Bitwise AND check
-				if pattern & int.from_bytes(cur_char, 'little') == pattern:
-					self.multibyte_fix = [cur_char] + ([None] * (num-1))
-
-			# Stop incomplete bytes from passing
-			if len(self.multibyte_fix) > 0:
-				continue
-
-			yield cur_char.decode("utf8")
+			cur_char = self.utf8_decoder.decode(self.token_to_str(id))
+			if len(cur_char) > 0:
+				yield cur_char
 
 	# read user input
 	def read_input(self):
@@ -582,7 +593,7 @@ n_keep = {self.params.n_keep}
 
         # Using string instead of tokens to check for antiprompt,
 		# It is more reliable than tokens for interactive mode.
-		generated_str = ""
+		antiprompt_matcher = StopMatcher([[ord(c) for c in ap] for ap in self.params.antiprompt])
 		while self.params.interactive:
 			self.set_color(util.CONSOLE_COLOR_USER_INPUT)
 			if (self.params.instruct):
@@ -594,13 +605,12 @@ n_keep = {self.params.n_keep}
 				print(self.params.input_suffix,end="")
 			self.set_color(util.CONSOLE_COLOR_DEFAULT)
 
+			antiprompt_matcher.reset()
 			try:
 				for i in self.output():
 					print(i,end="",flush=True)
-					generated_str += i
-					for ap in self.params.antiprompt:
-						if generated_str.endswith(ap):							
-							raise KeyboardInterrupt
+					if antiprompt_matcher.feed(ord(c) for c in i) is not None:
+						raise KeyboardInterrupt
 			except KeyboardInterrupt:
 				self.set_color(util.CONSOLE_COLOR_DEFAULT)
 				if not self.params.instruct:
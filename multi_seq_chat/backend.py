@@ -1,7 +1,12 @@
 import json
 import os
+import pickle
+import queue
 import sys
-from typing import List,Optional
+import threading
+from typing import Dict, List, Optional
+
+from llama_cpp import LlamaBranch
 
 def load_history_json(idx: int, memo_path: str = 'memory/') -> List:
     """
@@ -67,5 +72,80 @@ def save_history(idx: int, round: int, seq_id: list[int], chat: list[str], memo_
         except json.JSONDecodeError as e:
             print("Error while parsing JSON:", str(e)) 
 
+def seq_state_path(idx: int, seq_id: int, memo_path: str = './') -> str:
+    """
+    path of the kv cache state of a sequence, saved next to the chat history {idx}.json.
+    """
+    return memo_path + f"{idx}_seq{seq_id}.state"
+
+
+class SeqStateStore:
+    """
+    save and load each sequence with its round spans and kv cache state, so a branch doesn't have to be evaluated again after a restart.
+    states are pickled to disk by a background thread, the caller only pays for copying the state out of llama.cpp.
+    states that are not written yet are served from memory.
+    """
+    def __init__(self):
+        self._pending: Dict[str, LlamaBranch] = {}
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, path: str, state: LlamaBranch) -> None:
+        """
+        queue a state to be written to path, a newer state for the same path replaces the queued one.
+        """
+        with self._lock:
+            queued = path in self._pending
+            self._pending[path] = state
+        if not queued:
+            self._queue.put(path)
+
+    def load(self, path: str) -> Optional[LlamaBranch]:
+        """
+        return the latest state saved to path, None if there is none.
+        """
+        with self._lock:
+            state = self._pending.get(path)
+        if state is not None:
+            return state
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as file:
+                return pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Error while loading sequence state {path}:", str(e), file=sys.stderr)
+            return None
+
+    def flush(self) -> None:
+        """
+        block until all queued states are written.
+        """
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            path = self._queue.get()
+            try:
+                with self._lock:
+                    state = self._pending.get(path)
+                if state is not None:
+                    tmp_path = path + ".tmp"
+                    with open(tmp_path, "wb") as file:
+                        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp_path, path)
+                    with self._lock:
+                        if self._pending.get(path) is state:
+                            del self._pending[path]
+                        else:
+                            # saved again while writing
+                            self._queue.put(path)
+            except OSError as e:
+                print(f"Error while saving sequence state {path}:", str(e), file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
 # chat = ["what is your name?","jxc"]
 # save_history(1,2,[3],chat,"./")
\ No newline at end of file
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
 import os
+import time
 import ctypes
 
 from typing import (
+    Dict,
     List,
     Optional,
     Sequence,
+    Union,
 )
 from dataclasses import dataclass, field
 
@@ -44,6 +47,8 @@ class _LlamaModel:
         self._llama_free_model = llama_cpp._lib.llama_free_model  # type: ignore
 
         self.model = None
+        # special -> piece table, see pieces
+        self._piece_tables: Dict[bool, _LlamaPieceTable] = {}
 
         if not os.path.exists(path_model):
             raise ValueError(f"Model path does not exist: {path_model}")
@@ -183,23 +188,21 @@ class _LlamaModel:
                 )
         return list(tokens[:n_tokens])
 
+    def pieces(self, special: bool = False) -> "_LlamaPieceTable":
+        """The token -> piece table of the model, filled as tokens are looked up."""
+        table = self._piece_tables.get(special)
+        if table is None:
+            assert self.model is not None
+            table = _LlamaPieceTable(self.model, self.n_vocab(), special=special)
+            self._piece_tables[special] = table
+        return table
+
     def token_to_piece(self, token: int, special: bool = False) -> bytes:
-        assert self.model is not None
-        buf = ctypes.create_string_buffer(32)
-        llama_cpp.llama_token_to_piece(self.model, token, buf, 32, special)
-        return bytes(buf)
+        return self.pieces(special)[token]
 
     def detokenize(self, tokens: List[int], special: bool = False) -> bytes:
         assert self.model is not None
-        output = b""
-        size = 32
-        buffer = (ctypes.c_char * size)()
-        for token in tokens:
-            n = llama_cpp.llama_token_to_piece(
-                self.model, llama_cpp.llama_token(token), buffer, size, special
-            )
-            assert n <= size
-            output += bytes(buffer[:n])
+        output = self.pieces(special).join(tokens)
         # NOTE: Llama1 models automatically added a space at the start of the prompt
         # this line removes a leading space if the first token is a beginning of sentence token
         return (
@@ -299,10 +302,57 @@ class _LlamaContext:
         assert self.ctx is not None
         llama_cpp.llama_kv_cache_seq_add(self.ctx, seq_id, p0, p1, shift)
 
+    def kv_cache_seq_pos_max(self, seq_id: int) -> int:
+        """The largest position of `seq_id` in the kv cache, -1 if it holds no cells."""
+        assert self.ctx is not None
+        return llama_cpp.llama_kv_cache_seq_pos_max(self.ctx, seq_id)
+
+    def kv_cache_used_cells(self) -> int:
+        assert self.ctx is not None
+        return llama_cpp.llama_get_kv_cache_used_cells(self.ctx)
+
+    def kv_cache_defrag(self):
+        """Schedule a defragmentation, applied by the next decode."""
+        assert self.ctx is not None
+        llama_cpp.llama_kv_cache_defrag(self.ctx)
+
+    def kv_cache_fragmentation(self) -> float:
+        """Share of empty cells below the last used one, the measure llama.cpp
+        compares with defrag_thold."""
+        assert self.ctx is not None
+        view = llama_cpp.llama_kv_cache_view_init(self.ctx, 1)
+        try:
+            llama_cpp.llama_kv_cache_view_update(self.ctx, ctypes.byref(view))
+            if view.n_cells <= 0 or view.used_cells <= 0:
+                return 0.0
+            pos = np.ctypeslib.as_array(
+                ctypes.cast(view.cells, ctypes.POINTER(llama_cpp.llama_pos)),
+                shape=(view.n_cells,),
+            )
+            n_span = int(np.flatnonzero(pos >= 0)[-1]) + 1
+            return 1.0 - view.used_cells / n_span
+        finally:
+            llama_cpp.llama_kv_cache_view_free(ctypes.byref(view))
+
     def get_state_size(self) -> int:
         assert self.ctx is not None
         return llama_cpp.llama_get_state_size(self.ctx)
 
+    def seq_get_state(self, seq_id: int) -> bytes:
+        """Copy the kv cache of a single sequence."""
+        assert self.ctx is not None
+        size = llama_cpp.llama_state_seq_get_size(self.ctx, seq_id)
+        buffer = (ctypes.c_uint8 * size)()
+        n = llama_cpp.llama_state_seq_get_data(self.ctx, buffer, seq_id)
+        return bytes(buffer[:n])
+
+    def seq_set_state(self, state: bytes, dest_seq_id: int):
+        """Replace the kv cache of `dest_seq_id` with a copied sequence."""
+        assert self.ctx is not None
+        buffer = (ctypes.c_uint8 * len(state)).from_buffer_copy(state)
+        if llama_cpp.llama_state_seq_set_data(self.ctx, buffer, dest_seq_id) == 0:
+            raise RuntimeError(f"Failed to set the state of sequence {dest_seq_id}")
+
     # TODO: copy_state_data
 
     # TODO: set_state_data
@@ -333,10 +383,40 @@ class _LlamaContext:
         assert self.ctx is not None
         return llama_cpp.llama_get_logits_ith(self.ctx, i)
 
+    def get_logits_view(self, n_rows: int = 1) -> npt.NDArray[np.single]:
+        """NumPy view over the first `n_rows` output rows of the last decode.
+
+        The view aliases the logits buffer of the context, copy it before the
+        next decode if it has to be kept."""
+        return np.ctypeslib.as_array(
+            self.get_logits(), shape=(n_rows, self.model.n_vocab())
+        )
+
+    def get_logits_ith_view(self, i: int) -> npt.NDArray[np.single]:
+        """NumPy view over the logits of output row `i` of the last decode."""
+        return np.ctypeslib.as_array(
+            self.get_logits_ith(i), shape=(self.model.n_vocab(),)
+        )
+
     def get_embeddings(self):
         assert self.ctx is not None
         return llama_cpp.llama_get_embeddings(self.ctx)
 
+    def get_embeddings_view(self, n_rows: int) -> npt.NDArray[np.single]:
+        """NumPy view over the token embeddings of the first `n_rows` output
+        rows of the last decode."""
+        return np.ctypeslib.as_array(
+            self.get_embeddings(), shape=(n_rows, self.model.n_embd())
+        )
+
+    def get_embeddings_seq_view(self, seq_id: int) -> npt.NDArray[np.single]:
+        """NumPy view over the pooled embedding of `seq_id` of the last decode."""
+        assert self.ctx is not None
+        return np.ctypeslib.as_array(
+            llama_cpp.llama_get_embeddings_seq(self.ctx, seq_id),
+            shape=(self.model.n_embd(),),
+        )
+
     # Sampling functions
 
     def set_rng_seed(self, seed: int):
@@ -502,8 +582,39 @@ class _LlamaBatch:
             self._n_tokens, self.embd, self.n_seq_max
         )
 
+        # NumPy views over the C buffers so the batch can be filled with slice
+        # assignment instead of one ctypes store per element
+        self.token: Optional[npt.NDArray[np.int32]] = (
+            np.ctypeslib.as_array(self.batch.token, shape=(self._n_tokens,))
+            if self.embd == 0
+            else None
+        )
+        self.pos: npt.NDArray[np.int32] = np.ctypeslib.as_array(
+            self.batch.pos, shape=(self._n_tokens,)
+        )
+        self.n_seq_id: npt.NDArray[np.int32] = np.ctypeslib.as_array(
+            self.batch.n_seq_id, shape=(self._n_tokens,)
+        )
+        self.logits: npt.NDArray[np.int8] = np.ctypeslib.as_array(
+            self.batch.logits, shape=(self._n_tokens,)
+        )
+        # llama_batch_init allocates every seq_id row separately, point the
+        # rows into one contiguous buffer instead (restored before freeing)
+        self.seq_id: npt.NDArray[np.int32] = np.zeros(
+            (self._n_tokens, self.n_seq_max), dtype=np.int32
+        )
+        self._seq_id_ptrs = np.ctypeslib.as_array(
+            ctypes.cast(self.batch.seq_id, ctypes.POINTER(ctypes.c_size_t)),
+            shape=(self._n_tokens,),
+        )
+        self._seq_id_ptrs_orig = self._seq_id_ptrs.copy()
+        self._seq_id_ptrs[:] = self.seq_id.ctypes.data + np.arange(
+            self._n_tokens, dtype=np.uintp
+        ) * self.seq_id.strides[0]
+
     def __del__(self):
         if self.batch is not None and self._llama_batch_free is not None:
+            self._seq_id_ptrs[:] = self._seq_id_ptrs_orig
             self._llama_batch_free(self.batch)
             self.batch = None
 
@@ -517,29 +628,122 @@ class _LlamaBatch:
 
     def set_batch(self, batch: Sequence[int], n_past: int, logits_all: bool, seq_id:int):
         assert self.batch is not None
-        n_tokens = len(batch)
-        self.batch.n_tokens = n_tokens
-        for i in range(n_tokens):
-            self.batch.token[i] = batch[i]
-            self.batch.pos[i] = n_past + i
-            self.batch.seq_id[i][0] = seq_id #0
-            self.batch.n_seq_id[i] = 1
-            self.batch.logits[i] = logits_all
-        self.batch.logits[n_tokens - 1] = True
-
-    def add_sequence(self, batch: Sequence[int], seq_id: int, logits_all: bool):
+        self.reset()
+        self.add_sequence(batch, seq_id=seq_id, logits_all=logits_all, n_past=n_past)
+
+    def add_sequence(
+        self,
+        batch: Sequence[int],
+        seq_id: int,
+        logits_all: bool,
+        n_past: int = 0,
+        logits_last: bool = True,
+    ):
         assert self.batch is not None
         n_tokens = len(batch)
+        if n_tokens == 0:
+            return
         n_tokens0 = self.batch.n_tokens
-        self.batch.n_tokens += n_tokens
-        for i in range(n_tokens):
-            j = n_tokens0 + i
-            self.batch.token[j] = batch[i]
-            self.batch.pos[j] = i
-            self.batch.seq_id[j][0] = seq_id
-            self.batch.n_seq_id[j] = 1
-            self.batch.logits[j] = logits_all
-        self.batch.logits[n_tokens - 1] = True
+        self.add_tokens(
+            tokens=batch,
+            pos=np.arange(n_past, n_past + n_tokens, dtype=np.int32),
+            seq_ids=seq_id,
+            logits=logits_all,
+        )
+        if logits_last:
+            self.logits[n_tokens0 + n_tokens - 1] = True
+
+    def add_tokens(
+        self,
+        tokens: Union[Sequence[int], npt.NDArray[np.intc]],
+        pos: Union[Sequence[int], npt.NDArray[np.int32]],
+        seq_ids: Union[int, Sequence[int], npt.NDArray[np.int32]],
+        logits: Union[bool, Sequence[bool], npt.NDArray[np.bool_]],
+    ):
+        """Append tokens of one or many sequences to the batch.
+
+        All arguments are broadcast to the number of tokens, so a whole prompt
+        chunk (or one token for each of many sequences) is written with a
+        handful of slice assignments."""
+        assert self.batch is not None
+        assert self.token is not None
+        n_tokens = len(tokens)
+        i0 = self.batch.n_tokens
+        i1 = i0 + n_tokens
+        assert i1 <= self._n_tokens, "batch overflow"
+        self.token[i0:i1] = tokens
+        self.pos[i0:i1] = pos
+        self.seq_id[i0:i1, 0] = seq_ids
+        self.n_seq_id[i0:i1] = 1
+        self.logits[i0:i1] = logits
+        self.batch.n_tokens = i1
+
+
+class _LlamaPieceTable:
+    """Token -> piece table of a model, filled on first lookup of each token.
+
+    Pieces are kept in a list indexed by token id, so detokenizing is a join
+    over list lookups and llama.cpp is only called once per distinct token.
+    `n_hits` and `n_misses` count the token lookups served from the table and
+    the ones that called into llama.cpp, `t_misses` is the time spent in
+    those calls."""
+
+    def __init__(
+        self, model: llama_cpp.llama_model_p, n_vocab: int, special: bool = False
+    ):
+        self.model = model
+        self.special = special
+        self._pieces: List[Optional[bytes]] = [None] * n_vocab
+        self._buffer = ctypes.create_string_buffer(32)
+
+        self.n_hits = 0
+        self.n_misses = 0
+        self.t_misses = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        n = self.n_hits + self.n_misses
+        return self.n_hits / n if n > 0 else 0.0
+
+    @property
+    def time_saved(self) -> float:
+        """Estimated seconds the hits would have spent in llama.cpp."""
+        if self.n_misses == 0:
+            return 0.0
+        return self.n_hits * self.t_misses / self.n_misses
+
+    def _fill(self, token: int) -> bytes:
+        t_start = time.perf_counter()
+        n = llama_cpp.llama_token_to_piece(
+            self.model, token, self._buffer, len(self._buffer), self.special
+        )
+        if n < 0:
+            self._buffer = ctypes.create_string_buffer(-n)
+            n = llama_cpp.llama_token_to_piece(
+                self.model, token, self._buffer, len(self._buffer), self.special
+            )
+        piece = self._buffer.raw[:n]
+        self._pieces[token] = piece
+        self.t_misses += time.perf_counter() - t_start
+        self.n_misses += 1
+        return piece
+
+    def __getitem__(self, token: int) -> bytes:
+        piece = self._pieces[token]
+        if piece is None:
+            return self._fill(token)
+        self.n_hits += 1
+        return piece
+
+    def join(self, tokens: Sequence[int]) -> bytes:
+        pieces = self._pieces
+        try:
+            output = b"".join([pieces[token] for token in tokens])  # type: ignore
+        except TypeError:
+            # Some tokens were never looked up
+            return b"".join([self[token] for token in tokens])
+        self.n_hits += len(tokens)
+        return output
 
 
 class _LlamaTokenDataArray:
@@ -551,7 +755,7 @@ class _LlamaTokenDataArray:
                 [("id", np.intc), ("logit", np.single), ("p", np.single)], align=True
             ),
         )
-        self.candidates_data.resize(3, self.n_vocab, refcheck=False)
+        self.candidates_data.resize(self.n_vocab, refcheck=False)
         self.candidates = llama_cpp.llama_token_data_array(
             data=self.candidates_data.ctypes.data_as(llama_cpp.llama_token_data_p),
             size=self.n_vocab,
@@ -605,16 +809,7 @@ def _tokenize(model: _LlamaModel, text: str, add_bos: bool, special: bool) -> li
 
 def _token_to_piece(model: _LlamaModel, token: int, special: bool = False) -> str:
     assert model.model is not None
-    result = (ctypes.c_char * 8)(0)
-    n_tokens = llama_cpp.llama_token_to_piece(model.model, token, result, len(result), special)
-    if n_tokens < 0:
-        result = (ctypes.c_char * -n_tokens)(0)
-        check = llama_cpp.llama_token_to_piece(model.model, token, result, len(result), special)
-        if check != -n_tokens:
-            raise RuntimeError(f"Failed to get piece: token={token}")
-    else:
-        result = result[:n_tokens]
-    return bytes(result).decode("utf-8")
+    return model.pieces(special)[token].decode("utf-8")
 
 
 def _detokenize_spm(model: _LlamaModel, tokens: List[int]) -> str:
@@ -650,11 +845,11 @@ def _should_add_bos(model: _LlamaModel) -> bool:
 # Embedding functions
 
 
-def _normalize_embedding(embedding):
-    norm = float(np.linalg.norm(embedding))
-    if norm == 0.0:
-        return embedding
-    return [v / norm for v in embedding]
+def _normalize_embeddings(embeddings: npt.NDArray[np.single]) -> npt.NDArray[np.single]:
+    """Scale every row to unit length in place, leaving zero rows as they are."""
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    np.divide(embeddings, norms, out=embeddings, where=norms > 0.0)
+    return embeddings
 
 
 # Python wrappers over common/sampling structs
@@ -687,22 +882,96 @@ class _LlamaSamplingParams:
     logit_bias: dict[int, float] = field(default_factory=dict)
 
 
+class _LlamaTokenRing:
+    """Fixed capacity history of the most recent tokens.
+
+    Every token is written twice, at `i` and `i + capacity`, so the last `n`
+    tokens are always a contiguous slice of the buffer and can be passed to
+    llama.cpp without copying."""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self._data = np.zeros(2 * self.capacity, dtype=np.intc)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self):
+        return iter(self.last(self._size).tolist())
+
+    def reset(self):
+        self._head = 0
+        self._size = 0
+
+    def append(self, token: int):
+        self._data[self._head] = token
+        self._data[self._head + self.capacity] = token
+        self._head = (self._head + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def extend(self, tokens: Sequence[int]):
+        tokens = np.asarray(tokens, dtype=np.intc)[-self.capacity :]
+        n = len(tokens)
+        if n == 0:
+            return
+        idx = (self._head + np.arange(n)) % self.capacity
+        self._data[idx] = tokens
+        self._data[idx + self.capacity] = tokens
+        self._head = (self._head + n) % self.capacity
+        self._size = min(self._size + n, self.capacity)
+
+    def last(self, n: int) -> npt.NDArray[np.intc]:
+        """Return a view of the last `n` tokens, oldest first."""
+        n = max(min(n, self._size), 0)
+        start = self._head + self.capacity - n
+        return self._data[start : start + n]
+
+    def copy(self) -> "_LlamaTokenRing":
+        ring = _LlamaTokenRing(self.capacity)
+        ring._data[:] = self._data
+        ring._head = self._head
+        ring._size = self._size
+        return ring
+
+
 @dataclass
 class _LlamaSamplingContext:
     params: _LlamaSamplingParams = field(default_factory=_LlamaSamplingParams)
     mirostat_mu: ctypes.c_float = field(default_factory=ctypes.c_float)
     grammar: Optional[LlamaGrammar] = None
     # NOTE: Missing parsed_grammar
-    prev: list[int] = field(default_factory=list)
+    prev: Optional[_LlamaTokenRing] = None
     cur: list[llama_cpp.llama_token_data] = field(default_factory=list)
+    token_data_array: Optional[_LlamaTokenDataArray] = None
+
+    def __post_init__(self):
+        if self.prev is None:
+            self.prev = _LlamaTokenRing(self._n_prev(self.params))
+
+    @staticmethod
+    def _n_prev(params: _LlamaSamplingParams) -> int:
+        return max(params.n_prev, params.penalty_last_n)
+
+    def set_params(self, params: _LlamaSamplingParams):
+        """Swap the sampling parameters, growing the token history if needed."""
+        self.params = params
+        assert self.prev is not None
+        if self._n_prev(params) > self.prev.capacity:
+            prev = _LlamaTokenRing(self._n_prev(params))
+            prev.extend(self.prev.last(len(self.prev)))
+            self.prev = prev
 
     def reset(self):
-        self.prev = []
+        assert self.prev is not None
+        self.prev.reset()
         self.cur = []
         if self.grammar is not None:
             self.grammar.reset()
 
     def cp(self):
+        assert self.prev is not None
         return _LlamaSamplingContext(
             params=self.params,
             mirostat_mu=self.mirostat_mu,
@@ -712,48 +981,45 @@ class _LlamaSamplingContext:
         )
 
     def last(self) -> Optional[int]:
+        assert self.prev is not None
         if len(self.prev) > 0:
-            return self.prev[-1]
+            return int(self.prev.last(1)[0])
         else:
             return None
 
     def prev_str(self, ctx_main: _LlamaContext, n: int) -> str:
-        return ctx_main.model.detokenize(self.prev[-n:]).decode("utf-8")
+        assert self.prev is not None
+        return ctx_main.model.detokenize(self.prev.last(n).tolist()).decode("utf-8")
 
     def sample(
         self, ctx_main: _LlamaContext, idx: int = 0, logits_array: Optional[npt.NDArray[np.single]] = None
     ):
+        assert self.prev is not None
         n_vocab = ctx_main.model.n_vocab()
         id: int = 0
 
         if logits_array is None:
-            logits = ctx_main.get_logits_ith(idx)
-            logits_array = np.array(
-                ctypes.cast(logits, ctypes.POINTER(ctypes.c_float * n_vocab)).contents,
-                dtype=np.single,
-            )
+            logits_array = ctx_main.get_logits_ith_view(idx).copy()
 
         # apply logit_bias
         for token, logit_bias in self.params.logit_bias.items():
             logits_array[token] += logit_bias
 
-        token_data_array = _LlamaTokenDataArray(
-            n_vocab=n_vocab
-        )  # TODO: Only create this once
+        if self.token_data_array is None or self.token_data_array.n_vocab != n_vocab:
+            self.token_data_array = _LlamaTokenDataArray(n_vocab=n_vocab)
+        token_data_array = self.token_data_array
         token_data_array.copy_logits(logits_array)
 
         # apply penalties
         if len(self.prev) > 0:
             nl_token = ctx_main.model.token_nl()
             nl_logit = logits_array[nl_token]
-            last_tokens = self.prev[-self.params.penalty_last_n:]
-            last_tokens_size = min(len(last_tokens), self.params.penalty_last_n)
-            if last_tokens_size > 0:
-                last_tokens_p = (llama_cpp.llama_token * len(last_tokens))(*last_tokens)
+            last_tokens = self.prev.last(self.params.penalty_last_n)
+            if len(last_tokens) > 0:
                 ctx_main.sample_repetition_penalties(
                     token_data_array,
-                    last_tokens_p,
-                    last_tokens_size,
+                    last_tokens.ctypes.data_as(llama_cpp.llama_token_p),
+                    len(last_tokens),
                     self.params.penalty_repeat,
                     self.params.penalty_freq,
                     self.params.penalty_present,
@@ -812,4 +1078,5 @@ class _LlamaSamplingContext:
     def accept(self, ctx_main: _LlamaContext, id: int, apply_grammar: bool):
         if apply_grammar and self.grammar is not None:
             ctx_main.grammar_accept_token(self.grammar, id)
+        assert self.prev is not None
         self.prev.append(id)
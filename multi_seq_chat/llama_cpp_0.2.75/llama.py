@@ -19,8 +19,10 @@ from typing import (
     Deque,
     Callable,
     Dict,
+    Tuple,
 )
 from collections import deque
+from functools import partial
 from pathlib import Path
 
 
@@ -33,8 +35,28 @@ from .llama_cache import (
     LlamaCache,  # type: ignore
     LlamaDiskCache,  # type: ignore
     LlamaRAMCache,  # type: ignore
+    LlamaCacheAdmissionPolicy,
+    LlamaCacheMaxSizeAdmission,
+    LlamaCacheSizeAwareLRUAdmission,
 )
-from .llama_tokenizer import BaseLlamaTokenizer, LlamaTokenizer
+from .llama_tokenizer import BaseLlamaTokenizer, LlamaTokenizer, LlamaStreamDetokenizer
+from .llama_scheduler import LlamaScheduler, LlamaSequence
+from .llama_prefix_cache import LlamaPrefixCache
+from .llama_stop_matcher import StopMatcher
+from .llama_logits import (
+    BaseLlamaLogitsStore,
+    LlamaLogitsRing,
+    LlamaLogitsHistory,
+)
+from .llama_kv_slots import LlamaKVSlots
+from .llama_metrics import LlamaMetrics, LlamaMetricsWriter
+from .llama_context_policy import (
+    BaseLlamaContextPolicy,
+    LlamaShiftPolicy,
+    LlamaAttentionSinkPolicy,
+    LlamaSelfExtendPolicy,
+)
+from .llama_conversation import LlamaConversationTree, LlamaBranch
 import llama_cpp.llama_cpp as llama_cpp
 import llama_cpp.llama_chat_format as llama_chat_format
 
@@ -50,7 +72,7 @@ from ._internals import (
     _LlamaTokenDataArray,  # type: ignore
     _LlamaSamplingParams,  # type: ignore
     _LlamaSamplingContext,  # type: ignore
-    _normalize_embedding,  # type: ignore
+    _normalize_embeddings,  # type: ignore
 )
 from ._logger import set_verbose
 from ._utils import suppress_stdout_stderr
@@ -90,11 +112,17 @@ class Llama:
         yarn_beta_slow: float = 1.0,
         yarn_orig_ctx: int = 0,
         logits_all: bool = False,
+        logits_store: str = "memory",
         embedding: bool = False,
         offload_kqv: bool = True,
         flash_attn: bool = False,
         # Sampling Params
         last_n_tokens_size: int = 64,
+        # Prefix Cache Params
+        prefix_cache_slots: int = 0,
+        prefix_cache_block_size: int = 64,
+        # Context Shift Params
+        context_policy: Optional[BaseLlamaContextPolicy] = None,
         # LoRA Params
         lora_base: Optional[str] = None,
         lora_scale: float = 1.0,
@@ -167,10 +195,14 @@ class Llama:
             yarn_beta_slow: YaRN high correction dim
             yarn_orig_ctx: YaRN original context size
             logits_all: Return logits for all tokens, not just the last token. Must be True for completion to return logprobs.
+            logits_store: Where the logits of every token are kept for requests with logprobs or echo, "memory" or "mmap" for a temporary file. Other requests only keep the last rows.
             embedding: Embedding mode only.
             offload_kqv: Offload K, Q, V to GPU.
             flash_attn: Use flash attention.
             last_n_tokens_size: Maximum number of tokens to keep in the last_n_tokens deque.
+            prefix_cache_slots: Number of kv cache sequences reserved for parked prompt prefixes, 0 disables the paged prefix cache. The highest sequence ids below n_ctx are used.
+            prefix_cache_block_size: Number of tokens per prefix cache block.
+            context_policy: How a sequence makes room once it fills the context, copied for every sequence. Defaults to keeping the first prompt and dropping the older half of the rest.
             lora_base: Optional path to base model, useful if using a quantized base model and you want to apply LoRA to an f16 model.
             lora_path: Path to a LoRA file to apply to the model.
             numa: numa policy
@@ -329,6 +361,8 @@ class Llama:
 
         self.cache: Optional[BaseLlamaCache] = None
 
+        self.metrics = LlamaMetrics()
+
         self.lora_base = lora_base
         self.lora_scale = lora_scale
         self.lora_path = lora_path
@@ -391,16 +425,45 @@ class Llama:
 
         self._candidates = _LlamaTokenDataArray(n_vocab=self._n_vocab)
 
+        self._prefix_cache: Optional[LlamaPrefixCache] = None
+        if prefix_cache_slots > 0:
+            self._prefix_cache = LlamaPrefixCache(
+                self._ctx,
+                seq_ids=range(self._n_ctx - 1, self._n_ctx - 1 - prefix_cache_slots, -1),
+                block_size=prefix_cache_block_size,
+            )
+
+        self.context_policy = context_policy if context_policy is not None else LlamaShiftPolicy()
+        # Copy of context_policy holding the state of every sequence
+        self._context_policies: Dict[int, BaseLlamaContextPolicy] = {}
+
         self.n_tokens = 0
         self.input_ids: npt.NDArray[np.intc] = np.ndarray((n_ctx,), dtype=np.intc)
-        self.scores: npt.NDArray[np.single] = np.ndarray(
-            (n_ctx, self._n_vocab), dtype=np.single
+        # Sequence whose kv cache holds input_ids[:n_tokens]
+        self._input_ids_seq_id: Optional[int] = None
+        if logits_store not in ("memory", "mmap"):
+            raise ValueError(f"Unknown logits_store: {logits_store}")
+        self.logits_store = logits_store
+        # Sampling reads the last row, speculative decoding the rows of the
+        # draft tokens of the last batch. logprobs and echo read the history
+        self._logits_ring = LlamaLogitsRing(
+            self._n_vocab, self.n_batch if self.draft_model is not None else 1
         )
+        # Allocated by the first request asking for logprobs
+        self._logits_history: Optional[LlamaLogitsHistory] = None
+        self._keep_logits_history = False
 
         self._mirostat_mu = ctypes.c_float(
             2.0 * 5.0
         )  # TODO: Move this to sampling context
 
+        # Reused by every call to sample, only the parameters and the token
+        # history are refreshed per token.
+        self._sampling_context = _LlamaSamplingContext(
+            params=_LlamaSamplingParams(penalty_last_n=self.last_n_tokens_size),
+            token_data_array=self._candidates,
+        )
+
         try:
             self.metadata = self._model.metadata()
         except Exception as e:
@@ -476,7 +539,7 @@ class Llama:
 
     @property
     def _scores(self) -> npt.NDArray[np.single]:
-        return self.scores[: self.n_tokens, :]
+        return self._get_logits(0, self.n_tokens)
 
     @property
     def eval_tokens(self) -> Deque[int]:
@@ -484,11 +547,30 @@ class Llama:
 
     @property
     def eval_logits(self) -> Deque[List[float]]:
+        maxlen = self._n_ctx if self.context_params.logits_all else 1
+        start = max(0, self.n_tokens - maxlen)
+        if self._logits_history is None or not self._logits_history.has(
+            start, self.n_tokens
+        ):
+            # Only the last row is kept outside of logprobs requests
+            start = max(0, self.n_tokens - 1)
         return deque(
-            self.scores[: self.n_tokens, :].tolist(),
-            maxlen=self._n_ctx if self.context_params.logits_all else 1,
+            self._get_logits(start, self.n_tokens).tolist(),
+            maxlen=maxlen,
         )
 
+    def _get_logits(self, start: int, end: int) -> npt.NDArray[np.single]:
+        """Return the logits rows of positions [start, end).
+
+        Raises:
+            RuntimeError: If the rows were not kept, only the last rows are
+                unless the generation was asked to keep the logits history.
+        """
+        for store in (self._logits_ring, self._logits_history):
+            if store is not None and store.has(start, end):
+                return store.get(start, end)
+        raise RuntimeError(f"Logits of tokens {start} to {end} were not kept")
+
     def tokenize(
         self, text: bytes, add_bos: bool = True, special: bool = False
     ) -> List[int]:
@@ -505,6 +587,22 @@ class Llama:
         """
         return self.tokenizer_.tokenize(text, add_bos, special)
 
+    def tokenize_batch(
+        self, texts: Sequence[bytes], add_bos: bool = True, special: bool = False
+    ) -> List[List[int]]:
+        """Tokenize a list of strings.
+
+        Args:
+            texts: The utf-8 encoded strings to tokenize.
+
+        Raises:
+            RuntimeError: If the tokenization failed.
+
+        Returns:
+            A list of tokens for every string.
+        """
+        return self.tokenizer_.tokenize_batch(texts, add_bos, special)
+
     def detokenize(
         self, tokens: List[int], prev_tokens: Optional[List[int]] = None
     ) -> bytes:
@@ -540,41 +638,98 @@ class Llama:
         """Reset the model state."""
         self.n_tokens = 0
 
+    def _kv_cache_clear(self):
+        """Clear the whole kv cache, and forget the prefixes parked in it and
+        which sequence `input_ids` describes."""
+        self._ctx.kv_cache_clear()
+        if self._prefix_cache is not None:
+            self._prefix_cache.clear()
+        self._input_ids_seq_id = None
+        self.reset()
+
+    def _seq_policy(self, seq_id: int) -> BaseLlamaContextPolicy:
+        """The context policy holding the state of a sequence."""
+        policy = self._context_policies.get(seq_id)
+        if policy is None:
+            policy = self._context_policies[seq_id] = self.context_policy.copy()
+        return policy
+
+    def _make_room(self, policy: BaseLlamaContextPolicy, seq_id: int, n_new: int) -> int:
+        """Let the policy of a sequence free room for `n_new` tokens, only the
+        kv cache of that sequence is shifted. Returns the number of dropped tokens."""
+        print(f"hit ctx limit, n_past: {self.n_tokens}.", file=sys.stderr)
+        start, end = policy.make_room(self.ctx, seq_id, self.n_tokens, n_new, self._n_ctx)
+        n_dropped = end - start
+        self.input_ids[start : self.n_tokens - n_dropped] = self.input_ids[end : self.n_tokens].copy()
+        self.n_tokens -= n_dropped
+        self._logits_ring.invalidate(start, self._n_ctx)
+        if self._logits_history is not None:
+            self._logits_history.invalidate(start, self._n_ctx)
+        print(f"dropped tokens {start} to {end}, reset n_tokens to {self.n_tokens}.", file=sys.stderr)
+        return n_dropped
+
     def reset_to_first_round(self, n_tokens):
         """Reset the model state but keep the initial prompt in cache"""
         self.n_tokens = n_tokens
 
-    def eval(self, tokens: Sequence[int],seq_id):
+    def eval(self, tokens: Sequence[int], seq_id: int = 0):
         """Evaluate a list of tokens.
 
         Args:
             tokens: The list of tokens to evaluate.
+            seq_id: The sequence whose kv cache the tokens are appended to.
         """
         assert self._ctx.ctx is not None
         assert self._batch.batch is not None
-        self._ctx.kv_cache_seq_rm(seq_id, self.n_tokens, -1)
+        policy = self._seq_policy(seq_id)
+        self._ctx.kv_cache_seq_rm(seq_id, policy.pos(self.n_tokens), -1)
+        self.metrics.n_tokens_evaluated.inc(len(tokens))
         #self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+        logits_all = self.context_params.logits_all
         for i in range(0, len(tokens), self.n_batch):
             batch = tokens[i : min(len(tokens), i + self.n_batch)]
             n_past = self.n_tokens
             n_tokens = len(batch)
-            self._batch.set_batch(
-                batch=batch, n_past=n_past, logits_all=self.context_params.logits_all, seq_id=seq_id
+            # Without logits_all only the row of the very last token is read
+            is_last = i + self.n_batch >= len(tokens)
+            policy.before_decode(self.ctx, seq_id, n_past)
+            self._batch.reset()
+            self._batch.add_sequence(
+                batch,
+                seq_id=seq_id,
+                logits_all=logits_all,
+                n_past=policy.pos(n_past),
+                logits_last=is_last,
             )
-            self._ctx.decode(self._batch)
+            try:
+                self._ctx.decode(self._batch)
+            except RuntimeError:
+                # Parked prefixes may be holding the kv cells this batch needs
+                if self._prefix_cache is None or len(self._prefix_cache) == 0:
+                    raise
+                self._prefix_cache.clear()
+                self._ctx.decode(self._batch)
+            self._input_ids_seq_id = seq_id
             # Save tokens
             self.input_ids[n_past : n_past + n_tokens] = batch
-            # Save logits
-            if self.context_params.logits_all:
-                rows = n_tokens
-                cols = self._n_vocab
-                logits = self._ctx.get_logits()[: rows * cols]
-                self.scores[n_past : n_past + n_tokens, :].reshape(-1)[: :] = logits
+            # Save logits, straight from the context buffer
+            history = self._logits_history
+            if logits_all:
+                logits = self._ctx.get_logits_view(n_tokens)
+                if self._keep_logits_history:
+                    assert history is not None
+                    history.write(n_past, logits)
+                elif history is not None:
+                    history.invalidate(n_past, n_past + n_tokens)
+                if is_last:
+                    self._logits_ring.write(n_past, logits)
             else:
-                rows = 1
-                cols = self._n_vocab
-                logits = self._ctx.get_logits()[: rows * cols]
-                self.scores[n_past + n_tokens - 1, :].reshape(-1)[: :] = logits
+                if history is not None:
+                    history.invalidate(n_past, n_past + n_tokens)
+                if is_last:
+                    self._logits_ring.write(
+                        n_past + n_tokens - 1, self._ctx.get_logits_view(1)
+                    )
             # Update n_tokens
             self.n_tokens += n_tokens
 
@@ -612,16 +767,14 @@ class Llama:
         assert self.n_tokens > 0
 
         if idx is None:
-            logits: npt.NDArray[np.single] = self._scores[-1, :]
+            idx = self.n_tokens - 1
+            input_ids = self._input_ids
         else:
-            logits = self._scores[idx, :]
+            input_ids = self._input_ids[: idx + 1]
+        logits: npt.NDArray[np.single] = self._get_logits(idx, idx + 1)[0]
 
         if logits_processor is not None:
-            logits[:] = (
-                logits_processor(self._input_ids, logits)
-                if idx is None
-                else logits_processor(self._input_ids[: idx + 1], logits)
-            )
+            logits[:] = logits_processor(input_ids, logits)
 
         sampling_params = _LlamaSamplingParams(
             top_k=top_k,
@@ -639,11 +792,13 @@ class Llama:
             mirostat_eta=mirostat_eta,
             penalize_nl=penalize_nl,
         )
-        sampling_context = _LlamaSamplingContext(
-            params=sampling_params,
-            grammar=grammar,
-        )
-        sampling_context.prev = list(self.eval_tokens)
+        sampling_context = self._sampling_context
+        sampling_context.set_params(sampling_params)
+        sampling_context.mirostat_mu = self._mirostat_mu
+        sampling_context.grammar = grammar
+        assert sampling_context.prev is not None
+        sampling_context.prev.reset()
+        sampling_context.prev.extend(self.input_ids[: self.n_tokens])
         id = sampling_context.sample(ctx_main=self._ctx, logits_array=logits)
         sampling_context.accept(
             ctx_main=self._ctx,
@@ -673,6 +828,8 @@ class Llama:
         stopping_criteria: Optional[StoppingCriteriaList] = None,
         grammar: Optional[LlamaGrammar] = None,
         seq_id: Optional[int] = 0,
+        use_prefix_cache: bool = True,
+        logits_history: bool = False,
     ) -> Generator[int, Optional[Sequence[int]], None]:
         """Create a generator of tokens from a prompt.
 
@@ -689,6 +846,11 @@ class Llama:
             temp: The temperature parameter.
             repeat_penalty: The repeat penalty parameter.
             reset: Whether to reset the model state.
+            seq_id: The kv cache sequence to evaluate the tokens in.
+            use_prefix_cache: Whether to reuse and park prompt prefixes in the paged prefix cache.
+                Attached prefixes have no logits, so disable it when the prompt logits are needed.
+            logits_history: Keep the logits of every evaluated token instead of only the last ones,
+                as needed for logprobs. Requires logits_all.
 
         Yields:
             The generated tokens.
@@ -696,39 +858,71 @@ class Llama:
         # Reset mirostat sampling
         self._mirostat_mu = ctypes.c_float(2.0 * mirostat_tau)
 
+        prefix_cache = self._prefix_cache if use_prefix_cache and reset else None
+        prompt_tokens = tokens
+        policy = self._seq_policy(seq_id)
+
+        if logits_history:
+            if not self.context_params.logits_all:
+                raise ValueError("logits_history requires a model created with logits_all=True")
+            if self._logits_history is None:
+                self._logits_history = LlamaLogitsHistory(
+                    self._n_ctx, self._n_vocab, mmap=self.logits_store == "mmap"
+                )
+        self._keep_logits_history = logits_history
+
         # Check for kv cache prefix match
-        if reset and self.n_tokens > 0:
+        if reset and self.n_tokens > 0 and seq_id == self._input_ids_seq_id:
             longest_prefix = 0
             for a, b in zip(self._input_ids, tokens[:-1]):
                 if a == b:
                     longest_prefix += 1
                 else:
                     break
-            if longest_prefix > 0:
+            # Tokens evaluated without keeping their logits are evaluated again
+            if logits_history:
+                assert self._logits_history is not None
+                longest_prefix = min(longest_prefix, self._logits_history.n_valid_prefix())
+            # Grouped positions can't be cut back into
+            if longest_prefix > 0 and policy.can_truncate(longest_prefix):
                 if self.verbose:
                     print(f"Llama.generate: prefix-match hit, longest_prefix={longest_prefix}", file=sys.stderr)
                 reset = False
                 tokens = tokens[longest_prefix:]
                 self.n_tokens = longest_prefix
 
+        # Parked prefixes have a position per token
+        if not reset and not policy.linear:
+            prefix_cache = None
+
+        # Attach to a longer prefix parked in the paged prefix cache
+        if prefix_cache is not None:
+            n_cached = prefix_cache.attach(
+                prompt_tokens,
+                seq_id,
+                max_tokens=len(prompt_tokens) - 1,
+                min_tokens=0 if reset else self.n_tokens,
+            )
+            if n_cached > 0:
+                if self.verbose:
+                    print(f"Llama.generate: prefix cache hit, n_tokens={n_cached}", file=sys.stderr)
+                reset = False
+                tokens = prompt_tokens[n_cached:]
+                self.input_ids[:n_cached] = prompt_tokens[:n_cached]
+                self.n_tokens = n_cached
+                if self._logits_history is not None:
+                    self._logits_history.invalidate(0, n_cached)
+                self._input_ids_seq_id = seq_id
+
         # Reset the model state
         if reset:
             self.reset()
         
         if self.n_tokens == 0:
             self.n_prompt_tokens = len(tokens)
+            policy.start(len(tokens))
         # if self.keep==-1 and self.n_tokens != 0:
         #     self.reset_to_first_round(n_prompt_tokens)
-        if (self.n_tokens + len(tokens) >= self._n_ctx):
-            print(f"hit ctx limit, n_past: {self.n_tokens}.", file=sys.stderr)
-            n_left = self.n_tokens - self.n_prompt_tokens#- self.params.n_keep
-            self.n_tokens = self.n_prompt_tokens
-            print(f"keep the first prompt: {self.n_tokens}.", file=sys.stderr)
-            # insert n_left/2 tokens at the start of embd from last_n_tokens
-            llama_cpp.llama_kv_cache_seq_rm(self.ctx, -1, self.n_tokens, int(n_left/2)+self.n_tokens)
-            llama_cpp.llama_kv_cache_seq_add(self.ctx, -1, int(n_left/2)+self.n_tokens, self.n_ctx, -int(n_left/2))
-            self.n_tokens = int(n_left/2)+self.n_tokens
-            print(f"reset n_tokens to {self.n_tokens}.", file=sys.stderr)
 
         # Reset the grammar
         if grammar is not None:
@@ -740,7 +934,13 @@ class Llama:
         # Eval and sample
         #try:
         while True:
+            if (self.n_tokens + len(tokens) >= self._n_ctx):
+                sample_idx -= self._make_room(policy, seq_id, len(tokens))
+                prefix_cache = None
             self.eval(tokens,seq_id)
+            if prefix_cache is not None and policy.linear:
+                prefix_cache.store(self._input_ids.tolist(), seq_id)
+                prefix_cache = None
             while sample_idx < self.n_tokens:
                 token = self.sample(
                     top_k=top_k,
@@ -763,7 +963,7 @@ class Llama:
 
                 sample_idx += 1
                 if stopping_criteria is not None and stopping_criteria(
-                    self._input_ids, self._scores[-1, :]
+                    self._input_ids, self._get_logits(self.n_tokens - 1, self.n_tokens)[0]
                 ):
                     return
                 tokens_or_none = yield token
@@ -774,7 +974,7 @@ class Llama:
 
                 if sample_idx < self.n_tokens and token != self._input_ids[sample_idx]:
                     self.n_tokens = sample_idx
-                    self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+                    self._ctx.kv_cache_seq_rm(seq_id, policy.pos(self.n_tokens), -1)
                     break
 
             if self.draft_model is not None:
@@ -792,6 +992,135 @@ class Llama:
         #     return
 
 
+    def generate_batch(
+        self,
+        prompts: Sequence[Sequence[int]],
+        seq_ids: Optional[Sequence[int]] = None,
+        max_tokens: Optional[int] = None,
+        top_k: int = 40,
+        top_p: float = 0.95,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        temp: float = 0.80,
+        repeat_penalty: float = 1.1,
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        tfs_z: float = 1.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+        penalize_nl: bool = True,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+    ) -> Generator[Tuple[int, int], None, None]:
+        """Create a generator of tokens for several prompts decoded together.
+
+        Each prompt gets its own sequence in the kv cache. All sequences are
+        packed into a single batch per decode step, so the total throughput
+        grows with the number of prompts instead of running them one after
+        another. Prompts wait for kv cache cells when the cache can't hold
+        all of them up to `max_tokens`, without `max_tokens` they may fill the
+        context and run one after another. The kv cache of a sequence is
+        freed once it finishes.
+
+        Examples:
+            >>> llama = Llama("models/ggml-7b.bin")
+            >>> prompts = [llama.tokenize(b"Hello"), llama.tokenize(b"Bonjour")]
+            >>> for seq_id, token in llama.generate_batch(prompts, max_tokens=16):
+            ...     print(seq_id, llama.detokenize([token]))
+
+        Args:
+            prompts: The prompt tokens of each sequence.
+            seq_ids: The sequence id of each prompt, defaults to 0..len(prompts)-1.
+            max_tokens: The maximum number of tokens to generate per sequence.
+
+        Yields:
+            (seq_id, token) pairs in the order they were sampled.
+        """
+        # The single sequence state (input_ids) no longer matches the kv cache
+        self.reset()
+
+        sampling_params = _LlamaSamplingParams(
+            top_k=top_k,
+            top_p=top_p,
+            min_p=min_p,
+            tfs_z=tfs_z,
+            typical_p=typical_p,
+            temp=temp,
+            penalty_last_n=self.last_n_tokens_size,
+            penalty_repeat=repeat_penalty,
+            penalty_freq=frequency_penalty,
+            penalty_present=presence_penalty,
+            mirostat=mirostat_mode,
+            mirostat_tau=mirostat_tau,
+            mirostat_eta=mirostat_eta,
+            penalize_nl=penalize_nl,
+        )
+        if seq_ids is None:
+            seq_ids = list(range(len(prompts)))
+        if len(seq_ids) != len(prompts):
+            raise ValueError("seq_ids and prompts must have the same length")
+
+        scheduler = LlamaScheduler(self)
+        for seq_id, tokens in zip(seq_ids, prompts):
+            scheduler.add(
+                LlamaSequence(
+                    seq_id,
+                    tokens,
+                    max_tokens=max_tokens,
+                    sampling_params=sampling_params,
+                    logits_processor=logits_processor,
+                    stopping_criteria=stopping_criteria,
+                )
+            )
+        for sequence, token in scheduler:
+            yield sequence.seq_id, token
+            if sequence.finished:
+                # Free its cells for the sequences still waiting
+                self._ctx.kv_cache_seq_rm(sequence.seq_id, -1, -1)
+
+    def _reuse_prefix(self, tokens: Sequence[int], seq_id: int) -> int:
+        """Keep the longest prefix of all but the last of `tokens` that the kv
+        cache of `seq_id` already holds, or attach a longer one parked in the
+        prefix cache.
+
+        Returns:
+            The number of tokens of the prefix in the kv cache of `seq_id`,
+            the tokens after them are left for the caller to evaluate.
+        """
+        policy = self._seq_policy(seq_id)
+        n_past = 0
+        # The scheduler places every token at the position equal to its index
+        if self.n_tokens > 0 and seq_id == self._input_ids_seq_id and policy.linear:
+            n_past = Llama.longest_token_prefix(self._input_ids.tolist(), tokens[:-1])
+        if n_past == 0:
+            policy.start(len(tokens))
+        if self._prefix_cache is not None:
+            n_cached = self._prefix_cache.attach(
+                tokens, seq_id, max_tokens=len(tokens) - 1, min_tokens=n_past
+            )
+            n_past = max(n_past, n_cached)
+        if n_past > 0 and self.verbose:
+            print(f"Llama._reuse_prefix: prefix hit, seq_id={seq_id}, n_tokens={n_past}", file=sys.stderr)
+        return n_past
+
+    def _fork_seq_ids(self, seq_id: int, n: int) -> List[int]:
+        """`seq_id` and the first `n - 1` sequence ids after it that hold no
+        cells and aren't reserved for the prefix cache, so sequences of other
+        users (e.g. conversation branches) are left alone."""
+        reserved = set(self._prefix_cache.seq_ids) if self._prefix_cache is not None else set()
+        seq_ids = [seq_id]
+        fork_id = seq_id
+        while len(seq_ids) < n:
+            fork_id += 1
+            if fork_id >= self._n_ctx:
+                raise ValueError(
+                    f"Not enough kv cache sequences after {seq_id} for {n} completions"
+                )
+            if fork_id not in reserved and self._ctx.kv_cache_seq_pos_max(fork_id) < 0:
+                seq_ids.append(fork_id)
+        return seq_ids
+
     def create_embedding(
         self, input: Union[str, List[str]], model: Optional[str] = None
     ) -> CreateEmbeddingResponse:
@@ -837,24 +1166,94 @@ class Llama:
         self,
         input: Union[str, List[str]],
         normalize: bool = False,
-        truncate: bool = True,
+        truncate: bool = False,
         return_count: bool = False,
     ):
         """Embed a string.
 
         Args:
             input: The utf-8 encoded string to embed.
+            normalize: Scale every embedding to unit length.
+            truncate: Cut inputs longer than the batch size instead of
+                averaging the embeddings of their windows.
+            return_count: Also return the number of tokens evaluated.
+
+        Returns:
+            A list of embeddings, or of token embeddings if the model doesn't pool.
+        """
+        pooled = self.pooling_type() != llama_cpp.LLAMA_POOLING_TYPE_NONE
+        inputs = [input] if isinstance(input, str) else input
+        embeddings, n_tokens = self._embed(inputs, truncate)
+        if normalize:
+            _normalize_embeddings(embeddings)
+
+        data: Union[List[List[float]], List[List[List[float]]]]
+        if pooled:
+            data = embeddings.tolist()
+        else:
+            offsets = np.cumsum(n_tokens)
+            data = [rows.tolist() for rows in np.split(embeddings, offsets[:-1])]
+
+        output = data[0] if isinstance(input, str) else data
+        if return_count:
+            return output, int(n_tokens.sum())
+        else:
+            return output
+
+    def embed_array(
+        self,
+        input: Union[str, Sequence[str]],
+        normalize: bool = False,
+        truncate: bool = False,
+        return_count: bool = False,
+    ):
+        """Embed strings into a NumPy matrix.
+
+        Unlike `embed`, no Python lists are built, which matters when
+        embedding many documents. The model has to pool the token embeddings.
+
+        Args:
+            input: The utf-8 encoded string(s) to embed.
+            normalize: Scale every embedding to unit length.
+            truncate: Cut inputs longer than the batch size instead of
+                averaging the embeddings of their windows.
+            return_count: Also return the number of tokens evaluated.
+
+        Raises:
+            ValueError: If the model doesn't pool the token embeddings.
+
+        Returns:
+            A contiguous float32 array of shape (len(input), n_embd), or
+            (n_embd,) for a single string.
+        """
+        if self.pooling_type() == llama_cpp.LLAMA_POOLING_TYPE_NONE:
+            raise ValueError(
+                "embed_array needs a pooling type, use embed for token embeddings"
+            )
+        inputs = [input] if isinstance(input, str) else input
+        embeddings, n_tokens = self._embed(inputs, truncate)
+        if normalize:
+            _normalize_embeddings(embeddings)
+
+        output = embeddings[0] if isinstance(input, str) else embeddings
+        if return_count:
+            return output, int(n_tokens.sum())
+        else:
+            return output
+
+    def _embed(
+        self, inputs: Sequence[str], truncate: bool
+    ) -> Tuple[npt.NDArray[np.single], npt.NDArray[np.intp]]:
+        """Embed strings, split into windows of at most `n_batch` tokens.
 
         Returns:
-            A list of embeddings
+            The embeddings, one row per input if the model pools (the mean of
+            its windows weighted by their length) else one row per token, and
+            the number of tokens of every input.
         """
         assert self._ctx.ctx is not None
-        n_embd = self.n_embd()
         n_batch = self.n_batch
-
-        # get pooling information
-        pooling_type = self.pooling_type()
-        logits_all = pooling_type == llama_cpp.LLAMA_POOLING_TYPE_NONE
+        pooled = self.pooling_type() != llama_cpp.LLAMA_POOLING_TYPE_NONE
 
         if self.context_params.embeddings == False:
             raise RuntimeError(
@@ -863,141 +1262,125 @@ class Llama:
 
         if self.verbose:
             llama_cpp.llama_reset_timings(self._ctx.ctx)
+        t_start = time.perf_counter()
 
-        if isinstance(input, str):
-            inputs = [input]
-        else:
-            inputs = input
-
-        # reset batch
-        self._batch.reset()
-
-        # decode and fetch embeddings
-        data: Union[List[List[float]], List[List[List[float]]]] = []
-
-        def decode_batch(seq_sizes: List[int]):
-            assert self._ctx.ctx is not None
-            llama_cpp.llama_kv_cache_clear(self._ctx.ctx)
-            self._ctx.decode(self._batch)
-            self._batch.reset()
-
-            # store embeddings
-            if pooling_type == llama_cpp.LLAMA_POOLING_TYPE_NONE:
-                pos: int = 0
-                for i, size in enumerate(seq_sizes):
-                    ptr = llama_cpp.llama_get_embeddings(self._ctx.ctx)
-                    embedding: List[List[float]] = [
-                        ptr[pos + j * n_embd : pos + (j + 1) * n_embd] for j in range(size)
-                    ]
-                    if normalize:
-                        embedding = [_normalize_embedding(e) for e in embedding]
-                    data.append(embedding)
-                    pos += size
-            else:
-                for i in range(len(seq_sizes)):
-                    ptr = llama_cpp.llama_get_embeddings_seq(self._ctx.ctx, i)
-                    embedding: List[float] = ptr[:n_embd]
-                    if normalize:
-                        embedding = _normalize_embedding(embedding)
-                    data.append(embedding)
-
-        # init state
-        total_tokens = 0
-        s_batch = []
-        t_batch = 0
-        p_batch = 0
-
-        # accumulate batches and encode
-        for text in inputs:
-            tokens = self.tokenize(text.encode("utf-8"))
+        windows: List[List[int]] = []
+        owners: List[int] = []
+        for i, tokens in enumerate(
+            self.tokenize_batch([text.encode("utf-8") for text in inputs])
+        ):
             if truncate:
                 tokens = tokens[:n_batch]
+            for start in range(0, len(tokens), n_batch):
+                windows.append(tokens[start : start + n_batch])
+                owners.append(i)
+
+        lengths = np.fromiter(map(len, windows), dtype=np.intp, count=len(windows))
+        owner = np.array(owners, dtype=np.intp)
+        n_tokens = np.bincount(owner, weights=lengths, minlength=len(inputs)).astype(
+            np.intp
+        )
 
-            n_tokens = len(tokens)
-            total_tokens += n_tokens
-
-            # check for overrun
-            if n_tokens > n_batch:
-                raise ValueError(
-                    f"Requested tokens ({n_tokens}) exceed batch size of {n_batch}"
-                )
-
-            # time to eval batch
-            if t_batch + n_tokens > n_batch:
-                decode_batch(s_batch)
-                s_batch = []
-                t_batch = 0
-                p_batch = 0
+        embeddings = self._embed_windows(windows, lengths, pooled)
+
+        # Inputs may have been split into several windows or, when empty,
+        # none, so equal counts don't mean one window per input
+        if pooled and not np.array_equal(owner, np.arange(len(inputs))):
+            weighted = embeddings * lengths[:, None].astype(np.single)
+            embeddings = np.zeros((len(inputs), self.n_embd()), dtype=np.single)
+            np.add.at(embeddings, owner, weighted)
+            np.divide(
+                embeddings,
+                n_tokens[:, None].astype(np.single),
+                out=embeddings,
+                where=n_tokens[:, None] > 0,
+            )
 
-            # add to batch
-            self._batch.add_sequence(tokens, p_batch, logits_all)
+        if self.verbose:
+            llama_cpp.llama_print_timings(self._ctx.ctx)
 
-            # update batch stats
-            s_batch.append(n_tokens)
-            t_batch += n_tokens
-            p_batch += 1
+        seconds = time.perf_counter() - t_start
+        self.metrics.n_embedding_requests.inc()
+        self.metrics.n_embedding_tokens.inc(int(lengths.sum()))
+        if seconds > 0:
+            self.metrics.embedding_tokens_per_second.observe(
+                float(lengths.sum()) / seconds
+            )
 
-        # hanlde last batch
-        decode_batch(s_batch)
+        self._kv_cache_clear()
 
-        if self.verbose:
-            llama_cpp.llama_print_timings(self._ctx.ctx)
+        return embeddings, n_tokens
 
-        output = data[0] if isinstance(input, str) else data
+    def _embed_windows(
+        self,
+        windows: Sequence[Sequence[int]],
+        lengths: npt.NDArray[np.intp],
+        pooled: bool,
+    ) -> npt.NDArray[np.single]:
+        """Evaluate windows of at most `n_batch` tokens, one sequence each.
 
-        llama_cpp.llama_kv_cache_clear(self._ctx.ctx)
-        self.reset()
+        The windows are sorted by length and packed into as few batches as
+        possible: every batch takes the longest windows left that fit and is
+        topped up with the shortest ones.
 
-        if return_count:
-            return output, total_tokens
+        Returns:
+            One row per window if the model pools, else one row per token, in
+            the order of `windows`.
+        """
+        n_batch = self.n_batch
+        if pooled:
+            rows = np.arange(len(windows), dtype=np.intp)
+            n_rows = len(windows)
         else:
-            return output
+            rows = np.cumsum(lengths) - lengths
+            n_rows = int(lengths.sum())
+        embeddings = np.zeros((n_rows, self.n_embd()), dtype=np.single)
+
+        order = np.argsort(-lengths, kind="stable")
+        order = order[lengths[order] > 0].tolist()
+        lo, hi = 0, len(order)
+        while lo < hi:
+            batch: List[int] = []
+            n_tokens = 0
+            while lo < hi and n_tokens + lengths[order[lo]] <= n_batch:
+                batch.append(order[lo])
+                n_tokens += lengths[order[lo]]
+                lo += 1
+            while lo < hi and n_tokens + lengths[order[hi - 1]] <= n_batch:
+                hi -= 1
+                batch.append(order[hi])
+                n_tokens += lengths[order[hi]]
 
-    def _create_completion(
-        self,
-        prompt: Union[str, List[int]],
-        suffix: Optional[str] = None,
-        max_tokens: Optional[int] = 16,
-        temperature: float = 0.8,
-        top_p: float = 0.95,
-        min_p: float = 0.05,
-        typical_p: float = 1.0,
-        logprobs: Optional[int] = None,
-        echo: bool = False,
-        stop: Optional[Union[str, List[str]]] = [],
-        frequency_penalty: float = 0.0,
-        presence_penalty: float = 0.0,
-        repeat_penalty: float = 1.1,
-        top_k: int = 40,
-        stream: bool = False,
-        seed: Optional[int] = None,
-        tfs_z: float = 1.0,
-        mirostat_mode: int = 0,
-        mirostat_tau: float = 5.0,
-        mirostat_eta: float = 0.1,
-        model: Optional[str] = None,
-        stopping_criteria: Optional[StoppingCriteriaList] = None,
-        logits_processor: Optional[LogitsProcessorList] = None,
-        grammar: Optional[LlamaGrammar] = None,
-        logit_bias: Optional[Dict[str, float]] = None,
-        seq_id: Optional[int] = 0,
+            self._batch.reset()
+            for seq_id, w in enumerate(batch):
+                self._batch.add_sequence(windows[w], seq_id, logits_all=not pooled)
+            self._kv_cache_clear()
+            self._ctx.decode(self._batch)
 
-    ) -> Union[
-        Iterator[CreateCompletionResponse], Iterator[CreateCompletionStreamResponse]
-    ]:
-        assert self._ctx is not None
-        assert suffix is None or suffix.__class__ is str
+            if pooled:
+                for seq_id, w in enumerate(batch):
+                    embeddings[w] = self._ctx.get_embeddings_seq_view(seq_id)
+            else:
+                token_embeddings = self._ctx.get_embeddings_view(n_tokens)
+                i = 0
+                for w in batch:
+                    n = lengths[w]
+                    embeddings[rows[w] : rows[w] + n] = token_embeddings[i : i + n]
+                    i += n
+        self._batch.reset()
 
-        completion_id: str = f"cmpl-{str(uuid.uuid4())}"
-        created: int = int(time.time())
+        return embeddings
+
+    def _completion_prompt_tokens(
+        self, prompt: Union[str, List[int]], suffix: Optional[str] = None
+    ) -> List[int]:
+        """The tokens of a completion prompt, in fill-in-the-middle form if a
+        suffix is given and the model has the infill tokens."""
         prefix_token_id: int = self._model.token_prefix()
         middle_token_id: int = self._model.token_middle()
         suffix_token_id: int = self._model.token_suffix()
-        # If prompt is empty, initialize completion with BOS token to avoid
-        # detokenization including a space at the beginning of the completion
-        completion_tokens: List[int] = [] if len(prompt) > 0 else [self.token_bos()]
         # Add blank space to start of prompt to match OG llama tokenizer
-        prompt_tokens: List[int] = (
+        return (
             (
                 [prefix_token_id]
                 if prefix_token_id >= 0 and suffix is not None
@@ -1038,18 +1421,13 @@ class Llama:
                 else []
             )
         )
-        text: bytes = b""
-        returned_tokens: int = 0
-        stop = (
-            stop if isinstance(stop, list) else [stop] if isinstance(stop, str) else []
-        )
-        model_name: str = model if model is not None else self.model_path
-
-        # all_p = self.detokenize(prompt_tokens).decode("utf-8", errors="ignore")
-        # with open("/home/teng/AItools/writing-assistant/log.txt", "a") as f:
-        #     f.write(all_p)
-        #     f.write('\n')
 
+    def _with_logit_bias(
+        self,
+        logits_processor: Optional[LogitsProcessorList],
+        logit_bias: Optional[Dict[str, float]],
+    ) -> Optional[LogitsProcessorList]:
+        """`logits_processor` followed by a processor adding `logit_bias`."""
         # NOTE: This likely doesn't work correctly for the first token in the prompt
         # because of the extra space added to the start of the prompt_tokens
         if logit_bias is not None:
@@ -1066,25 +1444,81 @@ class Llama:
                     new_scores[input_id] = score + scores[input_id]
                 return new_scores
 
-            _logit_bias_processor = LogitsProcessorList([logit_bias_processor])
             if logits_processor is None:
-                logits_processor = _logit_bias_processor
-            else:
-                logits_processor = logits_processor.extend(_logit_bias_processor)
+                return LogitsProcessorList([logit_bias_processor])
+            return LogitsProcessorList([*logits_processor, logit_bias_processor])
+        return logits_processor
 
-        if self.verbose:
-            self._ctx.reset_timings()
-
-        if len(prompt_tokens) >= self._n_ctx:
-            raise ValueError(
-                f"Requested tokens ({len(prompt_tokens)}) exceed context window of {llama_cpp.llama_n_ctx(self.ctx)}"
-            )
+    def _create_completion(
+        self,
+        prompt: Union[str, List[int]],
+        suffix: Optional[str] = None,
+        max_tokens: Optional[int] = 16,
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        logprobs: Optional[int] = None,
+        echo: bool = False,
+        stop: Optional[Union[str, List[str]]] = [],
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        repeat_penalty: float = 1.1,
+        top_k: int = 40,
+        stream: bool = False,
+        seed: Optional[int] = None,
+        tfs_z: float = 1.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+        model: Optional[str] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        grammar: Optional[LlamaGrammar] = None,
+        logit_bias: Optional[Dict[str, float]] = None,
+        seq_id: Optional[int] = 0,
 
-        if max_tokens is None or max_tokens <= 0:
-            # Unlimited, depending on n_ctx.
-            max_tokens = self._n_ctx - len(prompt_tokens)
+    ) -> Union[
+        Iterator[CreateCompletionResponse], Iterator[CreateCompletionStreamResponse]
+    ]:
+        assert self._ctx is not None
+        assert suffix is None or suffix.__class__ is str
 
-        # Truncate max_tokens if requested tokens would exceed the context window
+        t_start = time.perf_counter()
+        completion_id: str = f"cmpl-{str(uuid.uuid4())}"
+        created: int = int(time.time())
+        suffix_token_id: int = self._model.token_suffix()
+        # If prompt is empty, initialize completion with BOS token to avoid
+        # detokenization including a space at the beginning of the completion
+        completion_tokens: List[int] = [] if len(prompt) > 0 else [self.token_bos()]
+        prompt_tokens = self._completion_prompt_tokens(prompt, suffix)
+        text: bytes = b""
+        returned_tokens: int = 0
+        stop = (
+            stop if isinstance(stop, list) else [stop] if isinstance(stop, str) else []
+        )
+        model_name: str = model if model is not None else self.model_path
+
+        # all_p = self.detokenize(prompt_tokens).decode("utf-8", errors="ignore")
+        # with open("/home/teng/AItools/writing-assistant/log.txt", "a") as f:
+        #     f.write(all_p)
+        #     f.write('\n')
+
+        logits_processor = self._with_logit_bias(logits_processor, logit_bias)
+
+        if self.verbose:
+            self._ctx.reset_timings()
+
+        if len(prompt_tokens) >= self._n_ctx:
+            raise ValueError(
+                f"Requested tokens ({len(prompt_tokens)}) exceed context window of {llama_cpp.llama_n_ctx(self.ctx)}"
+            )
+
+        if max_tokens is None or max_tokens <= 0:
+            # Unlimited, depending on n_ctx.
+            max_tokens = self._n_ctx - len(prompt_tokens)
+
+        # Truncate max_tokens if requested tokens would exceed the context window
         max_tokens = (
             max_tokens
             if max_tokens + len(prompt_tokens) < self._n_ctx
@@ -1122,7 +1556,55 @@ class Llama:
             self._ctx.set_rng_seed(seed)
 
         finish_reason = "length"
-        multibyte_fix = 0
+        detokenizer = LlamaStreamDetokenizer(self.tokenizer_, prev_tokens=prompt_tokens)
+        stop_matcher = StopMatcher(stop_sequences)
+        returned_bytes = 0
+        returned_text_length = 0
+
+        def stream_logprobs_chunk(i: int, end: int) -> Optional[CreateCompletionStreamResponse]:
+            nonlocal returned_text_length
+            token = completion_tokens[i]
+            start = detokenizer.offsets[i - 1] if i > 0 else 0
+            token_str = bytes(
+                detokenizer.text[start : min(detokenizer.offsets[i], end)]
+            ).decode("utf-8", errors="ignore")
+            text_offset = len(prompt) + returned_text_length
+            returned_text_length += len(token_str)
+            if token == self.token_bos():
+                return None
+            token_offset = len(prompt_tokens) + i
+            token_logprobs, top_logprobs = self._top_logprobs(
+                self._get_logits(token_offset - 1, token_offset), [token], logprobs
+            )
+            top_logprob = top_logprobs[0]
+            top_logprob.update({token_str: token_logprobs[0]})
+            return {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": model_name,
+                "choices": [
+                    {
+                        "text": token_str,
+                        "index": 0,
+                        "logprobs": {
+                            "tokens": [token_str],
+                            "text_offset": [text_offset],
+                            "token_logprobs": token_logprobs,
+                            "top_logprobs": [top_logprob],
+                        },
+                        "finish_reason": None,
+                    }
+                ],
+            }
+
+        metrics = self.metrics
+        metrics.n_requests.inc()
+        metrics.n_prompt_tokens.inc(len(prompt_tokens))
+        n_evaluated = metrics.n_tokens_evaluated.value
+        t_eval = time.perf_counter()
+        t_first: Optional[float] = None
+
         for token in self.generate(
             prompt_tokens,
             top_k=top_k,
@@ -1140,167 +1622,87 @@ class Llama:
             stopping_criteria=stopping_criteria,
             logits_processor=logits_processor,
             grammar=grammar,
-            seq_id=seq_id
+            seq_id=seq_id,
+            # Echoed logprobs read the logits of every prompt token
+            use_prefix_cache=not (echo and logprobs is not None),
+            logits_history=logprobs is not None,
         ):
             assert self._model.model is not None
+            if t_first is None:
+                t_first = time.perf_counter()
+                metrics.time_to_first_token.observe(t_first - t_start)
+                n_prompt_evaluated = metrics.n_tokens_evaluated.value - n_evaluated
+                if n_prompt_evaluated > 0 and t_first > t_eval:
+                    metrics.prompt_tokens_per_second.observe(
+                        n_prompt_evaluated / (t_first - t_eval)
+                    )
+
             if llama_cpp.llama_token_is_eog(self._model.model, token):
-                text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+                text = bytes(detokenizer.text)
                 finish_reason = "stop"
                 break
 
             completion_tokens.append(token)
+            stop_match = stop_matcher.feed(detokenizer.push(token))
+            all_text = detokenizer.text
 
-            all_text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
-
-            # Contains multi-byte UTF8
-            for k, char in enumerate(all_text[-3:]):
-                k = 3 - k
-                for num, pattern in [(2, 192), (3, 224), (4, 240)]:
-                    # Bitwise AND check
-                    if num > k and pattern & char == pattern:
-                        multibyte_fix = num - k
+            if stop_match is not None:
+                text = bytes(all_text[: stop_match[0]])
+                finish_reason = "stop"
+                break
 
             # Stop incomplete bytes from passing
-            if multibyte_fix > 0:
-                multibyte_fix -= 1
+            if detokenizer.n_incomplete > 0:
                 continue
 
-            any_stop = [s for s in stop_sequences if s in all_text]
-            if len(any_stop) > 0:
-                first_stop = any_stop[0]
-                text = all_text[: all_text.index(first_stop)]
-                finish_reason = "stop"
-                break
-
             if stream:
-                remaining_tokens = completion_tokens[returned_tokens:]
-                remaining_text = self.detokenize(remaining_tokens, prev_tokens=prompt_tokens + completion_tokens[:returned_tokens])
-                remaining_length = len(remaining_text)
+                remaining_length = len(all_text) - returned_bytes
 
                 # We want to avoid yielding any characters from
                 # the generated text if they are part of a stop
                 # sequence.
-                first_stop_position = 0
-                for s in stop_sequences:
-                    for i in range(min(len(s), remaining_length), 0, -1):
-                        if remaining_text.endswith(s[:i]):
-                            if i > first_stop_position:
-                                first_stop_position = i
-                            break
-
-                token_end_position = 0
+                first_stop_position = min(stop_matcher.partial, remaining_length)
+                stream_end = len(all_text) - first_stop_position
 
                 if logprobs is not None:
-                    # not sure how to handle this branch when dealing
-                    # with CJK output, so keep it unchanged
-                    for token in remaining_tokens:
-                        if token == self.token_bos():
-                            continue
-                        token_end_position += len(self.detokenize([token], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens]))
-                        # Check if stop sequence is in the token
-                        if token_end_position > (
-                            remaining_length - first_stop_position
-                        ):
+                    while returned_tokens < len(completion_tokens):
+                        if detokenizer.offsets[returned_tokens] > stream_end:
                             break
-                        token_str = self.detokenize([token], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens]).decode(
-                            "utf-8", errors="ignore"
-                        )
-                        text_offset = len(prompt) + len(
-                            self.detokenize(completion_tokens[:returned_tokens], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens]).decode(
-                                "utf-8", errors="ignore"
-                            )
-                        )
-                        token_offset = len(prompt_tokens) + returned_tokens
-                        logits = self._scores[token_offset - 1, :]
-                        current_logprobs = Llama.logits_to_logprobs(logits).tolist()
-                        sorted_logprobs = list(
-                            sorted(
-                                zip(current_logprobs, range(len(current_logprobs))),
-                                reverse=True,
-                            )
-                        )
-                        top_logprob = {
-                            self.detokenize([i]).decode(
-                                "utf-8", errors="ignore"
-                            ): logprob
-                            for logprob, i in sorted_logprobs[:logprobs]
-                        }
-                        top_logprob.update({token_str: current_logprobs[int(token)]})
-                        logprobs_or_none = {
-                            "tokens": [
-                                self.detokenize([token], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens]).decode(
-                                    "utf-8", errors="ignore"
-                                )
-                            ],
-                            "text_offset": [text_offset],
-                            "token_logprobs": [current_logprobs[int(token)]],
-                            "top_logprobs": [top_logprob],
-                        }
+                        chunk = stream_logprobs_chunk(returned_tokens, stream_end)
+                        returned_bytes = detokenizer.offsets[returned_tokens]
                         returned_tokens += 1
-                        yield {
-                            "id": completion_id,
-                            "object": "text_completion",
-                            "created": created,
-                            "model": model_name,
-                            "choices": [
-                                {
-                                    "text": self.detokenize([token], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens]).decode(
-                                        "utf-8", errors="ignore"
-                                    ),
-                                    "index": 0,
-                                    "logprobs": logprobs_or_none,
-                                    "finish_reason": None,
-                                }
-                            ],
-                        }
-                else:
-                    while len(remaining_tokens) > 0:
-                        decode_success = False
-                        for i in range(1, len(remaining_tokens) + 1):
-                            try:
-                                bs = self.detokenize(remaining_tokens[:i], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens])
-                                ts = bs.decode("utf-8")
-                                decode_success = True
-                                break
-                            except UnicodeError:
-                                pass
-                        else:
-                            break
-                        if not decode_success:
-                            # all remaining tokens cannot be decoded to a UTF-8 character
-                            break
-                        token_end_position += len(bs)
-                        if token_end_position > (
-                            remaining_length - first_stop_position
-                        ):
-                            break
-                        remaining_tokens = remaining_tokens[i:]
-                        returned_tokens += i
-
-                        yield {
-                            "id": completion_id,
-                            "object": "text_completion",
-                            "created": created,
-                            "model": model_name,
-                            "choices": [
-                                {
-                                    "text": ts,
-                                    "index": 0,
-                                    "logprobs": None,
-                                    "finish_reason": None,
-                                }
-                            ],
-                        }
+                        if chunk is not None:
+                            yield chunk
+                elif stream_end > returned_bytes:
+                    ts = bytes(all_text[returned_bytes:stream_end]).decode(
+                        "utf-8", errors="ignore"
+                    )
+                    returned_bytes = stream_end
+                    returned_tokens = len(completion_tokens)
+                    yield {
+                        "id": completion_id,
+                        "object": "text_completion",
+                        "created": created,
+                        "model": model_name,
+                        "choices": [
+                            {
+                                "text": ts,
+                                "index": 0,
+                                "logprobs": None,
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
 
             if len(completion_tokens) >= max_tokens:
-                text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+                text = bytes(detokenizer.text)
                 finish_reason = "length"
                 break
 
         if stopping_criteria is not None and stopping_criteria(
-            self._input_ids, self._scores[-1, :]
+            self._input_ids, self._get_logits(self.n_tokens - 1, self.n_tokens)[0]
         ):
-            text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+            text = bytes(detokenizer.text)
             finish_reason = "stop"
             
         # all_t = text.decode("utf-8", errors="ignore")
@@ -1311,75 +1713,25 @@ class Llama:
         if self.verbose:
             self._ctx.print_timings()
 
-        if stream:
-            remaining_tokens = completion_tokens[returned_tokens:]
-            all_text = self.detokenize(remaining_tokens, prev_tokens=prompt_tokens + completion_tokens[:returned_tokens])
-            any_stop = [s for s in stop_sequences if s in all_text]
-            if len(any_stop) > 0:
-                end = min(all_text.index(stop) for stop in any_stop)
-            else:
-                end = len(all_text)
-
-            token_end_position = 0
-            for token in remaining_tokens:
-                token_end_position += len(self.detokenize([token], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens]))
-
-                logprobs_or_none: Optional[CompletionLogprobs] = None
-                if logprobs is not None:
-                    if token == self.token_bos():
-                        continue
-                    token_str = self.detokenize([token]).decode(
-                        "utf-8", errors="ignore"
-                    )
-                    text_offset = len(prompt) + len(
-                        self.detokenize(completion_tokens[:returned_tokens], prev_tokens=prompt_tokens + completion_tokens[:returned_tokens])
-                    )
-                    token_offset = len(prompt_tokens) + returned_tokens - 1
-                    logits = self._scores[token_offset, :]
-                    current_logprobs = Llama.logits_to_logprobs(logits).tolist()
-                    sorted_logprobs = list(
-                        sorted(
-                            zip(current_logprobs, range(len(current_logprobs))),
-                            reverse=True,
-                        )
-                    )
-                    top_logprob = {
-                        self.detokenize([i]).decode("utf-8", errors="ignore"): logprob
-                        for logprob, i in sorted_logprobs[:logprobs]
-                    }
-                    top_logprob.update({token_str: current_logprobs[int(token)]})
-                    logprobs_or_none = {
-                        "tokens": [
-                            self.detokenize([token]).decode("utf-8", errors="ignore")
-                        ],
-                        "text_offset": [text_offset],
-                        "token_logprobs": [current_logprobs[int(token)]],
-                        "top_logprobs": [top_logprob],
-                    }
+        metrics.n_completion_tokens.inc(len(completion_tokens))
+        if t_first is not None and len(completion_tokens) > 1:
+            t_end = time.perf_counter()
+            if t_end > t_first:
+                metrics.generation_tokens_per_second.observe(
+                    (len(completion_tokens) - 1) / (t_end - t_first)
+                )
 
-                if token_end_position >= end:
-                    last_text = self.detokenize([token])
-                    if token_end_position == end - 1:
+        if stream:
+            if logprobs is not None:
+                while returned_tokens < len(completion_tokens):
+                    if returned_bytes >= len(text):
                         break
+                    chunk = stream_logprobs_chunk(returned_tokens, len(text))
+                    returned_bytes = detokenizer.offsets[returned_tokens]
                     returned_tokens += 1
-                    yield {
-                        "id": completion_id,
-                        "object": "text_completion",
-                        "created": created,
-                        "model": model_name,
-                        "choices": [
-                            {
-                                "text": last_text[
-                                    : len(last_text) - (token_end_position - end)
-                                ].decode("utf-8", errors="ignore"),
-                                "index": 0,
-                                "logprobs": logprobs_or_none,
-                                "finish_reason": None,
-                            }
-                        ],
-                    }
-                    break
-                returned_tokens += 1
+                    if chunk is not None:
+                        yield chunk
+            elif len(text) > returned_bytes:
                 yield {
                     "id": completion_id,
                     "object": "text_completion",
@@ -1387,11 +1739,9 @@ class Llama:
                     "model": model_name,
                     "choices": [
                         {
-                            "text": self.detokenize([token]).decode(
-                                "utf-8", errors="ignore"
-                            ),
+                            "text": text[returned_bytes:].decode("utf-8", errors="ignore"),
                             "index": 0,
-                            "logprobs": logprobs_or_none,
+                            "logprobs": None,
                             "finish_reason": None,
                         }
                     ],
@@ -1414,7 +1764,8 @@ class Llama:
                 if self.verbose:
                     print("Llama._create_completion: cache save", file=sys.stderr)
                 self.cache[prompt_tokens + completion_tokens] = self.save_state()
-                print("Llama._create_completion: cache saved", file=sys.stderr)
+                if self.verbose:
+                    print("Llama._create_completion: cache saved", file=sys.stderr)
             return
 
         if self.cache:
@@ -1449,10 +1800,14 @@ class Llama:
                 self.detokenize([token], prev_tokens=all_tokens[:i]).decode("utf-8", errors="ignore")
                 for i, token in enumerate(all_tokens)
             ]
-            all_logprobs = Llama.logits_to_logprobs(self._scores)[token_offset:]
-            # TODO: may be able to change this loop to use np.take_along_dim
-            for idx, (token, token_str, logprobs_token) in enumerate(
-                zip(all_tokens, all_token_strs, all_logprobs)
+            n_rows = min(len(all_tokens), self.n_tokens - token_offset)
+            all_logprobs, all_top_logprobs = self._top_logprobs(
+                self._get_logits(token_offset, token_offset + n_rows),
+                all_tokens[:n_rows],
+                logprobs,
+            )
+            for idx, (token, token_str, logprob, top_logprob) in enumerate(
+                zip(all_tokens, all_token_strs, all_logprobs, all_top_logprobs)
             ):
                 if token == self.token_bos():
                     continue
@@ -1465,17 +1820,8 @@ class Llama:
                     )
                 )
                 tokens.append(token_str)
-                sorted_logprobs = list(
-                    sorted(
-                        zip(logprobs_token, range(len(logprobs_token))), reverse=True
-                    )
-                )
-                token_logprobs.append(logprobs_token[int(token)])
-                top_logprob: Optional[Dict[str, float]] = {
-                    self.detokenize([i], prev_tokens=all_tokens[:idx]).decode("utf-8", errors="ignore"): logprob
-                    for logprob, i in sorted_logprobs[:logprobs]
-                }
-                top_logprob.update({token_str: logprobs_token[int(token)]})
+                token_logprobs.append(logprob)
+                top_logprob.update({token_str: logprob})
                 top_logprobs.append(top_logprob)
             # Weird idosincracy of the OpenAI API where
             # token_logprobs and top_logprobs are null for
@@ -1510,9 +1856,388 @@ class Llama:
             },
         }
 
+    def _create_completions(
+        self,
+        prompts: Sequence[Union[str, List[int]]],
+        suffix: Optional[str] = None,
+        max_tokens: Optional[int] = 16,
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        logprobs: Optional[int] = None,
+        echo: bool = False,
+        stop: Optional[Union[str, List[str]]] = [],
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        repeat_penalty: float = 1.1,
+        top_k: int = 40,
+        stream: bool = False,
+        seed: Optional[int] = None,
+        tfs_z: float = 1.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+        model: Optional[str] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        grammar: Optional[LlamaGrammar] = None,
+        logit_bias: Optional[Dict[str, float]] = None,
+        seq_id: Optional[int] = 0,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        seq_ids: Optional[Sequence[int]] = None,
+    ) -> Union[
+        Iterator[CreateCompletionResponse], Iterator[CreateCompletionStreamResponse]
+    ]:
+        """Sample `best_of` completions of each prompt and keep the `n` with
+        the highest cumulative logprob.
+
+        The prompts are decoded together by a `LlamaScheduler`, each on
+        sequences of its own starting from `seq_id`: prompt chunks and
+        generated tokens of all of them are packed into shared batches. A
+        prompt is evaluated once and its kv cache copied to one sequence per
+        completion. Prompts wait until the context has cells for their
+        completions, so any number of them can be passed.
+
+        Completion `i` of prompt `k` has index `k * n + i`.
+        """
+        assert self._ctx is not None
+        assert self._model.model is not None
+        assert suffix is None or suffix.__class__ is str
+        assert seq_id is not None
+
+        if best_of is None:
+            best_of = n
+        if len(prompts) == 0:
+            raise ValueError("At least one prompt is needed")
+        if n < 1 or best_of < n:
+            raise ValueError(f"best_of ({best_of}) must be at least n ({n}), n at least 1")
+        if stream and best_of != n:
+            raise ValueError("best_of can't be streamed, the completions are ranked once all are done")
+        if logprobs is not None:
+            raise ValueError("logprobs are not supported with several prompts or completions")
+
+        t_start = time.perf_counter()
+        completion_id: str = f"cmpl-{str(uuid.uuid4())}"
+        created: int = int(time.time())
+        suffix_token_id: int = self._model.token_suffix()
+        prompt_tokens = [self._completion_prompt_tokens(p, suffix) for p in prompts]
+        stop = (
+            stop if isinstance(stop, list) else [stop] if isinstance(stop, str) else []
+        )
+        stop_sequences = [s.encode("utf-8") for s in stop]
+        model_name: str = model if model is not None else self.model_path
+        logits_processor = self._with_logit_bias(logits_processor, logit_bias)
+
+        # The completions of a prompt share its cells, and split the rest
+        prompt_max_tokens: List[int] = []
+        for tokens in prompt_tokens:
+            if len(tokens) >= self._n_ctx:
+                raise ValueError(
+                    f"Requested tokens ({len(tokens)}) exceed context window of {llama_cpp.llama_n_ctx(self.ctx)}"
+                )
+            n_free = (self._n_ctx - len(tokens)) // best_of
+            if n_free < 1:
+                raise ValueError(
+                    f"Requested tokens ({len(tokens)} for the prompt, {best_of} completions) exceed context window of {self._n_ctx}"
+                )
+            prompt_max_tokens.append(
+                n_free if max_tokens is None or max_tokens <= 0 else min(max_tokens, n_free)
+            )
+        # Enough sequences to fill a batch with generated tokens, and a spare
+        # as seq_id may hold on to its tokens
+        n_pool = min(len(prompts) * best_of, max(self.n_batch, best_of) + 1)
+        if seq_ids is None:
+            pool_seq_ids = self._fork_seq_ids(seq_id, n_pool)
+        else:
+            pool_seq_ids = [seq_id] + [s for s in dict.fromkeys(seq_ids) if s != seq_id]
+            pool_seq_ids = pool_seq_ids[:n_pool]
+            if len(pool_seq_ids) < best_of:
+                raise ValueError(
+                    f"{best_of} sequences are needed per prompt, seq_ids only gives {len(pool_seq_ids)}"
+                )
+        # The other sequences are overwritten and cleared afterwards
+        reserved = set(self._prefix_cache.seq_ids) if self._prefix_cache is not None else set()
+        for fork_id in pool_seq_ids[1:]:
+            if fork_id in reserved or self._ctx.kv_cache_seq_pos_max(fork_id) >= 0:
+                raise ValueError(
+                    f"Sequence {fork_id} is in use, completions only fork into empty sequences"
+                )
+        free_seq_ids = deque(pool_seq_ids)
+
+        if self.verbose:
+            self._ctx.reset_timings()
+
+        if seed is not None:
+            self._ctx.set_rng_seed(seed)
+
+        sampling_params = _LlamaSamplingParams(
+            top_k=top_k,
+            top_p=top_p,
+            min_p=min_p,
+            tfs_z=tfs_z,
+            typical_p=typical_p,
+            temp=temperature,
+            penalty_last_n=self.last_n_tokens_size,
+            penalty_repeat=repeat_penalty,
+            penalty_freq=frequency_penalty,
+            penalty_present=presence_penalty,
+            mirostat=mirostat_mode,
+            mirostat_tau=mirostat_tau,
+            mirostat_eta=mirostat_eta,
+        )
+        scheduler = LlamaScheduler(self)
+        # Per prompt: its sequence ids, the first one evaluates the prompt,
+        # and the cells reserved for it
+        prompt_seq_ids: List[List[int]] = [[] for _ in prompts]
+        prompt_cells = [
+            len(tokens) + best_of * m
+            for tokens, m in zip(prompt_tokens, prompt_max_tokens)
+        ]
+        n_unfinished = [best_of] * len(prompts)
+        prefilling: Dict[int, int] = {}
+        n_cells = 0
+        n_started = 0
+        # Per completion, prompt k's j-th at k * best_of + j
+        sequences: List[Optional[LlamaSequence]] = [None] * (len(prompts) * best_of)
+        choice_of: Dict[int, int] = {}
+        detokenizers: List[Optional[LlamaStreamDetokenizer]] = [None] * len(sequences)
+        stop_matchers = [StopMatcher(stop_sequences) for _ in sequences]
+        texts: List[Optional[bytes]] = [None] * len(sequences)
+        finish_reasons = ["length"] * len(sequences)
+        returned_bytes = [0] * len(sequences)
+        # The sequence decoded in seq_id, which keeps its tokens afterwards
+        # for a follow-up prompt
+        kept: Optional[LlamaSequence] = None
+
+        def fork(k: int):
+            nonlocal kept
+            tokens = prompt_tokens[k]
+            n_past = len(tokens) - 1
+            base_id = prompt_seq_ids[k][0]
+            for j, fork_id in enumerate(prompt_seq_ids[k]):
+                if fork_id != base_id:
+                    self._ctx.kv_cache_seq_rm(fork_id, -1, -1)
+                    self._ctx.kv_cache_seq_cp(base_id, fork_id, 0, n_past)
+                c = k * best_of + j
+                sequences[c] = scheduler.add(
+                    LlamaSequence(
+                        fork_id,
+                        tokens,
+                        n_past=n_past,
+                        max_tokens=prompt_max_tokens[k],
+                        sampling_params=sampling_params,
+                        grammar=(
+                            grammar if grammar is None or c == 0 else grammar.copy()
+                        ),
+                        logits_processor=logits_processor,
+                        stopping_criteria=stopping_criteria,
+                        track_logprob=best_of > n,
+                    )
+                )
+                choice_of[fork_id] = c
+                detokenizers[c] = LlamaStreamDetokenizer(self.tokenizer_, prev_tokens=tokens)
+                if fork_id == seq_id:
+                    kept = sequences[c]
+            if self._prefix_cache is not None and n_past > 0:
+                self._prefix_cache.store(tokens[:n_past], base_id)
+
+        def stream_chunk(
+            c: int, text: str, finish_reason: Optional[str] = None
+        ) -> CreateCompletionStreamResponse:
+            return {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": model_name,
+                "choices": [
+                    {
+                        "text": text,
+                        "index": c,
+                        "logprobs": None,
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+
+        metrics = self.metrics
+        metrics.n_requests.inc()
+        metrics.n_prompt_tokens.inc(sum(len(tokens) for tokens in prompt_tokens))
+        t_eval = time.perf_counter()
+        t_first: Optional[float] = None
+
+        try:
+            while n_started < len(prompts) or len(scheduler) > 0:
+                # Start the waiting prompts there are sequences and cells for
+                while n_started < len(prompts) and len(free_seq_ids) >= best_of:
+                    k = n_started
+                    if n_cells > 0 and n_cells + prompt_cells[k] > self._n_ctx:
+                        break
+                    n_cells += prompt_cells[k]
+                    n_started += 1
+                    prompt_seq_ids[k] = [free_seq_ids.popleft() for _ in range(best_of)]
+                    base_id = prompt_seq_ids[k][0]
+                    tokens = prompt_tokens[k]
+                    n_past = self._reuse_prefix(tokens, base_id)
+                    if n_past < len(tokens) - 1:
+                        prefill = scheduler.add(
+                            LlamaSequence(base_id, tokens[:-1], n_past=n_past, max_tokens=0)
+                        )
+                        prefilling[base_id] = k
+                        if base_id == seq_id:
+                            kept = prefill
+                    else:
+                        fork(k)
+
+                n_evaluated = scheduler.n_tokens_evaluated
+                try:
+                    results = scheduler.step()
+                except RuntimeError:
+                    # Parked prefixes may be holding the kv cells the prompts need
+                    if self._prefix_cache is None or len(self._prefix_cache) == 0:
+                        raise
+                    self._prefix_cache.clear()
+                    results = scheduler.step()
+                metrics.n_tokens_evaluated.inc(scheduler.n_tokens_evaluated - n_evaluated)
+
+                for base_id, k in list(prefilling.items()):
+                    if base_id not in scheduler:
+                        del prefilling[base_id]
+                        fork(k)
+
+                if t_first is None and len(results) > 0:
+                    t_first = time.perf_counter()
+                    metrics.time_to_first_token.observe(t_first - t_start)
+                    n_prompt_evaluated = scheduler.n_tokens_evaluated - len(results)
+                    if n_prompt_evaluated > 0 and t_first > t_eval:
+                        metrics.prompt_tokens_per_second.observe(
+                            n_prompt_evaluated / (t_first - t_eval)
+                        )
+
+                for sequence, token in results:
+                    c = choice_of[sequence.seq_id]
+                    detokenizer = detokenizers[c]
+                    assert detokenizer is not None
+                    if llama_cpp.llama_token_is_eog(self._model.model, token):
+                        texts[c] = bytes(detokenizer.text)
+                        finish_reasons[c] = "stop"
+                    else:
+                        stop_match = stop_matchers[c].feed(detokenizer.push(token))
+                        if stop_match is not None:
+                            texts[c] = bytes(detokenizer.text[: stop_match[0]])
+                            finish_reasons[c] = "stop"
+                            if sequence.seq_id in scheduler:
+                                scheduler.remove(sequence.seq_id)
+                        elif sequence.finished:
+                            texts[c] = bytes(detokenizer.text)
+                            assert sequence.finish_reason is not None
+                            finish_reasons[c] = sequence.finish_reason
+
+                    text = texts[c]
+                    if text is not None:
+                        k = c // best_of
+                        n_unfinished[k] -= 1
+                        if n_unfinished[k] == 0:
+                            n_cells -= prompt_cells[k]
+                            for fork_id in prompt_seq_ids[k]:
+                                del choice_of[fork_id]
+                                # Once no prompt is waiting seq_id keeps its tokens
+                                if fork_id == seq_id and n_started == len(prompts):
+                                    continue
+                                if fork_id == seq_id:
+                                    kept = None
+                                self._ctx.kv_cache_seq_rm(fork_id, -1, -1)
+                                free_seq_ids.append(fork_id)
+
+                    if not stream:
+                        continue
+                    if text is not None:
+                        if len(text) > returned_bytes[c]:
+                            yield stream_chunk(
+                                c, text[returned_bytes[c] :].decode("utf-8", errors="ignore")
+                            )
+                        yield stream_chunk(c, "", finish_reasons[c])
+                    elif detokenizer.n_incomplete == 0:
+                        # Hold back what may be the start of a stop sequence
+                        all_text = detokenizer.text
+                        stream_end = len(all_text) - min(
+                            stop_matchers[c].partial, len(all_text) - returned_bytes[c]
+                        )
+                        if stream_end > returned_bytes[c]:
+                            yield stream_chunk(
+                                c,
+                                bytes(all_text[returned_bytes[c] : stream_end]).decode(
+                                    "utf-8", errors="ignore"
+                                ),
+                            )
+                            returned_bytes[c] = stream_end
+        finally:
+            for fork_id in pool_seq_ids:
+                if fork_id != seq_id or kept is None:
+                    self._ctx.kv_cache_seq_rm(fork_id, -1, -1)
+            self._switch_seq(seq_id, [] if kept is None else kept.tokens[: kept.n_past])
+
+        if self.verbose:
+            self._ctx.print_timings()
+
+        completion_lengths = [
+            len(s.completion_tokens) for s in sequences if s is not None
+        ]
+        n_completion_tokens = sum(completion_lengths)
+        metrics.n_completion_tokens.inc(n_completion_tokens)
+        if t_first is not None and n_completion_tokens > len(completion_lengths):
+            t_end = time.perf_counter()
+            if t_end > t_first:
+                metrics.generation_tokens_per_second.observe(
+                    (n_completion_tokens - len(completion_lengths)) / (t_end - t_first)
+                )
+
+        if stream:
+            return
+
+        cumulative_logprobs = [
+            s.cumulative_logprob if s is not None else -float("inf") for s in sequences
+        ]
+        choices: List[CompletionChoice] = []
+        for k, prompt in enumerate(prompts):
+            ranked = list(range(k * best_of, (k + 1) * best_of))
+            if best_of > n:
+                ranked.sort(key=lambda c: cumulative_logprobs[c], reverse=True)
+            for i, c in enumerate(ranked[:n]):
+                text = texts[c]
+                assert text is not None
+                text_str = text.decode("utf-8", errors="ignore")
+                if echo:
+                    text_str = prompt + text_str
+                if suffix_token_id < 0 and suffix is not None:
+                    text_str = text_str + suffix
+                choices.append(
+                    {
+                        "text": text_str,
+                        "index": k * n + i,
+                        "logprobs": None,
+                        "finish_reason": finish_reasons[c],
+                    }
+                )
+
+        n_prompt_tokens = sum(len(tokens) for tokens in prompt_tokens)
+        yield {
+            "id": completion_id,
+            "object": "text_completion",
+            "created": created,
+            "model": model_name,
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": n_prompt_tokens,
+                "completion_tokens": n_completion_tokens,
+                "total_tokens": n_prompt_tokens + n_completion_tokens,
+            },
+        }
+
     def create_completion(
         self,
-        prompt: Union[str, List[int]],
+        prompt: Union[str, List[int], List[str], List[List[int]]],
         suffix: Optional[str] = None,
         max_tokens: Optional[int] = 16,
         temperature: float = 0.8,
@@ -1537,18 +2262,22 @@ class Llama:
         logits_processor: Optional[LogitsProcessorList] = None,
         grammar: Optional[LlamaGrammar] = None,
         logit_bias: Optional[Dict[str, float]] = None,
+        seq_id: Optional[int] = 0,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        seq_ids: Optional[Sequence[int]] = None,
     ) -> Union[CreateCompletionResponse, Iterator[CreateCompletionStreamResponse]]:
         """Generate text from a prompt.
 
         Args:
-            prompt: The prompt to generate text from.
+            prompt: The prompt to generate text from, or a list of prompts decoded together on separate sequences. Completion `i` of prompt `k` has index `k * n + i`.
             suffix: A suffix to append to the generated text. If None, no suffix is appended.
             max_tokens: The maximum number of tokens to generate. If max_tokens <= 0 or None, the maximum number of tokens to generate is unlimited and depends on n_ctx.
             temperature: The temperature to use for sampling.
             top_p: The top-p value to use for nucleus sampling. Nucleus sampling described in academic paper "The Curious Case of Neural Text Degeneration" https://arxiv.org/abs/1904.09751
             min_p: The min-p value to use for minimum p sampling. Minimum P sampling as described in https://github.com/ggerganov/llama.cpp/pull/3841
             typical_p: The typical-p value to use for sampling. Locally Typical Sampling implementation described in the paper https://arxiv.org/abs/2202.00666.
-            logprobs: The number of logprobs to return. If None, no logprobs are returned.
+            logprobs: The number of logprobs to return. If None, no logprobs are returned. Only supported for a single prompt and completion.
             echo: Whether to echo the prompt.
             stop: A list of strings to stop generation when encountered.
             frequency_penalty: The penalty to apply to tokens based on their frequency in the prompt.
@@ -1566,6 +2295,10 @@ class Llama:
             logits_processor: A list of logits processors to use.
             grammar: A grammar to use for constrained sampling.
             logit_bias: A logit bias to use.
+            seq_id: The kv cache sequence to evaluate the prompt in.
+            n: The number of completions to return per prompt. A prompt is evaluated once and the completions are decoded together, in `seq_id` and the sequences after it.
+            best_of: The number of completions to sample, the `n` with the highest cumulative logprob are returned. Defaults to `n`, can't be streamed if larger.
+            seq_ids: The empty sequences the other completions and prompts may use besides `seq_id`. Defaults to the empty sequences after `seq_id`.
 
         Raises:
             ValueError: If the requested tokens exceed the context window.
@@ -1574,8 +2307,17 @@ class Llama:
         Returns:
             Response object containing the generated text.
         """
-        completion_or_chunks = self._create_completion(
-            prompt=prompt,
+        if isinstance(prompt, list) and len(prompt) > 0 and not isinstance(prompt[0], int):
+            prompts = prompt
+        else:
+            prompts = [prompt]
+        if len(prompts) > 1 or n != 1 or (best_of is not None and best_of != 1):
+            create = partial(
+                self._create_completions, prompts, n=n, best_of=best_of, seq_ids=seq_ids
+            )
+        else:
+            create = partial(self._create_completion, prompts[0])
+        completion_or_chunks = create(
             suffix=suffix,
             max_tokens=-1 if max_tokens is None else max_tokens,
             temperature=temperature,
@@ -1600,6 +2342,7 @@ class Llama:
             logits_processor=logits_processor,
             grammar=grammar,
             logit_bias=logit_bias,
+            seq_id=seq_id,
         )
         if stream:
             chunks: Iterator[CreateCompletionStreamResponse] = completion_or_chunks
@@ -1609,7 +2352,7 @@ class Llama:
 
     def __call__(
         self,
-        prompt: str,
+        prompt: Union[str, List[int], List[str], List[List[int]]],
         suffix: Optional[str] = None,
         max_tokens: Optional[int] = 16,
         temperature: float = 0.8,
@@ -1634,18 +2377,22 @@ class Llama:
         logits_processor: Optional[LogitsProcessorList] = None,
         grammar: Optional[LlamaGrammar] = None,
         logit_bias: Optional[Dict[str, float]] = None,
+        seq_id: Optional[int] = 0,
+        n: int = 1,
+        best_of: Optional[int] = None,
+        seq_ids: Optional[Sequence[int]] = None,
     ) -> Union[CreateCompletionResponse, Iterator[CreateCompletionStreamResponse]]:
         """Generate text from a prompt.
 
         Args:
-            prompt: The prompt to generate text from.
+            prompt: The prompt to generate text from, or a list of prompts decoded together on separate sequences. Completion `i` of prompt `k` has index `k * n + i`.
             suffix: A suffix to append to the generated text. If None, no suffix is appended.
             max_tokens: The maximum number of tokens to generate. If max_tokens <= 0 or None, the maximum number of tokens to generate is unlimited and depends on n_ctx.
             temperature: The temperature to use for sampling.
             top_p: The top-p value to use for nucleus sampling. Nucleus sampling described in academic paper "The Curious Case of Neural Text Degeneration" https://arxiv.org/abs/1904.09751
             min_p: The min-p value to use for minimum p sampling. Minimum P sampling as described in https://github.com/ggerganov/llama.cpp/pull/3841
             typical_p: The typical-p value to use for sampling. Locally Typical Sampling implementation described in the paper https://arxiv.org/abs/2202.00666.
-            logprobs: The number of logprobs to return. If None, no logprobs are returned.
+            logprobs: The number of logprobs to return. If None, no logprobs are returned. Only supported for a single prompt and completion.
             echo: Whether to echo the prompt.
             stop: A list of strings to stop generation when encountered.
             frequency_penalty: The penalty to apply to tokens based on their frequency in the prompt.
@@ -1663,6 +2410,10 @@ class Llama:
             logits_processor: A list of logits processors to use.
             grammar: A grammar to use for constrained sampling.
             logit_bias: A logit bias to use.
+            seq_id: The kv cache sequence to evaluate the prompt in.
+            n: The number of completions to return per prompt. A prompt is evaluated once and the completions are decoded together, in `seq_id` and the sequences after it.
+            best_of: The number of completions to sample, the `n` with the highest cumulative logprob are returned. Defaults to `n`, can't be streamed if larger.
+            seq_ids: The empty sequences the other completions and prompts may use besides `seq_id`. Defaults to the empty sequences after `seq_id`.
 
         Raises:
             ValueError: If the requested tokens exceed the context window.
@@ -1697,6 +2448,10 @@ class Llama:
             logits_processor=logits_processor,
             grammar=grammar,
             logit_bias=logit_bias,
+            seq_id=seq_id,
+            n=n,
+            best_of=best_of,
+            seq_ids=seq_ids,
         )
 
     def create_chat_completion(
@@ -1861,11 +2616,17 @@ class Llama:
             yarn_beta_slow=self.context_params.yarn_beta_slow,
             yarn_orig_ctx=self.context_params.yarn_orig_ctx,
             logits_all=self.context_params.logits_all,
+            logits_store=self.logits_store,
             embedding=self.context_params.embeddings,
             offload_kqv=self.context_params.offload_kqv,
             flash_attn=self.context_params.flash_attn,
             # Sampling Params
             last_n_tokens_size=self.last_n_tokens_size,
+            # Prefix Cache Params
+            prefix_cache_slots=0 if self._prefix_cache is None else len(self._prefix_cache.seq_ids),
+            prefix_cache_block_size=64 if self._prefix_cache is None else self._prefix_cache.block_size,
+            # Context Shift Params
+            context_policy=self.context_policy,
             # LoRA Params
             lora_base=self.lora_base,
             lora_scale=self.lora_scale,
@@ -1909,27 +2670,117 @@ class Llama:
                 f"Llama.save_state: saving {n_bytes} bytes of llama state",
                 file=sys.stderr,
             )
+        # Only the row sampling continues from, the history is not restored.
+        # The ring may not hold it, e.g. after switching sequences
+        try:
+            scores = self._get_logits(max(0, self.n_tokens - 1), self.n_tokens).copy()
+        except RuntimeError:
+            scores = np.zeros((0, self._n_vocab), dtype=np.single)
         return LlamaState(
-            scores=self._scores.copy(),
+            scores=scores,
             input_ids=self.input_ids.copy(),
             n_tokens=self.n_tokens,
             llama_state=bytes(llama_state_compact),
             llama_state_size=n_bytes,
+            seq_id=self._input_ids_seq_id,
         )
 
     def load_state(self, state: LlamaState) -> None:
         assert self._ctx.ctx is not None
-        # Only filling in up to `n_tokens` and then zero-ing out the rest
-        self.scores[: state.n_tokens, :] = state.scores.copy()
-        self.scores[state.n_tokens :, :] = 0.0
+        # States hold the last rows of logits, older ones the full matrix
+        self._logits_ring.clear()
+        if self._logits_history is not None:
+            self._logits_history.clear()
+        if len(state.scores) > 0:
+            self._logits_ring.write(state.n_tokens - len(state.scores), state.scores)
         self.input_ids = state.input_ids.copy()
         self.n_tokens = state.n_tokens
+        # So the next generate in that sequence reuses the restored cells
+        self._input_ids_seq_id = state.seq_id
         state_size = state.llama_state_size
         LLamaStateArrayType = ctypes.c_uint8 * state_size
         llama_state = LLamaStateArrayType.from_buffer_copy(state.llama_state)
 
         if llama_cpp.llama_set_state_data(self._ctx.ctx, llama_state) != state_size:
             raise RuntimeError("Failed to set llama state data")
+        # The restored kv cache no longer matches the parked prefixes
+        if self._prefix_cache is not None:
+            self._prefix_cache.clear()
+
+    def save_seq_state(
+        self, seq_id: int = 0, tokens: Optional[Sequence[int]] = None
+    ) -> LlamaSeqState:
+        """Snapshot the kv cache of a single sequence.
+
+        Args:
+            seq_id: The sequence to save.
+            tokens: The tokens held by the sequence, only needed if it is not the
+                sequence evaluated last.
+
+        Raises:
+            ValueError: If the tokens of the sequence are unknown.
+
+        Returns:
+            The sequence state.
+        """
+        if tokens is None:
+            if seq_id != self._input_ids_seq_id:
+                raise ValueError(f"The tokens of sequence {seq_id} are unknown")
+            input_ids = self._input_ids.copy()
+        else:
+            input_ids = np.array(tokens, dtype=np.intc)
+        n_tokens = len(input_ids)
+        last = max(0, n_tokens - 1)
+        if seq_id == self._input_ids_seq_id and self._logits_ring.has(last, n_tokens):
+            scores = self._logits_ring.get(last, n_tokens).copy()
+        else:
+            scores = np.zeros((0, self._n_vocab), dtype=np.single)
+        llama_state = self._ctx.seq_get_state(seq_id)
+        if self.verbose:
+            print(
+                f"Llama.save_seq_state: saving {len(llama_state)} bytes of sequence {seq_id}",
+                file=sys.stderr,
+            )
+        return LlamaSeqState(
+            seq_id=seq_id,
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=n_tokens,
+            llama_state=llama_state,
+            context_policy=self._seq_policy(seq_id).copy(),
+        )
+
+    def load_seq_state(self, state: LlamaSeqState, seq_id: Optional[int] = None) -> None:
+        """Restore a sequence saved with `save_seq_state`, other sequences are
+        left untouched.
+
+        The restored sequence becomes the current one, so a following
+        `generate` call on it reuses the restored tokens.
+
+        Args:
+            state: The sequence state.
+            seq_id: The sequence to restore into, defaults to the saved one.
+        """
+        seq_id = state.seq_id if seq_id is None else seq_id
+        self._ctx.seq_set_state(state.llama_state, seq_id)
+        if state.context_policy is not None:
+            self._context_policies[seq_id] = state.context_policy.copy()
+        else:
+            self._context_policies.pop(seq_id, None)
+        self._switch_seq(seq_id, state.input_ids)
+        if len(state.scores) > 0:
+            self._logits_ring.write(state.n_tokens - len(state.scores), state.scores)
+
+    def _switch_seq(self, seq_id: int, tokens: Sequence[int]) -> None:
+        """Make `seq_id`, whose kv cache holds `tokens`, the current sequence,
+        so the next `generate` call on it only evaluates what follows them."""
+        n_tokens = len(tokens)
+        self.input_ids[:n_tokens] = tokens
+        self.n_tokens = n_tokens
+        self._input_ids_seq_id = seq_id
+        self._logits_ring.clear()
+        if self._logits_history is not None:
+            self._logits_history.clear()
 
     def n_ctx(self) -> int:
         """Return the context window size."""
@@ -1963,6 +2814,120 @@ class Llama:
         """Return the pooling type."""
         return self._ctx.pooling_type()
 
+    def collect_metrics(self, writer: LlamaMetricsWriter, **labels: str):
+        """Add the metrics of the model, its caches and its kv cache to `writer`.
+
+        Args:
+            writer: The metrics writer.
+            labels: Labels of every sample, e.g. the model alias.
+        """
+        m = self.metrics
+        samples = [
+            ("llama_requests_total", "counter", "Completion requests.", m.n_requests),
+            (
+                "llama_prompt_tokens_total",
+                "counter",
+                "Prompt tokens of completion requests.",
+                m.n_prompt_tokens,
+            ),
+            (
+                "llama_completion_tokens_total",
+                "counter",
+                "Generated tokens.",
+                m.n_completion_tokens,
+            ),
+            (
+                "llama_tokens_evaluated_total",
+                "counter",
+                "Tokens decoded, without those restored from a cache.",
+                m.n_tokens_evaluated,
+            ),
+            (
+                "llama_time_to_first_token_seconds",
+                "histogram",
+                "Time from a completion request to its first token.",
+                m.time_to_first_token,
+            ),
+            (
+                "llama_prompt_tokens_per_second",
+                "histogram",
+                "Prompt evaluation speed of completion requests.",
+                m.prompt_tokens_per_second,
+            ),
+            (
+                "llama_generation_tokens_per_second",
+                "histogram",
+                "Generation speed after the first token.",
+                m.generation_tokens_per_second,
+            ),
+            (
+                "llama_embedding_requests_total",
+                "counter",
+                "Embedding requests.",
+                m.n_embedding_requests,
+            ),
+            (
+                "llama_embedding_tokens_total",
+                "counter",
+                "Tokens embedded.",
+                m.n_embedding_tokens,
+            ),
+            (
+                "llama_embedding_tokens_per_second",
+                "histogram",
+                "Embedding speed.",
+                m.embedding_tokens_per_second,
+            ),
+        ]
+        if self._ctx.ctx is not None:
+            samples.append(
+                (
+                    "llama_kv_cache_used_cells",
+                    "gauge",
+                    "KV cache cells in use.",
+                    self._ctx.kv_cache_used_cells(),
+                )
+            )
+            samples.append(
+                ("llama_kv_cache_cells", "gauge", "KV cache cells.", self._n_ctx)
+            )
+        for name, kind, help, metric in samples:
+            writer.add(name, kind, help, metric, **labels)
+
+        caches = (
+            ("state", self.cache),
+            ("prefix", self._prefix_cache),
+            ("tokenization", getattr(self.tokenizer_, "cache", None)),
+        )
+        for cache_name, cache in caches:
+            if cache is None:
+                continue
+            writer.add(
+                "llama_cache_hits_total",
+                "counter",
+                "Cache lookups that found an entry.",
+                cache.n_hits,
+                cache=cache_name,
+                **labels,
+            )
+            writer.add(
+                "llama_cache_misses_total",
+                "counter",
+                "Cache lookups that found nothing.",
+                cache.n_misses,
+                cache=cache_name,
+                **labels,
+            )
+            if hasattr(cache, "n_tokens_reused"):
+                writer.add(
+                    "llama_cache_tokens_reused_total",
+                    "counter",
+                    "Prompt tokens restored from a cache instead of evaluated.",
+                    cache.n_tokens_reused,
+                    cache=cache_name,
+                    **labels,
+                )
+
     @staticmethod
     def logits_to_logprobs(
         logits: Union[npt.NDArray[np.single], List], axis: int = -1
@@ -1981,6 +2946,36 @@ class Llama:
             out = np.log(summed)
         return subtract_maxs - out
 
+    def _top_logprobs(
+        self, logits: npt.NDArray[np.single], tokens: Sequence[int], k: int
+    ) -> Tuple[List[float], List[Dict[str, float]]]:
+        """Logprobs of `tokens` and of the `k` most likely tokens for every
+        row of `logits`, the i-th row predicting `tokens[i]`."""
+        logprobs = Llama.logits_to_logprobs(logits)
+        rows = np.arange(len(tokens))
+        token_logprobs = logprobs[rows, np.asarray(tokens, dtype=np.intc)].tolist()
+        k = min(k, logprobs.shape[1])
+        if k <= 0:
+            return token_logprobs, [{} for _ in rows]
+        if isinstance(self.tokenizer_, LlamaTokenizer):
+            pieces = self._model.pieces()
+            piece_str = lambda i: pieces[i].decode("utf-8", errors="ignore")
+        else:
+            piece_str = lambda i: self.detokenize([i]).decode("utf-8", errors="ignore")
+        thresholds = np.partition(logprobs, -k, axis=1)[:, -k]
+        top_logprobs: List[Dict[str, float]] = []
+        for row, threshold in zip(logprobs, thresholds):
+            top_ids = np.flatnonzero(row >= threshold)
+            # Descending logprob, ties by descending token id
+            top_ids = top_ids[np.lexsort((-top_ids, -row[top_ids]))[:k]]
+            top_logprobs.append(
+                {
+                    piece_str(i): logprob
+                    for i, logprob in zip(top_ids.tolist(), row[top_ids].tolist())
+                }
+            )
+        return token_logprobs, top_logprobs
+
     @staticmethod
     def longest_token_prefix(a: Sequence[int], b: Sequence[int]):
         longest_prefix = 0
@@ -2087,6 +3082,9 @@ class Llama:
 
 
 class LlamaState:
+    # States pickled before the sequence was recorded all described sequence 0
+    seq_id: Optional[int] = 0
+
     def __init__(
         self,
         input_ids: npt.NDArray[np.intc],
@@ -2094,12 +3092,36 @@ class LlamaState:
         n_tokens: int,
         llama_state: bytes,
         llama_state_size: int,
+        seq_id: Optional[int] = 0,
     ):
         self.input_ids = input_ids
         self.scores = scores
         self.n_tokens = n_tokens
         self.llama_state = llama_state
         self.llama_state_size = llama_state_size
+        # The sequence input_ids describe, None if none does
+        self.seq_id = seq_id
+
+
+class LlamaSeqState:
+    """Kv cache and tokens of a single sequence, see `Llama.save_seq_state`."""
+
+    def __init__(
+        self,
+        seq_id: int,
+        input_ids: npt.NDArray[np.intc],
+        scores: npt.NDArray[np.single],
+        n_tokens: int,
+        llama_state: bytes,
+        context_policy: Optional[BaseLlamaContextPolicy] = None,
+    ):
+        self.seq_id = seq_id
+        self.input_ids = input_ids
+        self.scores = scores
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        # The state of the sequence's context policy, e.g. its grouped positions
+        self.context_policy = context_policy
 
 
 LogitsProcessor = Callable[
@@ -1,6 +1,10 @@
-import sys
+import os
+import time
+import pickle
 from abc import ABC, abstractmethod
 from typing import (
+    Dict,
+    List,
     Optional,
     Sequence,
     Tuple,
@@ -14,11 +18,137 @@ import llama_cpp.llama
 from .llama_types import *
 
 
+class _TokenTrieNode:
+    __slots__ = ("edge", "parent", "children", "key")
+
+    def __init__(
+        self,
+        edge: Tuple[int, ...] = (),
+        parent: Optional["_TokenTrieNode"] = None,
+    ):
+        self.edge = edge
+        self.parent = parent
+        self.children: Dict[int, "_TokenTrieNode"] = {}
+        self.key: Optional[Tuple[int, ...]] = None
+
+
+class _TokenTrie:
+    """Radix tree over the token keys of a cache.
+
+    Edges hold runs of tokens, so a lookup walks at most one node per branch
+    point of the query and costs O(len(key)) token comparisons regardless of
+    the number of cached keys. The trie only indexes keys, recency is kept by
+    the owning cache which calls `remove` when it evicts an entry."""
+
+    def __init__(self):
+        self._root = _TokenTrieNode()
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    @staticmethod
+    def _match(edge: Tuple[int, ...], key: Tuple[int, ...], start: int) -> int:
+        if key[start : start + len(edge)] == edge:
+            return len(edge)
+        n = 0
+        for a, b in zip(edge, key[start:]):
+            if a != b:
+                break
+            n += 1
+        return n
+
+    def _find(self, key: Tuple[int, ...]) -> Optional[_TokenTrieNode]:
+        node, i = self._root, 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None or self._match(child.edge, key, i) != len(child.edge):
+                return None
+            node, i = child, i + len(child.edge)
+        return node
+
+    def insert(self, key: Tuple[int, ...]):
+        node, i = self._root, 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None:
+                leaf = _TokenTrieNode(key[i:], node)
+                node.children[key[i]] = leaf
+                node = leaf
+                break
+            m = self._match(child.edge, key, i)
+            if m < len(child.edge):
+                # Split the edge at the first mismatching token
+                mid = _TokenTrieNode(child.edge[:m], node)
+                node.children[key[i]] = mid
+                child.edge = child.edge[m:]
+                child.parent = mid
+                mid.children[child.edge[0]] = child
+                child = mid
+            node, i = child, i + m
+        if node.key is None:
+            self._len += 1
+        node.key = key
+
+    def remove(self, key: Tuple[int, ...]):
+        node = self._find(key)
+        if node is None or node.key is None:
+            raise KeyError(key)
+        node.key = None
+        self._len -= 1
+        # Drop empty leaves and merge pass-through nodes so every non-root
+        # node either holds a key or is a branch point.
+        while node is not self._root and node.key is None and len(node.children) <= 1:
+            parent = node.parent
+            assert parent is not None
+            if len(node.children) == 0:
+                del parent.children[node.edge[0]]
+            else:
+                (child,) = node.children.values()
+                child.edge = node.edge + child.edge
+                child.parent = parent
+                parent.children[child.edge[0]] = child
+            node = parent
+
+    def longest_prefix(self, key: Sequence[int]) -> Optional[Tuple[int, ...]]:
+        """Return a stored key sharing the longest common prefix with `key`,
+        or None if no stored key shares its first token."""
+        key = tuple(key)
+        node, i = self._root, 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None:
+                break
+            m = self._match(child.edge, key, i)
+            node, i = child, i + m
+            if m < len(child.edge):
+                break
+        if node is self._root:
+            return None
+        # Every key below `node` shares the same prefix with `key`
+        while node.key is None:
+            node = next(iter(node.children.values()))
+        return node.key
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
 class BaseLlamaCache(ABC):
     """Base cache class for a llama.cpp model."""
 
     def __init__(self, capacity_bytes: int = (2 << 30)):
         self.capacity_bytes = capacity_bytes
+        # Lookups, and the prompt tokens shared with the states they returned
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_tokens_reused = 0
 
     @property
     @abstractmethod
@@ -44,40 +174,91 @@ class BaseLlamaCache(ABC):
         raise NotImplementedError
 
 
+class LlamaCacheAdmissionPolicy(ABC):
+    """Decides whether a new state may enter a `LlamaRAMCache`."""
+
+    @abstractmethod
+    def admit(self, cache: "LlamaRAMCache", key: Tuple[int, ...], size: int) -> bool:
+        raise NotImplementedError
+
+
+class LlamaCacheMaxSizeAdmission(LlamaCacheAdmissionPolicy):
+    """Reject states larger than `max_fraction` of the cache capacity."""
+
+    def __init__(self, max_fraction: float = 0.5):
+        self.max_fraction = max_fraction
+
+    def admit(self, cache: "LlamaRAMCache", key: Tuple[int, ...], size: int) -> bool:
+        return size <= self.max_fraction * cache.capacity_bytes
+
+
+class LlamaCacheSizeAwareLRUAdmission(LlamaCacheAdmissionPolicy):
+    """Reject states that would push more than `max_evictions` least recently
+    used entries out of the cache, so a single long context can't flush many
+    short prefixes."""
+
+    def __init__(self, max_evictions: int = 1):
+        self.max_evictions = max_evictions
+
+    def admit(self, cache: "LlamaRAMCache", key: Tuple[int, ...], size: int) -> bool:
+        free = cache.capacity_bytes - cache.cache_size
+        if key in cache.cache_state:
+            free += cache.cache_state[key].llama_state_size
+        n_evictions = 0
+        for k, state in cache.cache_state.items():
+            if free >= size:
+                break
+            if k == key:
+                continue
+            if n_evictions == self.max_evictions:
+                return False
+            free += state.llama_state_size
+            n_evictions += 1
+        return free >= size
+
+
 class LlamaRAMCache(BaseLlamaCache):
-    """Cache for a llama.cpp model using RAM."""
+    """Cache for a llama.cpp model using RAM.
 
-    def __init__(self, capacity_bytes: int = (2 << 30)):
+    Args:
+        capacity_bytes: Maximum total size of the cached llama states.
+        admission_policy: Optional policy deciding whether a new state is
+            cached at all. By default every state is admitted and the least
+            recently used entries are evicted to make room for it.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int = (2 << 30),
+        admission_policy: Optional[LlamaCacheAdmissionPolicy] = None,
+    ):
         super().__init__(capacity_bytes)
         self.capacity_bytes = capacity_bytes
+        self.admission_policy = admission_policy
         self.cache_state: OrderedDict[Tuple[int, ...], "llama_cpp.llama.LlamaState"] = OrderedDict()
+        self._index = _TokenTrie()
+        self._cache_size = 0
 
     @property
     def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+        return self._cache_size
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, llama_cpp.llama.Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
+        return self._index.longest_prefix(key)
 
     def __getitem__(self, key: Sequence[int]) -> "llama_cpp.llama.LlamaState":
         key = tuple(key)
         _key = self._find_longest_prefix_key(key)
         if _key is None:
+            self.n_misses += 1
             raise KeyError("Key not found")
         value = self.cache_state[_key]
         self.cache_state.move_to_end(_key)
+        self.n_hits += 1
+        self.n_tokens_reused += _common_prefix_length(_key, key)
         return value
 
     def __contains__(self, key: Sequence[int]) -> bool:
@@ -85,11 +266,26 @@ class LlamaRAMCache(BaseLlamaCache):
 
     def __setitem__(self, key: Sequence[int], value: "llama_cpp.llama.LlamaState"):
         key = tuple(key)
+        if self.admission_policy is not None and not self.admission_policy.admit(
+            self, key, value.llama_state_size
+        ):
+            return
         if key in self.cache_state:
-            del self.cache_state[key]
+            self._cache_size -= self.cache_state.pop(key).llama_state_size
+        else:
+            self._index.insert(key)
         self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes and len(self.cache_state) > 0:
-            self.cache_state.popitem(last=False)
+        self._cache_size += value.llama_state_size
+        while self._cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            evicted_key, evicted = self.cache_state.popitem(last=False)
+            self._index.remove(evicted_key)
+            self._cache_size -= evicted.llama_state_size
+
+    def __delitem__(self, key: Sequence[int]):
+        key = tuple(key)
+        state = self.cache_state.pop(key)
+        self._index.remove(key)
+        self._cache_size -= state.llama_state_size
 
 
 # Alias for backwards compatibility
@@ -97,54 +293,172 @@ LlamaCache = LlamaRAMCache
 
 
 class LlamaDiskCache(BaseLlamaCache):
-    """Cache for a llama.cpp model using disk."""
+    """Cache for a llama.cpp model using disk.
+
+    States are stored in a `diskcache.Cache`. The cached keys, together with
+    their size, recency and hit count, are kept in an index file in the same
+    directory, so lookups go through an in-memory `_TokenTrie` instead of
+    unpickling every key, and warm prefixes survive a restart.
+
+    Recency and hit counts change on every lookup, they are only written with
+    the next change to the stored states, at most every `flush_interval`
+    seconds on lookups, and by `close`. States missing from the index, e.g.
+    after a crash before it was written, are indexed again on load so they
+    can still be evicted.
+
+    Args:
+        cache_dir: Directory of the cache.
+        capacity_bytes: Maximum total size of the cached llama states.
+        eviction_policy: "least-recently-used" or "least-frequently-used".
+        flush_interval: Seconds between writes of the index caused by lookups.
+    """
+
+    _index_filename = "prefix_index.pkl"
 
     def __init__(
-        self, cache_dir: str = ".cache/llama_cache", capacity_bytes: int = (2 << 30)
+        self,
+        cache_dir: str = ".cache/llama_cache",
+        capacity_bytes: int = (2 << 30),
+        eviction_policy: str = "least-recently-used",
+        flush_interval: float = 30.0,
     ):
         super().__init__(capacity_bytes)
-        self.cache = diskcache.Cache(cache_dir)
+        if eviction_policy not in ("least-recently-used", "least-frequently-used"):
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
+        self.eviction_policy = eviction_policy
+        # Eviction is done here so the index always matches the stored keys
+        self.cache = diskcache.Cache(cache_dir, eviction_policy="none")
+        self._index_path = os.path.join(cache_dir, self._index_filename)
+        # key -> [llama_state_size, hits], ordered from least to most recently used
+        self._entries: OrderedDict[Tuple[int, ...], List[int]] = OrderedDict()
+        self._index = _TokenTrie()
+        self._cache_size = 0
+        self.flush_interval = flush_interval
+        # Whether the index file is behind the recency and hit counts
+        self._index_dirty = False
+        self._index_saved_at = time.monotonic()
+        self._load_index()
 
     @property
     def cache_size(self):
-        return int(self.cache.volume())  # type: ignore
+        return self._cache_size
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, "rb") as f:
+                entries = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # Missing or unreadable index, rebuild it from the stored states
+            entries = []
+        # Index the states the index doesn't know about as least recently used,
+        # they would never be evicted otherwise
+        indexed = set(k for k, _, _ in entries)
+        for k in list(self.cache.iterkeys()):  # type: ignore
+            if k in indexed:
+                continue
+            state = self.cache.get(k)
+            if state is None:
+                continue
+            if not isinstance(k, tuple) or not hasattr(state, "llama_state_size"):
+                self.cache.delete(k)
+                continue
+            self._add_entry(k, state.llama_state_size)
+        for k, size, hits in entries:
+            if k in self.cache:
+                self._add_entry(k, size, hits)
+        while self._cache_size > self.capacity_bytes and len(self._entries) > 0:
+            self._remove_entry(self._eviction_candidate())
+        self._save_index()
+
+    def _save_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                [(k, size, hits) for k, (size, hits) in self._entries.items()], f
+            )
+        os.replace(tmp_path, self._index_path)
+        self._index_dirty = False
+        self._index_saved_at = time.monotonic()
+
+    def flush(self):
+        """Write the recency and hit counts of lookups to the index."""
+        if self._index_dirty:
+            self._save_index()
+
+    def close(self):
+        """Flush the index and close the underlying `diskcache.Cache`."""
+        self.flush()
+        self.cache.close()
+
+    def _add_entry(self, key: Tuple[int, ...], size: int, hits: int = 0):
+        self._entries[key] = [size, hits]
+        self._index.insert(key)
+        self._cache_size += size
+
+    def _remove_entry(self, key: Tuple[int, ...]):
+        size, _ = self._entries.pop(key)
+        self._index.remove(key)
+        self._cache_size -= size
+        self.cache.delete(key)
+
+    def _eviction_candidate(
+        self, new_key: Optional[Tuple[int, ...]] = None
+    ) -> Tuple[int, ...]:
+        if self.eviction_policy == "least-frequently-used" and len(self._entries) > 1:
+            # A fresh entry has no hits yet, never pick it over an older one.
+            # min keeps the first of equal hit counts, i.e. the least recently used
+            return min(
+                (item for item in self._entries.items() if item[0] != new_key),
+                key=lambda item: item[1][1],
+            )[0]
+        return next(iter(self._entries))
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key: Optional[Tuple[int, ...]] = None
-        for k in self.cache.iterkeys():  # type: ignore
-            prefix_len = llama_cpp.llama.Llama.longest_token_prefix(k, key)
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k  # type: ignore
-        return min_key
+        return self._index.longest_prefix(key)
 
     def __getitem__(self, key: Sequence[int]) -> "llama_cpp.llama.LlamaState":
         key = tuple(key)
         _key = self._find_longest_prefix_key(key)
         if _key is None:
+            self.n_misses += 1
             raise KeyError("Key not found")
-        value: "llama_cpp.llama.LlamaState" = self.cache.pop(_key)  # type: ignore
-        # NOTE: This puts an integer as key in cache, which breaks,
-        # Llama.longest_token_prefix(k, key) above since k is not a tuple of ints/tokens
-        # self.cache.push(_key, side="front")  # type: ignore
+        value: Optional["llama_cpp.llama.LlamaState"] = self.cache.get(_key)  # type: ignore
+        if value is None:
+            # Removed from the directory behind our back
+            self._remove_entry(_key)
+            self._save_index()
+            self.n_misses += 1
+            raise KeyError("Key not found")
+        self.n_hits += 1
+        self.n_tokens_reused += _common_prefix_length(_key, key)
+        self._entries[_key][1] += 1
+        self._entries.move_to_end(_key)
+        self._index_dirty = True
+        if time.monotonic() - self._index_saved_at >= self.flush_interval:
+            self._save_index()
         return value
 
     def __contains__(self, key: Sequence[int]) -> bool:
         return self._find_longest_prefix_key(tuple(key)) is not None
 
     def __setitem__(self, key: Sequence[int], value: "llama_cpp.llama.LlamaState"):
-        print("LlamaDiskCache.__setitem__: called", file=sys.stderr)
         key = tuple(key)
-        if key in self.cache:
-            print("LlamaDiskCache.__setitem__: delete", file=sys.stderr)
-            del self.cache[key]
+        hits = 0
+        if key in self._entries:
+            hits = self._entries[key][1]
+            self._remove_entry(key)
         self.cache[key] = value
-        print("LlamaDiskCache.__setitem__: set", file=sys.stderr)
-        while self.cache_size > self.capacity_bytes and len(self.cache) > 0:
-            key_to_remove = next(iter(self.cache))
-            del self.cache[key_to_remove]
-        print("LlamaDiskCache.__setitem__: trim", file=sys.stderr)
+        self._add_entry(key, value.llama_state_size, hits)
+        while self._cache_size > self.capacity_bytes and len(self._entries) > 0:
+            self._remove_entry(self._eviction_candidate(key))
+        self._save_index()
+
+    def __delitem__(self, key: Sequence[int]):
+        key = tuple(key)
+        if key not in self._entries:
+            raise KeyError(key)
+        self._remove_entry(key)
+        self._save_index()
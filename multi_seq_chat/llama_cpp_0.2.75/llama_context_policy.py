@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import copy
+
+from abc import ABC, abstractmethod
+from typing import (
+    Optional,
+    Tuple,
+)
+
+import llama_cpp.llama_cpp as llama_cpp
+
+
+class BaseLlamaContextPolicy(ABC):
+    """How a sequence makes room for new tokens once it fills the context.
+
+    A policy object holds the state of a single sequence and only touches the
+    kv cache of that sequence, so other sequences sharing the context are
+    left as they are. Tokens are counted from the start of the sequence; the
+    token at index `i` sits at kv position `pos(i)`.
+    """
+
+    def start(self, n_prompt: int):
+        """Called when the sequence starts over with a prompt of `n_prompt` tokens."""
+        pass
+
+    def pos(self, n_tokens: int) -> int:
+        """The kv position of the token at index `n_tokens`."""
+        return n_tokens
+
+    @property
+    def linear(self) -> bool:
+        """Whether every token sits at the kv position equal to its index."""
+        return True
+
+    def can_truncate(self, n_tokens: int) -> bool:
+        """Whether the sequence can be cut back to its first `n_tokens` tokens."""
+        return True
+
+    def before_decode(self, ctx: llama_cpp.llama_context_p, seq_id: int, n_tokens: int):
+        """Called before every batch of the sequence is decoded."""
+        pass
+
+    @abstractmethod
+    def make_room(
+        self,
+        ctx: llama_cpp.llama_context_p,
+        seq_id: int,
+        n_tokens: int,
+        n_new: int,
+        n_ctx: int,
+    ) -> Tuple[int, int]:
+        """Free the kv cache of `seq_id` so `n_new` tokens fit after its
+        `n_tokens` tokens.
+
+        Returns:
+            The (start, end) range of tokens dropped, the tokens after it
+            moved down by end - start.
+        """
+        raise NotImplementedError
+
+    def copy(self) -> BaseLlamaContextPolicy:
+        """A policy with the same options and state, for another sequence."""
+        return copy.deepcopy(self)
+
+    @staticmethod
+    def _drop(
+        ctx: llama_cpp.llama_context_p, seq_id: int, start: int, end: int
+    ) -> Tuple[int, int]:
+        llama_cpp.llama_kv_cache_seq_rm(ctx, seq_id, start, end)
+        llama_cpp.llama_kv_cache_seq_add(ctx, seq_id, end, -1, start - end)
+        return start, end
+
+
+class LlamaShiftPolicy(BaseLlamaContextPolicy):
+    """Keeps the first `n_keep` tokens and drops the older half of the rest,
+    as llama.cpp's main example does.
+
+    Args:
+        n_keep: Number of tokens to keep, None to keep the first prompt.
+    """
+
+    def __init__(self, n_keep: Optional[int] = None):
+        self.n_keep = n_keep
+        self._n_keep = n_keep or 0
+
+    def start(self, n_prompt: int):
+        self._n_keep = n_prompt if self.n_keep is None else self.n_keep
+
+    def make_room(self, ctx, seq_id, n_tokens, n_new, n_ctx):
+        n_keep = min(self._n_keep, n_tokens)
+        n_left = n_tokens - n_keep
+        n_needed = n_tokens + n_new - n_ctx + 1
+        n_discard = min(n_left, max(n_left // 2, n_needed))
+        return self._drop(ctx, seq_id, n_keep, n_keep + n_discard)
+
+
+class LlamaAttentionSinkPolicy(BaseLlamaContextPolicy):
+    """Streams past the end of the context by keeping the first `n_sink`
+    tokens, which collect much of the attention, and a sliding window of the
+    most recent ones (StreamingLLM).
+
+    Args:
+        n_sink: Number of leading tokens that are never dropped.
+        n_discard: Minimum number of tokens dropped at once, so the window
+            isn't shifted for every new token. Defaults to 1/8 of the window.
+    """
+
+    def __init__(self, n_sink: int = 4, n_discard: Optional[int] = None):
+        if n_sink < 0:
+            raise ValueError("n_sink must be non-negative")
+        self.n_sink = n_sink
+        self.n_discard = n_discard
+
+    def make_room(self, ctx, seq_id, n_tokens, n_new, n_ctx):
+        n_sink = min(self.n_sink, n_tokens)
+        n_window = n_tokens - n_sink
+        n_discard = (
+            self.n_discard if self.n_discard is not None else max(1, (n_ctx - n_sink) // 8)
+        )
+        n_drop = min(n_window, max(n_tokens + n_new - n_ctx + 1, n_discard))
+        return self._drop(ctx, seq_id, n_sink, n_sink + n_drop)
+
+
+class LlamaSelfExtendPolicy(BaseLlamaContextPolicy):
+    """Grouped-attention self-extend (LongLM): as the sequence grows, every
+    window of `ga_w` positions past the start is divided by `ga_n`, so the
+    positions stay within the trained context while no token is dropped.
+    The context still has to have a cell for every token.
+
+    Args:
+        ga_n: Group-attention factor.
+        ga_w: Group-attention width, a multiple of `ga_n`.
+    """
+
+    def __init__(self, ga_n: int = 4, ga_w: int = 512):
+        if ga_n <= 0 or ga_w <= 0 or ga_w % ga_n != 0:
+            raise ValueError("ga_w must be a positive multiple of ga_n")
+        self.ga_n = ga_n
+        self.ga_w = ga_w
+        # Start of the next window in kv positions, and how many positions
+        # the tokens after it have been moved down by
+        self._ga_i = 0
+        self._n_shift = 0
+
+    def start(self, n_prompt: int):
+        self._ga_i = 0
+        self._n_shift = 0
+
+    def pos(self, n_tokens: int) -> int:
+        return n_tokens - self._n_shift
+
+    @property
+    def linear(self) -> bool:
+        return self._n_shift == 0
+
+    def can_truncate(self, n_tokens: int) -> bool:
+        # Only tokens past the grouped windows have a position of their own
+        return n_tokens >= self._ga_i + self._n_shift
+
+    def before_decode(self, ctx, seq_id, n_tokens):
+        ga_n, ga_w = self.ga_n, self.ga_w
+        n_past = self.pos(n_tokens)
+        while n_past >= self._ga_i + ga_w:
+            ib = (ga_n * self._ga_i) // ga_w
+            bd = (ga_w // ga_n) * (ga_n - 1)
+            dd = (ga_w // ga_n) - ib * bd - ga_w
+            llama_cpp.llama_kv_cache_seq_add(ctx, seq_id, self._ga_i, n_past, ib * bd)
+            llama_cpp.llama_kv_cache_seq_div(
+                ctx, seq_id, self._ga_i + ib * bd, self._ga_i + ib * bd + ga_w, ga_n
+            )
+            llama_cpp.llama_kv_cache_seq_add(
+                ctx, seq_id, self._ga_i + ib * bd + ga_w, n_past + ib * bd, dd
+            )
+            n_past -= bd
+            self._n_shift += bd
+            self._ga_i += ga_w // ga_n
+
+    def make_room(self, ctx, seq_id, n_tokens, n_new, n_ctx):
+        raise ValueError(
+            f"Requested tokens ({n_tokens + n_new}) exceed context window of {n_ctx}, "
+            "self-extend only compresses positions, every token still needs a kv cell"
+        )
@@ -0,0 +1,368 @@
+from __future__ import annotations
+
+import os
+import pickle
+
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import llama_cpp
+from llama_cpp.llama_types import (
+    CreateCompletionResponse,
+    CreateCompletionStreamResponse,
+)
+from .llama_kv_slots import LlamaKVSlots
+
+
+class LlamaBranch:
+    """A conversation branch: its tokens, the end offset of every round in
+    them and where its kv cache currently is.
+
+    Args:
+        branch_id: Logical id of the branch.
+        seq_id: The kv cache sequence holding the branch, None while it has no slot.
+        tokens: The evaluated tokens.
+        round_ends: End offset in `tokens` of every round.
+    """
+
+    def __init__(
+        self,
+        branch_id: int,
+        seq_id: Optional[int] = None,
+        tokens: Optional[Sequence[int]] = None,
+        round_ends: Optional[Sequence[int]] = None,
+    ):
+        self.branch_id = branch_id
+        self.seq_id = seq_id
+        self.tokens: List[int] = list(tokens) if tokens is not None else []
+        self.round_ends: List[int] = list(round_ends) if round_ends is not None else []
+        # Number of leading tokens held by the kv cache of `seq_id`, the rest
+        # is evaluated again by the next round
+        self.n_cached = 0
+        # File holding the kv cache of an evicted branch
+        self.spill_path: Optional[str] = None
+        # Snapshot of the kv cache, only set on branches returned by
+        # `LlamaConversationTree.save_state`
+        self.state: Optional[llama_cpp.LlamaSeqState] = None
+
+    @property
+    def n_rounds(self) -> int:
+        return len(self.round_ends)
+
+    @property
+    def n_tokens(self) -> int:
+        return len(self.tokens)
+
+    def spans(self) -> List[Tuple[int, int]]:
+        """The (start, end) token span of every round."""
+        starts = [0] + self.round_ends[:-1]
+        return list(zip(starts, self.round_ends))
+
+
+class LlamaConversationTree:
+    """Conversation branches sharing their history in the kv cache.
+
+    Every branch lives in its own kv cache sequence. Forking a branch at a
+    round copies the parent's cells up to the end of that round into the
+    child's sequence with `kv_cache_seq_cp`, which only tags the existing
+    cells with the child's id, so the shared history is neither copied nor
+    evaluated again. A round then only evaluates its new turn.
+
+    Branch ids are logical, the sequences are handed out by a `LlamaKVSlots`
+    pool of `n_slots` sequences. When the pool or the kv cache runs out, the
+    least recently used branches are evicted: their kv cache is spilled to
+    `spill_dir` and loaded back when they are used again, or, without a
+    `spill_dir`, dropped and evaluated again from their tokens.
+
+    Example:
+        >>> tree = LlamaConversationTree(llama)
+        >>> tree.add(0)
+        >>> tree.create_completion(0, "<user>Hi</user>")
+        >>> tree.create_completion(0, "<user>Tell me a joke</user>")
+        >>> tree.fork(0, 1, n_rounds=1)
+        >>> tree.create_completion(1, "<user>Tell me a poem</user>")
+
+    Args:
+        llama: The model.
+        n_slots: Number of kv cache sequences used for branches, the sequences
+            of the prefix cache are skipped.
+        spill_dir: Directory for the kv cache of evicted branches, None to drop it.
+        defrag_threshold: Fragmentation of the kv cache above which it is
+            defragmented after evictions, negative to never defragment.
+    """
+
+    def __init__(
+        self,
+        llama: llama_cpp.Llama,
+        n_slots: int = 8,
+        spill_dir: Optional[str] = None,
+        defrag_threshold: float = 0.1,
+    ):
+        self._llama = llama
+        self.branches: Dict[int, LlamaBranch] = {}
+        reserved = (
+            set(llama._prefix_cache.seq_ids) if llama._prefix_cache is not None else set()
+        )
+        seq_ids = [
+            seq_id for seq_id in range(n_slots + len(reserved)) if seq_id not in reserved
+        ]
+        self.slots = LlamaKVSlots(
+            llama._ctx,
+            seq_ids[:n_slots],
+            on_evict=self._spill,
+            defrag_threshold=defrag_threshold,
+        )
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __contains__(self, branch_id: int) -> bool:
+        return branch_id in self.branches
+
+    def __getitem__(self, branch_id: int) -> LlamaBranch:
+        return self.branches[branch_id]
+
+    def __len__(self) -> int:
+        return len(self.branches)
+
+    def add(self, branch_id: int) -> LlamaBranch:
+        """Start an empty branch.
+
+        Args:
+            branch_id: Id of the new branch.
+
+        Raises:
+            ValueError: If the branch already exists.
+            RuntimeError: If no slot can be freed.
+        """
+        if branch_id in self.branches:
+            raise ValueError(f"Branch {branch_id} already exists")
+        branch = LlamaBranch(branch_id)
+        self._attach(branch)
+        self.branches[branch_id] = branch
+        return branch
+
+    def fork(
+        self,
+        parent_id: int,
+        child_id: int,
+        n_rounds: Optional[int] = None,
+    ) -> LlamaBranch:
+        """Start a branch sharing the first rounds of another one.
+
+        Args:
+            parent_id: The branch to fork.
+            child_id: Id of the new branch.
+            n_rounds: Number of rounds of the parent to share, defaults to all of them.
+
+        Raises:
+            KeyError: If the parent branch doesn't exist.
+            ValueError: If the child branch already exists or the parent has fewer rounds.
+        """
+        parent = self.branches[parent_id]
+        if n_rounds is None:
+            n_rounds = parent.n_rounds
+        if n_rounds > parent.n_rounds:
+            raise ValueError(
+                f"Branch {parent_id} has {parent.n_rounds} rounds, can't share {n_rounds}"
+            )
+        if child_id in self.branches:
+            raise ValueError(f"Branch {child_id} already exists")
+        end = parent.round_ends[n_rounds - 1] if n_rounds > 0 else 0
+        self._attach(parent)
+        child = LlamaBranch(
+            child_id, tokens=parent.tokens[:end], round_ends=parent.round_ends[:n_rounds]
+        )
+        self._attach(child, pinned=(parent_id,))
+        assert parent.seq_id is not None and child.seq_id is not None
+        n_copied = min(end, parent.n_cached)
+        policy = self._llama._seq_policy(parent.seq_id)
+        # Grouped positions can't be split, the child evaluates its history again
+        if not policy.can_truncate(n_copied):
+            n_copied = 0
+        if n_copied > 0:
+            self._llama._ctx.kv_cache_seq_cp(
+                parent.seq_id, child.seq_id, 0, policy.pos(n_copied)
+            )
+            self._llama._context_policies[child.seq_id] = policy.copy()
+        child.n_cached = n_copied
+        self.slots.set_cells(child_id, n_copied)
+        self.branches[child_id] = child
+        return child
+
+    def remove(self, branch_id: int):
+        """Drop a branch and free its cells not shared with other branches."""
+        branch = self.branches.pop(branch_id)
+        if branch.seq_id is not None:
+            self._forget_seq(branch.seq_id)
+            self.slots.release(branch_id)
+        if branch.spill_path is not None:
+            os.remove(branch.spill_path)
+
+    def prompt_tokens(self, branch_id: int, turn: Union[str, List[int]]) -> List[int]:
+        """The tokens of the branch followed by those of a new turn."""
+        branch = self.branches[branch_id]
+        if isinstance(turn, str):
+            turn = self._llama.tokenize(
+                turn.encode("utf-8"), add_bos=branch.n_tokens == 0, special=True
+            )
+        return branch.tokens + list(turn)
+
+    def create_completion(
+        self,
+        branch_id: int,
+        turn: Union[str, List[int]],
+        stream: bool = False,
+        **kwargs: Any,
+    ) -> Union[CreateCompletionResponse, Iterator[CreateCompletionStreamResponse]]:
+        """Add a round to a branch, only `turn` and the reply are evaluated.
+
+        Args:
+            branch_id: The branch to continue.
+            turn: The new turn, appended to the branch's tokens without a bos.
+            stream: Whether to stream the results.
+            kwargs: Passed to `Llama.create_completion`, except n, best_of
+                and seq_ids.
+
+        Returns:
+            The completion, or its chunks when streaming.
+        """
+        # The other completions would need sequences of their own, which the
+        # slots hand out to branches
+        if (
+            kwargs.get("n", 1) != 1
+            or kwargs.get("best_of") not in (None, 1)
+            or "seq_ids" in kwargs
+        ):
+            raise ValueError("A round has a single completion, n, best_of and seq_ids are not supported")
+        if not isinstance(turn, str) and any(not isinstance(t, int) for t in turn):
+            raise ValueError("A round takes a single turn, not a list of prompts")
+        branch = self.branches[branch_id]
+        prompt = self.prompt_tokens(branch_id, turn)
+        self._attach(branch)
+        assert branch.seq_id is not None
+        # Make room for the prompt and the reply
+        max_tokens = kwargs.get("max_tokens", 16)
+        n_cells = len(prompt) - branch.n_cached + (max_tokens if max_tokens and max_tokens > 0 else 0)
+        self.slots.reserve(n_cells, pinned=(branch_id,))
+        # The cache of a branch evaluated after another one is still there
+        if self._llama._input_ids_seq_id != branch.seq_id:
+            self._llama._switch_seq(branch.seq_id, branch.tokens[: branch.n_cached])
+        if stream:
+            return self._stream(branch, prompt, **kwargs)
+        try:
+            return self._llama.create_completion(
+                prompt=prompt, seq_id=branch.seq_id, **kwargs
+            )
+        finally:
+            self._end_round(branch)
+
+    def _stream(
+        self, branch: LlamaBranch, prompt: List[int], **kwargs: Any
+    ) -> Iterator[CreateCompletionStreamResponse]:
+        try:
+            yield from self._llama.create_completion(
+                prompt=prompt, seq_id=branch.seq_id, stream=True, **kwargs
+            )
+        finally:
+            self._end_round(branch)
+
+    def _end_round(self, branch: LlamaBranch):
+        llama = self._llama
+        if branch.seq_id is None or llama._input_ids_seq_id != branch.seq_id:
+            return
+        tokens = llama.input_ids[: llama.n_tokens].tolist()
+        # A context shift may have dropped part of the earlier rounds
+        n_kept = 0
+        for a, b in zip(branch.tokens, tokens):
+            if a != b:
+                break
+            n_kept += 1
+        branch.round_ends = [min(end, n_kept) for end in branch.round_ends]
+        branch.round_ends.append(len(tokens))
+        branch.tokens = tokens
+        branch.n_cached = len(tokens)
+        self.slots.set_cells(branch.branch_id, len(tokens))
+
+    def _attach(self, branch: LlamaBranch, pinned: Sequence[int] = ()):
+        """Give a branch a slot, loading back its spilled kv cache."""
+        if branch.seq_id is not None:
+            self.slots.touch(branch.branch_id)
+            return
+        seq_id = self.slots.acquire(branch.branch_id, pinned=pinned)
+        # Free slots may still hold cells of requests made outside the tree
+        self._llama._ctx.kv_cache_seq_rm(seq_id, 0, -1)
+        self._llama._context_policies.pop(seq_id, None)
+        self._forget_seq(seq_id)
+        branch.seq_id = seq_id
+        branch.n_cached = 0
+        if branch.spill_path is not None:
+            with open(branch.spill_path, "rb") as f:
+                state: llama_cpp.LlamaSeqState = pickle.load(f)
+            os.remove(branch.spill_path)
+            branch.spill_path = None
+            self._llama.load_seq_state(state, seq_id)
+            branch.n_cached = state.n_tokens
+            self.slots.set_cells(branch.branch_id, state.n_tokens)
+
+    def _spill(self, branch_id: int, seq_id: int):
+        """Called by the slots before the cells of an evicted branch are removed."""
+        branch = self.branches[branch_id]
+        if self.spill_dir is not None and branch.n_cached > 0:
+            state = self._llama.save_seq_state(
+                seq_id, tokens=branch.tokens[: branch.n_cached]
+            )
+            path = os.path.join(self.spill_dir, f"branch_{branch_id}.state")
+            with open(path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            branch.spill_path = path
+        self._forget_seq(seq_id)
+        branch.seq_id = None
+        branch.n_cached = 0
+
+    def _forget_seq(self, seq_id: int):
+        # The tokens of the current sequence are no longer in its cache
+        if self._llama._input_ids_seq_id == seq_id:
+            self._llama._input_ids_seq_id = None
+            self._llama.n_tokens = 0
+
+    def save_state(self, branch_id: int) -> LlamaBranch:
+        """Snapshot a branch and its kv cache, see `Llama.save_seq_state`."""
+        branch = self.branches[branch_id]
+        self._attach(branch)
+        assert branch.seq_id is not None
+        saved = LlamaBranch(branch.branch_id, None, branch.tokens, branch.round_ends)
+        saved.state = self._llama.save_seq_state(
+            branch.seq_id, tokens=branch.tokens[: branch.n_cached]
+        )
+        return saved
+
+    def load_state(self, saved: LlamaBranch, branch_id: Optional[int] = None) -> LlamaBranch:
+        """Restore a branch returned by `save_state`, replacing the branch with
+        the same id.
+
+        Args:
+            saved: The saved branch.
+            branch_id: Id of the restored branch, defaults to the saved one.
+        """
+        if saved.state is None:
+            raise ValueError("The branch has no saved state")
+        branch_id = saved.branch_id if branch_id is None else branch_id
+        if branch_id in self.branches:
+            self.remove(branch_id)
+        branch = LlamaBranch(branch_id, None, saved.tokens, saved.round_ends)
+        self._attach(branch)
+        assert branch.seq_id is not None
+        self._llama.load_seq_state(saved.state, branch.seq_id)
+        branch.n_cached = saved.state.n_tokens
+        self.slots.set_cells(branch_id, branch.n_cached)
+        self.branches[branch_id] = branch
+        return branch
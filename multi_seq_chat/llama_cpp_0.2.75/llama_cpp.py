@@ -1808,6 +1808,20 @@ def llama_kv_cache_seq_div(
     ...
 
 
+# // Returns the largest position present in the KV cache for the specified sequence
+# LLAMA_API llama_pos llama_kv_cache_seq_pos_max(
+#         struct llama_context * ctx,
+#                 llama_seq_id   seq_id);
+@ctypes_function(
+    "llama_kv_cache_seq_pos_max", [llama_context_p_ctypes, llama_seq_id], llama_pos
+)
+def llama_kv_cache_seq_pos_max(
+    ctx: llama_context_p, seq_id: Union[llama_seq_id, int], /
+) -> int:
+    """Returns the largest position present in the KV cache for the specified sequence"""
+    ...
+
+
 # // Defragment the KV cache
 # // This will be applied:
 # //   - lazily on next llama_decode()
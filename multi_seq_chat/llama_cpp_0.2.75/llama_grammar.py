@@ -103,6 +103,16 @@ class LlamaGrammar:
             f"{cls.from_file.__name__}: error parsing grammar file: params_grammer is empty"
         )
 
+    def copy(self) -> "LlamaGrammar":
+        """A grammar with the same rules and a state of its own, for
+        constraining another sequence."""
+        grammar = self.__class__.__new__(self.__class__)
+        grammar._grammar_rules = self._grammar_rules
+        grammar._n_rules = self._n_rules
+        grammar._start_rule_index = self._start_rule_index
+        grammar.init()
+        return grammar
+
     def init(self) -> None:
         # Step 1: Convert LlamaGrammarElement to llama_grammar_element
         self._element_lists = [
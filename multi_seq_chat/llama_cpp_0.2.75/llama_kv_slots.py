@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+from collections import OrderedDict
+
+from ._internals import _LlamaContext  # type: ignore
+
+
+class LlamaKVSlots:
+    """Hands out the kv cache sequences of a context to logical branches.
+
+    A context only has so many sequences and cells, while a chat can grow any
+    number of branches. Branches get a sequence (slot) when they are used and
+    keep it until it is needed by another one: when no slot is free, or the
+    cache is too full for the next evaluation, the least recently used
+    branches are evicted. `on_evict` is called before the cells of an evicted
+    branch are removed, so its owner can spill them to disk.
+
+    Removing sequences leaves holes in the kv cache, so a defragmentation is
+    scheduled whenever the fragmentation exceeds `defrag_threshold`.
+
+    Args:
+        ctx: The llama context owning the kv cache.
+        seq_ids: The sequence ids of the slots, without those reserved
+            elsewhere, e.g. for the prefix cache.
+        on_evict: Called with the branch id and sequence id of an evicted branch.
+        defrag_threshold: Fragmentation above which the kv cache is
+            defragmented, negative to never defragment.
+    """
+
+    def __init__(
+        self,
+        ctx: _LlamaContext,
+        seq_ids: Sequence[int],
+        on_evict: Optional[Callable[[int, int], None]] = None,
+        defrag_threshold: float = 0.1,
+    ):
+        if len(seq_ids) == 0:
+            raise ValueError("At least one slot is needed")
+        self._ctx = ctx
+        self.seq_ids = list(seq_ids)
+        self.on_evict = on_evict
+        self.defrag_threshold = defrag_threshold
+        # Lowest sequence ids are handed out first
+        self._free: List[int] = sorted(self.seq_ids, reverse=True)
+        # branch id -> seq id, ordered from least to most recently used
+        self._slots: OrderedDict[int, int] = OrderedDict()
+        # seq id -> number of cells held
+        self._n_cells: Dict[int, int] = {}
+
+        self.n_evictions = 0
+        self.n_defrags = 0
+
+    def __contains__(self, branch_id: int) -> bool:
+        return branch_id in self._slots
+
+    def __len__(self) -> int:
+        """Number of slots in use."""
+        return len(self._slots)
+
+    @property
+    def n_free(self) -> int:
+        return len(self._free)
+
+    @property
+    def n_cells(self) -> int:
+        """Number of cells held by the slots, shared cells counted once per slot."""
+        return sum(self._n_cells.values())
+
+    def get(self, branch_id: int) -> Optional[int]:
+        """The sequence id of a branch, None if it has no slot."""
+        return self._slots.get(branch_id)
+
+    def cells(self, branch_id: int) -> int:
+        """Number of cells held by the slot of a branch."""
+        seq_id = self._slots.get(branch_id)
+        return 0 if seq_id is None else self._n_cells[seq_id]
+
+    def set_cells(self, branch_id: int, n_cells: int):
+        self._n_cells[self._slots[branch_id]] = n_cells
+
+    def touch(self, branch_id: int):
+        """Mark a branch as most recently used."""
+        self._slots.move_to_end(branch_id)
+
+    def acquire(self, branch_id: int, pinned: Collection[int] = ()) -> int:
+        """Return the sequence id of a branch, giving it a slot if it has none.
+
+        Args:
+            branch_id: The branch.
+            pinned: Branches that must not be evicted to make room.
+
+        Raises:
+            RuntimeError: If all slots are held by pinned branches.
+        """
+        seq_id = self._slots.get(branch_id)
+        if seq_id is not None:
+            self._slots.move_to_end(branch_id)
+            return seq_id
+        if len(self._free) == 0:
+            victim = self._coldest(pinned)
+            if victim is None:
+                raise RuntimeError(
+                    f"All {len(self.seq_ids)} kv cache slots are in use"
+                )
+            self.evict(victim)
+        seq_id = self._free.pop()
+        self._slots[branch_id] = seq_id
+        self._n_cells[seq_id] = 0
+        return seq_id
+
+    def reserve(self, n_cells: int, pinned: Collection[int] = ()) -> bool:
+        """Evict branches until `n_cells` more cells fit in the kv cache.
+
+        Evicting a branch only frees the cells it doesn't share, so this may
+        evict more than strictly needed.
+
+        Returns:
+            Whether the cells fit.
+        """
+        n_ctx = self._ctx.n_ctx()
+        while self._ctx.kv_cache_used_cells() + n_cells > n_ctx:
+            victim = self._coldest(pinned)
+            if victim is None:
+                return False
+            self.evict(victim)
+        return True
+
+    def evict(self, branch_id: int):
+        """Free the slot of a branch, after handing it to `on_evict`."""
+        seq_id = self._slots[branch_id]
+        if self.on_evict is not None:
+            self.on_evict(branch_id, seq_id)
+        self.n_evictions += 1
+        self.release(branch_id)
+
+    def release(self, branch_id: int):
+        """Free the slot of a branch and remove its cells."""
+        seq_id = self._slots.pop(branch_id)
+        del self._n_cells[seq_id]
+        self._ctx.kv_cache_seq_rm(seq_id, 0, -1)
+        self._free.append(seq_id)
+        self.maybe_defrag()
+
+    def maybe_defrag(self) -> bool:
+        """Schedule a defragmentation if the kv cache is fragmented enough."""
+        if self.defrag_threshold < 0:
+            return False
+        if self._ctx.kv_cache_fragmentation() <= self.defrag_threshold:
+            return False
+        self._ctx.kv_cache_defrag()
+        self.n_defrags += 1
+        return True
+
+    def _coldest(self, pinned: Collection[int]) -> Optional[int]:
+        for branch_id in self._slots:
+            if branch_id not in pinned:
+                return branch_id
+        return None
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import tempfile
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+import numpy.typing as npt
+
+
+class BaseLlamaLogitsStore(ABC):
+    """Storage for the logits rows produced by `Llama.eval`, indexed by token
+    position."""
+
+    def __init__(self, n_vocab: int):
+        self.n_vocab = n_vocab
+
+    @abstractmethod
+    def write(self, pos: int, logits: npt.NDArray[np.single]):
+        """Store the rows of `logits` for the positions starting at `pos`."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def has(self, start: int, end: int) -> bool:
+        """Whether the rows of positions [start, end) are all stored."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, start: int, end: int) -> npt.NDArray[np.single]:
+        """Return the rows of positions [start, end), a view where possible.
+
+        Raises:
+            KeyError: If one of the rows is not stored.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def invalidate(self, start: int, end: int):
+        """Forget the rows of positions [start, end)."""
+        raise NotImplementedError
+
+    def clear(self):
+        self.invalidate(0, np.iinfo(np.int32).max)
+
+
+class LlamaLogitsRing(BaseLlamaLogitsStore):
+    """Keeps the rows of the last `n_rows` written positions, which is all
+    sampling ever reads."""
+
+    def __init__(self, n_vocab: int, n_rows: int = 1):
+        super().__init__(n_vocab)
+        if n_rows <= 0:
+            raise ValueError("n_rows must be positive")
+        self.n_rows = n_rows
+        self._rows: npt.NDArray[np.single] = np.zeros(
+            (n_rows, n_vocab), dtype=np.single
+        )
+        self._pos: npt.NDArray[np.intc] = np.full((n_rows,), -1, dtype=np.intc)
+
+    def write(self, pos: int, logits: npt.NDArray[np.single]):
+        n = logits.shape[0]
+        if n > self.n_rows:
+            pos, logits, n = pos + n - self.n_rows, logits[n - self.n_rows :], self.n_rows
+        positions = np.arange(pos, pos + n, dtype=np.intc)
+        slots = positions % self.n_rows
+        self._rows[slots] = logits
+        self._pos[slots] = positions
+
+    def has(self, start: int, end: int) -> bool:
+        if end - start > self.n_rows or start < 0:
+            return False
+        positions = np.arange(start, end, dtype=np.intc)
+        return bool(np.all(self._pos[positions % self.n_rows] == positions))
+
+    def get(self, start: int, end: int) -> npt.NDArray[np.single]:
+        if not self.has(start, end):
+            raise KeyError((start, end))
+        if end - start == 1:
+            slot = start % self.n_rows
+            return self._rows[slot : slot + 1]
+        return self._rows[np.arange(start, end) % self.n_rows]
+
+    def invalidate(self, start: int, end: int):
+        self._pos[(self._pos >= start) & (self._pos < end)] = -1
+
+
+class LlamaLogitsHistory(BaseLlamaLogitsStore):
+    """Keeps a row for every position of the context, as needed by logprobs
+    and echo.
+
+    Args:
+        n_ctx: Number of positions.
+        n_vocab: Row width.
+        mmap: Back the rows with an anonymous temporary file instead of RAM.
+    """
+
+    def __init__(self, n_ctx: int, n_vocab: int, mmap: bool = False):
+        super().__init__(n_vocab)
+        self.n_ctx = n_ctx
+        if mmap:
+            self._file = tempfile.TemporaryFile()
+            self._rows: npt.NDArray[np.single] = np.memmap(
+                self._file, dtype=np.single, mode="w+", shape=(n_ctx, n_vocab)
+            )
+        else:
+            self._file = None
+            # Pages are only committed once written
+            self._rows = np.empty((n_ctx, n_vocab), dtype=np.single)
+        self._valid: npt.NDArray[np.bool_] = np.zeros((n_ctx,), dtype=np.bool_)
+
+    def write(self, pos: int, logits: npt.NDArray[np.single]):
+        self._rows[pos : pos + logits.shape[0]] = logits
+        self._valid[pos : pos + logits.shape[0]] = True
+
+    def has(self, start: int, end: int) -> bool:
+        return 0 <= start and end <= self.n_ctx and bool(np.all(self._valid[start:end]))
+
+    def get(self, start: int, end: int) -> npt.NDArray[np.single]:
+        if not self.has(start, end):
+            raise KeyError((start, end))
+        return self._rows[start:end]
+
+    def invalidate(self, start: int, end: int):
+        self._valid[max(start, 0) : end] = False
+
+    def n_valid_prefix(self) -> int:
+        """Number of leading positions whose rows are all stored."""
+        invalid = np.flatnonzero(~self._valid)
+        return int(invalid[0]) if len(invalid) > 0 else self.n_ctx
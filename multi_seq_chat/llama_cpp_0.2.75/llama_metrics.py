@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import math
+
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import (
+    Dict,
+    List,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+# Seconds, from a fast prompt cache hit to a long prompt on a slow machine
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Tokens per second
+THROUGHPUT_BUCKETS = (1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0, 5000.0)
+
+
+class LlamaCounter:
+    """A monotonically increasing count.
+
+    Like the other metrics it takes no lock: every metric is updated by the
+    thread that holds the model (or the scheduler lock), and a scrape reading
+    a value mid-update is harmless."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value: float = 0
+
+    def inc(self, n: float = 1):
+        self.value += n
+
+
+class LlamaHistogram:
+    """Counts of observations per bucket, with their sum.
+
+    Args:
+        buckets: Upper bounds of the buckets, in increasing order. A last
+            bucket without an upper bound is added.
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Not cumulative, the last one counts observations above all bounds
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class LlamaMetrics:
+    """Counters and histograms of a `Llama`."""
+
+    def __init__(self):
+        self.n_requests = LlamaCounter()
+        self.n_prompt_tokens = LlamaCounter()
+        self.n_completion_tokens = LlamaCounter()
+        # Every token decoded, prompt tokens found in a cache aren't
+        self.n_tokens_evaluated = LlamaCounter()
+        self.time_to_first_token = LlamaHistogram(LATENCY_BUCKETS)
+        self.prompt_tokens_per_second = LlamaHistogram(THROUGHPUT_BUCKETS)
+        self.generation_tokens_per_second = LlamaHistogram(THROUGHPUT_BUCKETS)
+        self.n_embedding_requests = LlamaCounter()
+        self.n_embedding_tokens = LlamaCounter()
+        self.embedding_tokens_per_second = LlamaHistogram(THROUGHPUT_BUCKETS)
+
+
+Metric = Union[float, LlamaCounter, LlamaHistogram]
+
+
+class LlamaMetricsWriter:
+    """Collects metrics from many sources and renders them in the Prometheus
+    text exposition format.
+
+    Metrics of the same name (e.g. of several models, told apart by labels)
+    are written as one family.
+    """
+
+    def __init__(self):
+        # name -> (type, help, [(labels, metric)])
+        self._families: OrderedDict[
+            str, Tuple[str, str, List[Tuple[Dict[str, str], Metric]]]
+        ] = OrderedDict()
+
+    def add(
+        self, name: str, kind: str, help: str, metric: Metric, **labels: str
+    ):
+        """Add a sample.
+
+        Args:
+            name: Metric name, counters should end in `_total`.
+            kind: "counter", "gauge" or "histogram".
+            help: Description of the metric.
+            metric: The value, a counter or a histogram.
+            labels: Labels of the sample.
+        """
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help, [])
+        family[2].append((labels, metric))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, (kind, help, samples) in self._families.items():
+            lines.append(f"# HELP {name} {_escape_help(help)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in samples:
+                if isinstance(metric, LlamaHistogram):
+                    n = 0
+                    for bound, count in zip(metric.buckets, metric.counts):
+                        n += count
+                        lines.append(
+                            f"{name}_bucket{_labels(labels, le=_number(bound))} {n}"
+                        )
+                    lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {metric.count}')
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(metric.sum)}")
+                    lines.append(f"{name}_count{_labels(labels)} {metric.count}")
+                else:
+                    value = metric.value if isinstance(metric, LlamaCounter) else metric
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _number(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, str], **extra: str) -> str:
+    items = {**labels, **extra}
+    if len(items) == 0:
+        return ""
+    escaped = (
+        str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        for v in items.values()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(items, escaped)) + "}"
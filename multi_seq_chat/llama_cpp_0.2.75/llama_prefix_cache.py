@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from collections import OrderedDict
+
+from ._internals import _LlamaContext  # type: ignore
+
+
+class _PrefixSlot:
+    __slots__ = ("seq_id", "tokens", "hashes")
+
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        self.tokens: Tuple[int, ...] = ()
+        self.hashes: List[int] = []
+
+
+class LlamaPrefixCache:
+    """Paged prefix cache kept resident in the kv cache.
+
+    Prompts are split into blocks of `block_size` tokens and every block is
+    identified by a hash chained over all blocks before it, so equal hashes
+    mean equal prefixes. Evaluated prefixes are parked in spare sequences of
+    the kv cache (`seq_ids`) with `kv_cache_seq_cp`, which only tags the
+    existing cells with the extra sequence id. A new request is attached to
+    the longest matching block chain by copying the parked cells into its own
+    sequence, again without touching the kv data itself.
+
+    Slots are recycled in least recently used order.
+
+    Args:
+        ctx: The llama context owning the kv cache.
+        seq_ids: Sequence ids reserved for parked prefixes, one per slot.
+        block_size: Number of tokens per block.
+    """
+
+    def __init__(
+        self,
+        ctx: _LlamaContext,
+        seq_ids: Sequence[int],
+        block_size: int = 64,
+    ):
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+        self._ctx = ctx
+        self.block_size = block_size
+        # Ordered from least to most recently used
+        self._slots: OrderedDict[int, _PrefixSlot] = OrderedDict(
+            (seq_id, _PrefixSlot(seq_id)) for seq_id in seq_ids
+        )
+        # block hash -> seq_id of a slot holding that block chain
+        self._blocks: Dict[int, int] = {}
+
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_tokens_reused = 0
+
+    def __len__(self) -> int:
+        """Number of slots holding a prefix."""
+        return sum(1 for slot in self._slots.values() if len(slot.hashes) > 0)
+
+    @property
+    def seq_ids(self) -> List[int]:
+        return list(self._slots.keys())
+
+    def _block_hashes(self, tokens: Sequence[int]) -> List[int]:
+        hashes: List[int] = []
+        h = 0
+        for i in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(tokens[i : i + self.block_size])))
+            hashes.append(h)
+        return hashes
+
+    def match(self, tokens: Sequence[int]) -> Tuple[Optional[int], int]:
+        """Find the longest parked block chain that prefixes `tokens`.
+
+        Returns:
+            The seq_id of the slot holding it and the number of matching
+            tokens, or (None, 0) if not even the first block is parked.
+        """
+        seq_id: Optional[int] = None
+        n_blocks = 0
+        for i, h in enumerate(self._block_hashes(tokens)):
+            if h not in self._blocks:
+                break
+            seq_id, n_blocks = self._blocks[h], i + 1
+        if seq_id is None:
+            return None, 0
+        n = n_blocks * self.block_size
+        # Guard against hash collisions
+        if self._slots[seq_id].tokens[:n] != tuple(tokens[:n]):
+            return None, 0
+        return seq_id, n
+
+    def attach(
+        self,
+        tokens: Sequence[int],
+        seq_id: int,
+        max_tokens: Optional[int] = None,
+        min_tokens: int = 0,
+    ) -> int:
+        """Replace the kv cache of `seq_id` with the longest parked prefix of
+        `tokens`.
+
+        Args:
+            tokens: The prompt tokens.
+            seq_id: The sequence to attach the prefix to.
+            max_tokens: Attach at most this many tokens.
+            min_tokens: Only attach prefixes longer than this, e.g. the prefix
+                `seq_id` already holds.
+
+        Returns:
+            The number of tokens now present in the kv cache of `seq_id`. The
+            kv cache of `seq_id` is left untouched if this is 0.
+        """
+        slot_seq_id, n = self.match(tokens)
+        if max_tokens is not None:
+            n = min(n, max_tokens)
+        if slot_seq_id is None or n <= 0:
+            self.n_misses += 1
+            return 0
+        # The cells may be gone if the kv cache was cleared behind our back
+        slot = self._slots[slot_seq_id]
+        if self._ctx.kv_cache_seq_pos_max(slot_seq_id) < len(slot.tokens) - 1:
+            self._release(slot)
+            self.n_misses += 1
+            return 0
+        if n <= min_tokens:
+            return 0
+        self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        self._ctx.kv_cache_seq_cp(slot_seq_id, seq_id, 0, n)
+        self._slots.move_to_end(slot_seq_id)
+        self.n_hits += 1
+        self.n_tokens_reused += n
+        return n
+
+    def store(self, tokens: Sequence[int], seq_id: int):
+        """Park the full blocks of `tokens`, which must be the first tokens
+        in the kv cache of `seq_id`."""
+        hashes = self._block_hashes(tokens)
+        if len(hashes) == 0 or len(self._slots) == 0:
+            return
+        if hashes[-1] in self._blocks:
+            self._slots.move_to_end(self._blocks[hashes[-1]])
+            return
+        # Extend a slot whose chain is a prefix of this one, else recycle the
+        # least recently used slot
+        slot = next(iter(self._slots.values()))
+        for i in range(len(hashes) - 2, -1, -1):
+            if hashes[i] in self._blocks:
+                candidate = self._slots[self._blocks[hashes[i]]]
+                if len(candidate.hashes) == i + 1:
+                    slot = candidate
+                break
+        self._release(slot)
+        n = len(hashes) * self.block_size
+        self._ctx.kv_cache_seq_cp(seq_id, slot.seq_id, 0, n)
+        slot.tokens = tuple(tokens[:n])
+        slot.hashes = hashes
+        for h in hashes:
+            self._blocks[h] = slot.seq_id
+        self._slots.move_to_end(slot.seq_id)
+
+    def _release(self, slot: _PrefixSlot):
+        if len(slot.hashes) == 0:
+            return
+        self._ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+        hashes, slot.hashes, slot.tokens = slot.hashes, [], ()
+        for h in hashes:
+            if self._blocks.get(h) != slot.seq_id:
+                continue
+            # Hand the block over to another slot holding the same chain
+            for other in self._slots.values():
+                if h in other.hashes:
+                    self._blocks[h] = other.seq_id
+                    break
+            else:
+                del self._blocks[h]
+
+    def clear(self):
+        """Drop all parked prefixes and free their kv cache cells."""
+        for slot in self._slots.values():
+            self._release(slot)
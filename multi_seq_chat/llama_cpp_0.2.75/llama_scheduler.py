@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import ctypes
+
+from typing import (
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from collections import OrderedDict
+
+import numpy as np
+import numpy.typing as npt
+
+import llama_cpp.llama
+import llama_cpp.llama_cpp as llama_cpp
+
+from .llama_grammar import LlamaGrammar
+from ._internals import (
+    _LlamaContext,  # type: ignore
+    _LlamaSamplingParams,  # type: ignore
+    _LlamaSamplingContext,  # type: ignore
+)
+
+
+class LlamaSequence:
+    """Decoding state of a single sequence driven by a `LlamaScheduler`.
+
+    The tokens of a sequence are split in two parts: `tokens[:n_past]` are
+    already stored in the kv cache under `seq_id`, `tokens[n_past:]` are
+    pending and will be evaluated by the next scheduler steps. A sequence
+    with `max_tokens=0` only evaluates its tokens, e.g. to prefill a prompt
+    that is then copied to other sequences."""
+
+    def __init__(
+        self,
+        seq_id: int,
+        tokens: Sequence[int],
+        *,
+        n_past: int = 0,
+        max_tokens: Optional[int] = None,
+        sampling_params: Optional[_LlamaSamplingParams] = None,
+        grammar: Optional[LlamaGrammar] = None,
+        logits_processor: Optional["llama_cpp.llama.LogitsProcessorList"] = None,
+        stopping_criteria: Optional["llama_cpp.llama.StoppingCriteriaList"] = None,
+        track_logprob: bool = False,
+    ):
+        assert len(tokens) > n_past, "a sequence needs at least one token to evaluate"
+        self.seq_id = seq_id
+        self.tokens: List[int] = list(tokens)
+        self.n_past = n_past
+        self.n_prompt_tokens = len(self.tokens)
+        self.max_tokens = max_tokens
+        self.logits_processor = logits_processor
+        self.stopping_criteria = stopping_criteria
+
+        params = sampling_params or _LlamaSamplingParams()
+        self.sampling_context = _LlamaSamplingContext(
+            params=params,
+            mirostat_mu=ctypes.c_float(2.0 * params.mirostat_tau),
+            grammar=grammar,
+        )
+        if grammar is not None:
+            grammar.reset()
+        assert self.sampling_context.prev is not None
+        self.sampling_context.prev.extend(self.tokens)
+
+        self.finish_reason: Optional[str] = None
+        # Sum of the logprobs of the sampled tokens, e.g. to rank completions
+        self.track_logprob = track_logprob
+        self.cumulative_logprob = 0.0
+        self._last_logits: Optional[npt.NDArray[np.single]] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def pending_tokens(self) -> List[int]:
+        return self.tokens[self.n_past :]
+
+    @property
+    def completion_tokens(self) -> List[int]:
+        return self.tokens[self.n_prompt_tokens :]
+
+    def sample(self, ctx: _LlamaContext, idx: int) -> int:
+        """Sample the next token from row `idx` of the last decoded batch."""
+        logits_array = ctx.get_logits_ith_view(idx).copy()
+        if self.logits_processor is not None:
+            input_ids = np.array(self.tokens, dtype=np.intc)
+            logits_array[:] = self.logits_processor(input_ids, logits_array)
+        token = self.sampling_context.sample(ctx_main=ctx, logits_array=logits_array)
+        self.sampling_context.accept(
+            ctx_main=ctx,
+            id=token,
+            apply_grammar=self.sampling_context.grammar is not None,
+        )
+        self._last_logits = logits_array
+        if self.track_logprob:
+            max_logit = logits_array.max()
+            self.cumulative_logprob += float(
+                logits_array[token]
+                - max_logit
+                - np.log(np.exp(logits_array - max_logit).sum())
+            )
+        return token
+
+    def accept(self, token: int, is_eog: bool, n_ctx: int):
+        """Append a sampled token and update the finish reason."""
+        if is_eog:
+            self.finish_reason = "stop"
+            return
+        self.tokens.append(token)
+        if self.stopping_criteria is not None and self.stopping_criteria(
+            np.array(self.tokens, dtype=np.intc), self._last_logits
+        ):
+            self.finish_reason = "stop"
+        elif (
+            self.max_tokens is not None
+            and len(self.completion_tokens) >= self.max_tokens
+        ) or len(self.tokens) >= n_ctx:
+            self.finish_reason = "length"
+
+
+class LlamaScheduler:
+    """Continuous batching over the sequences of a single llama context.
+
+    Every call to `step` packs the pending tokens of all active sequences
+    into one `_LlamaBatch` and runs a single `llama_decode`. Sequences that
+    are generating contribute one token each and are scheduled first, prompt
+    ingestion fills up the remaining `n_batch` budget in chunks. After the
+    decode every sequence whose pending tokens were fully evaluated samples
+    its next token from its own logits row.
+
+    Sequences can be added or removed between steps, which lets a new
+    request join the batch while others are still generating.
+
+    All sequences share the cells of one kv cache. A sequence only joins the
+    batch once the cells it may still fill, up to `max_tokens` or the end of
+    the context, fit next to the used cells and those the running sequences
+    may still fill; until then it waits, in the order it was added. Parked
+    prefixes are dropped before making a sequence wait, and with nothing
+    running the first waiting sequence always joins."""
+
+    def __init__(self, llama: "llama_cpp.llama.Llama"):
+        self._llama = llama
+        self._sequences: "OrderedDict[int, LlamaSequence]" = OrderedDict()
+        # Sequences waiting for kv cache cells, in the order they were added
+        self._waiting: "OrderedDict[int, LlamaSequence]" = OrderedDict()
+        self.n_tokens_evaluated = 0
+
+    def __len__(self) -> int:
+        return len(self._sequences) + len(self._waiting)
+
+    def __contains__(self, seq_id: int) -> bool:
+        return seq_id in self._sequences or seq_id in self._waiting
+
+    def __getitem__(self, seq_id: int) -> LlamaSequence:
+        if seq_id in self._waiting:
+            return self._waiting[seq_id]
+        return self._sequences[seq_id]
+
+    @property
+    def sequences(self) -> List[LlamaSequence]:
+        return list(self._sequences.values()) + list(self._waiting.values())
+
+    @property
+    def n_waiting(self) -> int:
+        """Number of sequences waiting for kv cache cells."""
+        return len(self._waiting)
+
+    def add(self, sequence: LlamaSequence) -> LlamaSequence:
+        """Add a sequence to the batch, or to the waiting sequences if the kv
+        cache may run out of cells for it.
+
+        Any kv cache entries of `sequence.seq_id` at or beyond
+        `sequence.n_past` are dropped so the pending tokens can be written."""
+        if sequence.seq_id in self:
+            raise ValueError(f"Sequence {sequence.seq_id} is already scheduled")
+        if len(sequence.tokens) >= self._llama._n_ctx:
+            raise ValueError(
+                f"Requested tokens ({len(sequence.tokens)}) exceed context window of {self._llama._n_ctx}"
+            )
+        self._llama._ctx.kv_cache_seq_rm(sequence.seq_id, sequence.n_past, -1)
+        self._waiting[sequence.seq_id] = sequence
+        self._admit()
+        return sequence
+
+    def remove(self, seq_id: int, clear_kv_cache: bool = False) -> LlamaSequence:
+        """Stop scheduling a sequence, optionally freeing its kv cache cells."""
+        if seq_id in self._waiting:
+            sequence = self._waiting.pop(seq_id)
+        else:
+            sequence = self._sequences.pop(seq_id)
+        if clear_kv_cache:
+            self._llama._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+        return sequence
+
+    def _n_cells_left(self, sequence: LlamaSequence) -> int:
+        # The last sampled token is never evaluated
+        n_ctx = self._llama._n_ctx
+        if sequence.max_tokens == 0:
+            n_end = len(sequence.tokens)
+        elif sequence.max_tokens is None:
+            n_end = n_ctx - 1
+        else:
+            n_end = min(sequence.n_prompt_tokens + sequence.max_tokens, n_ctx) - 1
+        return max(n_end, len(sequence.tokens)) - sequence.n_past
+
+    def _fits(self, sequence: LlamaSequence) -> bool:
+        n_cells = (
+            self._llama._ctx.kv_cache_used_cells()
+            + sum(self._n_cells_left(s) for s in self._sequences.values())
+            + self._n_cells_left(sequence)
+        )
+        return n_cells <= self._llama._n_ctx
+
+    def _admit(self):
+        # Move the waiting sequences that fit to the batch, in order
+        while len(self._waiting) > 0:
+            sequence = next(iter(self._waiting.values()))
+            if len(self._sequences) > 0 and not self._fits(sequence):
+                prefix_cache = self._llama._prefix_cache
+                if prefix_cache is None or len(prefix_cache) == 0:
+                    break
+                # Parked prefixes may be holding the cells it needs
+                prefix_cache.clear()
+                continue
+            del self._waiting[sequence.seq_id]
+            self._sequences[sequence.seq_id] = sequence
+
+    def step(self) -> List[Tuple[LlamaSequence, int]]:
+        """Decode one batch and sample one token for every sequence that is
+        ready.
+
+        Returns:
+            A list of (sequence, token) pairs sampled during this step. Finished
+            sequences are removed from the scheduler but keep their kv cache,
+            including those with `max_tokens=0` that were fully evaluated
+            without sampling. Waiting sequences join once there are cells for
+            them.
+        """
+        llama = self._llama
+        batch = llama._batch
+        batch.reset()
+        self._admit()
+
+        budget = llama.n_batch
+        scheduled: List[Tuple[LlamaSequence, int]] = []
+        sample_rows: List[Tuple[LlamaSequence, int]] = []
+        prefilled: List[LlamaSequence] = []
+
+        # Generating sequences first so prompt ingestion can't starve them
+        active = sorted(
+            self._sequences.values(), key=lambda s: len(s.tokens) - s.n_past
+        )
+        for sequence in active:
+            if budget <= 0:
+                break
+            pending = sequence.pending_tokens
+            n_eval = min(len(pending), budget)
+            complete = n_eval == len(pending)
+            sample = complete and sequence.max_tokens != 0
+            batch.add_sequence(
+                pending[:n_eval],
+                seq_id=sequence.seq_id,
+                logits_all=False,
+                n_past=sequence.n_past,
+                logits_last=sample,
+            )
+            scheduled.append((sequence, n_eval))
+            if sample:
+                sample_rows.append((sequence, batch.n_tokens() - 1))
+            elif complete:
+                prefilled.append(sequence)
+            budget -= n_eval
+
+        if len(scheduled) == 0:
+            return []
+
+        llama._ctx.decode(batch)
+        self.n_tokens_evaluated += batch.n_tokens()
+
+        for sequence, n_eval in scheduled:
+            sequence.n_past += n_eval
+        for sequence in prefilled:
+            sequence.finish_reason = "length"
+            del self._sequences[sequence.seq_id]
+
+        results: List[Tuple[LlamaSequence, int]] = []
+        for sequence, idx in sample_rows:
+            token = sequence.sample(llama._ctx, idx)
+            sequence.accept(
+                token,
+                is_eog=llama_cpp.llama_token_is_eog(llama._model.model, token),
+                n_ctx=llama._n_ctx,
+            )
+            results.append((sequence, token))
+            if sequence.finished:
+                del self._sequences[sequence.seq_id]
+        return results
+
+    def __iter__(self) -> Iterator[Tuple[LlamaSequence, int]]:
+        """Run steps until every scheduled sequence has finished."""
+        while len(self) > 0:
+            yield from self.step()
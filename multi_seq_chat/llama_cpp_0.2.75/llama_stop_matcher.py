@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from collections import deque
+
+
+class StopMatcher:
+    """Streaming multi-pattern matcher (Aho-Corasick).
+
+    Patterns are sequences of ints, e.g. the bytes of stop strings or the
+    tokens of an antiprompt. The automaton state is kept between calls to
+    `feed`, so every symbol of the stream is looked at once no matter how many
+    patterns there are or how long the stream gets.
+
+    Args:
+        patterns: The patterns to look for, empty patterns are ignored.
+    """
+
+    def __init__(self, patterns: Sequence[Sequence[int]]):
+        self.patterns = [tuple(p) for p in patterns]
+        self._goto: List[Dict[int, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._depth: List[int] = [0]
+        # Longest pattern ending at a state, through the failure links
+        self._out: List[int] = [0]
+        for pattern in self.patterns:
+            state = 0
+            for symbol in pattern:
+                next_state = self._goto[state].get(symbol)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][symbol] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._out.append(0)
+                state = next_state
+            self._out[state] = len(pattern)
+
+        queue = deque(self._goto[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for symbol, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail != 0 and symbol not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(symbol, 0)
+                self._out[next_state] = max(
+                    self._out[next_state], self._out[self._fail[next_state]]
+                )
+                queue.append(next_state)
+
+        self._state = 0
+        self.position = 0
+
+    def reset(self):
+        self._state = 0
+        self.position = 0
+
+    @property
+    def partial(self) -> int:
+        """Length of the longest tail of the stream that is a prefix of a
+        pattern, i.e. how much should be held back from the client."""
+        return self._depth[self._state]
+
+    @property
+    def at_match(self) -> bool:
+        """Whether a pattern ends at the last consumed symbol."""
+        return self._out[self._state] > 0
+
+    def step(self, symbol: int) -> int:
+        """Consume one symbol and return the length of the longest pattern
+        ending at it, 0 if none does."""
+        state = self._state
+        while state != 0 and symbol not in self._goto[state]:
+            state = self._fail[state]
+        self._state = self._goto[state].get(symbol, 0)
+        self.position += 1
+        return self._out[self._state]
+
+    def feed(self, symbols: Iterable[int]) -> Optional[Tuple[int, int]]:
+        """Consume `symbols`.
+
+        Returns:
+            The (start, end) stream offsets of the match starting first among
+            the matches ending within `symbols`, or None.
+        """
+        match: Optional[Tuple[int, int]] = None
+        for symbol in symbols:
+            n = self.step(symbol)
+            if n > 0 and (match is None or self.position - n < match[0]):
+                match = (self.position - n, self.position)
+        return match
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
 import abc
+import codecs
 from typing import (
     List,
     Optional,
+    Sequence,
+    Tuple,
     Any,
 )
+from collections import OrderedDict
 
 import llama_cpp
 from llama_cpp.llama_types import List
@@ -35,15 +39,125 @@ class BaseLlamaTokenizer(abc.ABC):
             prev_tokens: If tokens is a continuation of a previous sequence, the previous tokens."""
         raise NotImplementedError
 
+    def tokenize_batch(
+        self, texts: Sequence[bytes], add_bos: bool = True, special: bool = True
+    ) -> List[List[int]]:
+        """Tokenize several texts with the same options."""
+        return [self.tokenize(text, add_bos=add_bos, special=special) for text in texts]
+
+
+class LlamaTokenizationCache:
+    """Bounded LRU cache of tokenizations keyed by (text, add_bos, special).
+
+    Args:
+        capacity: Maximum number of cached texts.
+    """
+
+    def __init__(self, capacity: int = 128):
+        self.capacity = capacity
+        self._entries: OrderedDict[Tuple[bytes, bool, bool], Tuple[int, ...]] = (
+            OrderedDict()
+        )
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, text: bytes, add_bos: bool, special: bool) -> Optional[List[int]]:
+        key = (text, add_bos, special)
+        tokens = self._entries.get(key)
+        if tokens is None:
+            self.n_misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.n_hits += 1
+        return list(tokens)
+
+    def put(self, text: bytes, add_bos: bool, special: bool, tokens: Sequence[int]):
+        if self.capacity <= 0:
+            return
+        key = (text, add_bos, special)
+        self._entries[key] = tuple(tokens)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def longest_prefix(
+        self, text: bytes, add_bos: bool, special: bool
+    ) -> Optional[Tuple[bytes, Tuple[int, ...]]]:
+        """Return the longest cached text that is a proper prefix of `text`,
+        with its tokens."""
+        best: Optional[Tuple[bytes, Tuple[int, ...]]] = None
+        for (cached_text, cached_add_bos, cached_special), tokens in self._entries.items():
+            if (
+                cached_add_bos == add_bos
+                and cached_special == special
+                and len(cached_text) < len(text)
+                and (best is None or len(cached_text) > len(best[0]))
+                and text.startswith(cached_text)
+            ):
+                best = (cached_text, tokens)
+        return best
+
+    def clear(self):
+        self._entries.clear()
+
 
 class LlamaTokenizer(BaseLlamaTokenizer):
-    def __init__(self, llama: llama_cpp.Llama):
+    """Tokenizer of the llama.cpp model.
+
+    Tokenizations are cached, and a text that extends a cached one, like a
+    chat prompt with a new message appended, only has its new suffix
+    tokenized when that suffix starts with a special token.
+
+    Args:
+        llama: The model.
+        cache_size: Number of cached tokenizations, 0 disables the cache.
+    """
+
+    def __init__(self, llama: llama_cpp.Llama, cache_size: int = 128):
         self._model = llama._model  # type: ignore
+        self.cache = LlamaTokenizationCache(cache_size)
+        self.n_incremental = 0
 
     def tokenize(
         self, text: bytes, add_bos: bool = True, special: bool = True
     ) -> List[int]:
-        return self._model.tokenize(text, add_bos=add_bos, special=special)
+        if self.cache.capacity <= 0:
+            return self._model.tokenize(text, add_bos=add_bos, special=special)
+        tokens = self.cache.get(text, add_bos, special)
+        if tokens is not None:
+            return tokens
+        if special:
+            tokens = self._tokenize_incremental(text, add_bos)
+        if tokens is None:
+            tokens = self._model.tokenize(text, add_bos=add_bos, special=special)
+        self.cache.put(text, add_bos, special, tokens)
+        return tokens
+
+    def _tokenize_incremental(self, text: bytes, add_bos: bool) -> Optional[List[int]]:
+        prefix = self.cache.longest_prefix(text, add_bos, True)
+        # A trailing eos would end up in the middle
+        if prefix is None or llama_cpp.llama_add_eos_token(self._model.model) == 1:
+            return None
+        prefix_text, prefix_tokens = prefix
+        suffix = text[len(prefix_text) :]
+        suffix_tokens = self._model.tokenize(suffix, add_bos=False, special=True)
+        if len(suffix_tokens) == 0:
+            return None
+        # llama.cpp splits the text at special tokens and tokenizes the pieces
+        # in between on their own, so a split right before one is exact
+        first = suffix_tokens[0]
+        piece = self._model.pieces(special=True)[first]
+        if (
+            len(piece) == 0
+            or self._model.pieces(special=False)[first] != b""
+            or not suffix.startswith(piece)
+        ):
+            return None
+        self.n_incremental += 1
+        return list(prefix_tokens) + suffix_tokens
 
     def detokenize(
         self, tokens: List[int], prev_tokens: Optional[List[int]] = None
@@ -65,6 +179,61 @@ class LlamaTokenizer(BaseLlamaTokenizer):
         return cls(llama_cpp.Llama(model_path=path, vocab_only=True))
 
 
+class LlamaStreamDetokenizer:
+    """Incremental detokenizer for streamed completions.
+
+    Every pushed token is detokenized against a short window of the tokens
+    before it, so the cost per token doesn't grow with the completion. The
+    bytes are accumulated in `text` with the end offset of every token in
+    `offsets`; the last `n_incomplete` bytes of `text` don't form a complete
+    UTF-8 character yet and should be held back from the client.
+
+    Args:
+        tokenizer: The tokenizer to detokenize with.
+        prev_tokens: The tokens preceding the first pushed token, e.g. the prompt.
+        n_prev: Number of previous tokens passed to the tokenizer as context.
+    """
+
+    def __init__(
+        self,
+        tokenizer: BaseLlamaTokenizer,
+        prev_tokens: Optional[List[int]] = None,
+        n_prev: int = 8,
+    ):
+        self._tokenizer = tokenizer
+        self._n_prev = n_prev
+        self._prev: List[int] = list(prev_tokens[-n_prev:]) if prev_tokens else []
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = bytearray()
+        self.offsets: List[int] = []
+        self.n_incomplete = 0
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def n_complete(self) -> int:
+        """Length of the prefix of `text` that is valid to emit."""
+        return len(self.text) - self.n_incomplete
+
+    def push(self, token: int) -> bytes:
+        """Detokenize the next token and return its bytes."""
+        piece = self._tokenizer.detokenize([token], prev_tokens=self._prev)
+        self._prev.append(token)
+        if len(self._prev) > self._n_prev:
+            del self._prev[0]
+        self.text += piece
+        self.offsets.append(len(self.text))
+        self._decoder.decode(piece)
+        self.n_incomplete = len(self._decoder.getstate()[0])
+        return piece
+
+    def token_bytes(self, i: int) -> bytes:
+        """Return the bytes of the `i`-th pushed token."""
+        start = self.offsets[i - 1] if i > 0 else 0
+        return bytes(self.text[start : self.offsets[i]])
+
+
 class LlamaHFTokenizer(BaseLlamaTokenizer):
     def __init__(self, hf_tokenizer: Any):
         self.hf_tokenizer = hf_tokenizer
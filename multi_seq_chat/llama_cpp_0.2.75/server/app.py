@@ -3,7 +3,6 @@ from __future__ import annotations
 import os
 import json
 
-from threading import Lock
 from functools import partial
 from typing import Iterator, List, Optional, Union, Dict
 
@@ -15,6 +14,7 @@ from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
 from fastapi import Depends, FastAPI, APIRouter, Request, HTTPException, status, Body
 from fastapi.middleware import Middleware
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from fastapi.security import HTTPBearer
 from sse_starlette.sse import EventSourceResponse
 from starlette_context.plugins import RequestIdPlugin  # type: ignore
@@ -41,6 +41,13 @@ from llama_cpp.server.types import (
     DetokenizeInputResponse,
 )
 from llama_cpp.server.errors import RouteErrorHandler
+from llama_cpp.llama_metrics import LlamaMetricsWriter
+from llama_cpp.server.scheduler import (
+    PRIORITY_CLASSES,
+    QueueFullError,
+    QueueTimeoutError,
+    RequestScheduler,
+)
 
 
 router = APIRouter(route_class=RouteErrorHandler)
@@ -59,32 +66,107 @@ def get_server_settings():
 
 _llama_proxy: Optional[LlamaProxy] = None
 
-llama_outer_lock = Lock()
-llama_inner_lock = Lock()
-
 
-def set_llama_proxy(model_settings: List[ModelSettings]):
+def set_llama_proxy(
+    model_settings: List[ModelSettings], ram_budget: Optional[int] = None
+):
     global _llama_proxy
-    _llama_proxy = LlamaProxy(models=model_settings)
+    _llama_proxy = LlamaProxy(models=model_settings, ram_budget=ram_budget)
+
+
+def get_model_pool():
+    # Unlike get_llama_proxy, doesn't wait for the models
+    yield _llama_proxy
+
+
+_request_scheduler: Optional[RequestScheduler] = None
+
+
+def set_request_scheduler(server_settings: ServerSettings):
+    global _request_scheduler
+    _request_scheduler = RequestScheduler(
+        max_queue_size=server_settings.max_queue_size,
+        max_queue_per_key=server_settings.max_queue_per_key,
+        queue_timeout=server_settings.queue_timeout,
+    )
+
+
+def get_request_scheduler():
+    yield _request_scheduler
+
 
+def _request_key(request: Request) -> str:
+    # Requests are queued fairly per API key, or per client without one
+    authorization = request.headers.get("authorization")
+    if authorization is not None:
+        return authorization
+    return request.client.host if request.client is not None else ""
 
-def get_llama_proxy():
-    # NOTE: This double lock allows the currently streaming llama model to
-    # check if any other requests are pending in the same thread and cancel
-    # the stream if so.
-    llama_outer_lock.acquire()
-    release_outer_lock = True
+
+def _request_priority(request: Request) -> str:
+    priority = request.headers.get("x-request-priority")
+    if priority is not None:
+        if priority not in PRIORITY_CLASSES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"X-Request-Priority must be one of {', '.join(PRIORITY_CLASSES)}",
+            )
+        return priority
+    # Embedding many documents shouldn't hold up someone typing
+    if request.url.path == "/v1/embeddings":
+        return "batch"
+    return "interactive"
+
+
+def _request_timeout(request: Request) -> Optional[float]:
+    timeout = request.headers.get("x-request-timeout")
+    if timeout is None:
+        return None
     try:
-        llama_inner_lock.acquire()
-        try:
-            llama_outer_lock.release()
-            release_outer_lock = False
-            yield _llama_proxy
-        finally:
-            llama_inner_lock.release()
+        seconds = float(timeout)
+    except ValueError:
+        seconds = -1.0
+    if not seconds > 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="X-Request-Timeout must be a positive number of seconds",
+        )
+    queue_timeout = next(get_server_settings()).queue_timeout
+    return seconds if queue_timeout is None else min(seconds, queue_timeout)
+
+
+def get_llama_proxy(request: Request):
+    # NOTE: Requests wait for the model in the scheduler's queue. The ticket
+    # is kept on the request so a streaming response can check whether other
+    # requests are waiting and cancel the stream if so.
+    assert _request_scheduler is not None
+    try:
+        ticket = _request_scheduler.acquire(
+            _request_key(request),
+            _request_priority(request),
+            _request_timeout(request),
+        )
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=(
+                status.HTTP_429_TOO_MANY_REQUESTS
+                if e.per_key
+                else status.HTTP_503_SERVICE_UNAVAILABLE
+            ),
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except QueueTimeoutError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    request.state.scheduler_ticket = ticket
+    try:
+        yield _llama_proxy
     finally:
-        if release_outer_lock:
-            llama_outer_lock.release()
+        _request_scheduler.release(ticket)
 
 
 _ping_message_factory = None
@@ -127,6 +209,7 @@ def create_app(
     ), "server_settings and model_settings must be provided together"
 
     set_server_settings(server_settings)
+    set_request_scheduler(server_settings)
     middleware = [Middleware(RawContextMiddleware, plugins=(RequestIdPlugin(),))]
     app = FastAPI(
         middleware=middleware,
@@ -144,7 +227,9 @@ def create_app(
     app.include_router(router)
 
     assert model_settings is not None
-    set_llama_proxy(model_settings=model_settings)
+    set_llama_proxy(
+        model_settings=model_settings, ram_budget=server_settings.models_ram_budget
+    )
 
     if server_settings.disable_ping_events:
         set_ping_message_factory(lambda: bytes())
@@ -163,9 +248,10 @@ async def get_event_publisher(
                 await inner_send_chan.send(dict(data=json.dumps(chunk)))
                 if await request.is_disconnected():
                     raise anyio.get_cancelled_exc_class()()
-                if (
-                    next(get_server_settings()).interrupt_requests
-                    and llama_outer_lock.locked()
+                if next(
+                    get_server_settings()
+                ).interrupt_requests and _request_scheduler.has_waiting(
+                    request.state.scheduler_ticket.priority
                 ):
                     await inner_send_chan.send(dict(data="[DONE]"))
                     raise anyio.get_cancelled_exc_class()()
@@ -260,9 +346,9 @@ async def create_completion(
     body: CreateCompletionRequest,
     llama_proxy: LlamaProxy = Depends(get_llama_proxy),
 ) -> llama_cpp.Completion:
-    if isinstance(body.prompt, list):
-        assert len(body.prompt) <= 1
-        body.prompt = body.prompt[0] if len(body.prompt) > 0 else ""
+    # Several prompts are decoded together, their choices indexed in order
+    if isinstance(body.prompt, list) and len(body.prompt) == 0:
+        body.prompt = ""
 
     llama = llama_proxy(
         body.model
@@ -271,8 +357,6 @@ async def create_completion(
     )
 
     exclude = {
-        "n",
-        "best_of",
         "logit_bias_type",
         "user",
         "min_tokens",
@@ -544,7 +628,13 @@ async def tokenize(
     body: TokenizeInputRequest,
     llama_proxy: LlamaProxy = Depends(get_llama_proxy),
 ) -> TokenizeInputResponse:
-    tokens = llama_proxy(body.model).tokenize(body.input.encode("utf-8"), special=True)
+    llama = llama_proxy(body.model)
+    if isinstance(body.input, list):
+        tokens = llama.tokenize_batch(
+            [text.encode("utf-8") for text in body.input], special=True
+        )
+    else:
+        tokens = llama.tokenize(body.input.encode("utf-8"), special=True)
 
     return TokenizeInputResponse(tokens=tokens)
 
@@ -559,9 +649,56 @@ async def count_query_tokens(
     body: TokenizeInputRequest,
     llama_proxy: LlamaProxy = Depends(get_llama_proxy),
 ) -> TokenizeInputCountResponse:
-    tokens = llama_proxy(body.model).tokenize(body.input.encode("utf-8"), special=True)
+    inputs = body.input if isinstance(body.input, list) else [body.input]
+    tokens = llama_proxy(body.model).tokenize_batch(
+        [text.encode("utf-8") for text in inputs], special=True
+    )
+
+    return TokenizeInputCountResponse(count=sum(len(t) for t in tokens))
+
+
+@router.get(
+    "/extras/queue",
+    summary="Request Queue",
+    dependencies=[Depends(authenticate)],
+    tags=[extras_tag],
+)
+async def get_queue(
+    request_scheduler: RequestScheduler = Depends(get_request_scheduler),
+) -> Dict[str, object]:
+    return request_scheduler.stats()
 
-    return TokenizeInputCountResponse(count=len(tokens))
+
+@router.get(
+    "/extras/models",
+    summary="Loaded Models",
+    dependencies=[Depends(authenticate)],
+    tags=[extras_tag],
+)
+async def get_loaded_models(
+    model_pool: LlamaProxy = Depends(get_model_pool),
+) -> Dict[str, object]:
+    return model_pool.stats()
+
+
+@router.get(
+    "/metrics",
+    summary="Metrics",
+    dependencies=[Depends(authenticate)],
+    response_class=PlainTextResponse,
+    tags=[extras_tag],
+)
+async def get_metrics(
+    model_pool: LlamaProxy = Depends(get_model_pool),
+    request_scheduler: RequestScheduler = Depends(get_request_scheduler),
+) -> PlainTextResponse:
+    # Prometheus text format, read without waiting for the models
+    writer = LlamaMetricsWriter()
+    request_scheduler.collect_metrics(writer)
+    model_pool.collect_metrics(writer)
+    return PlainTextResponse(
+        writer.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @router.post(
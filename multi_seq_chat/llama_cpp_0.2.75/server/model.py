@@ -1,18 +1,60 @@
 from __future__ import annotations
 
+import os
+import sys
 import json
+import time
+import threading
 
-from typing import Dict, Optional, Union, List
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Optional, Union, List
+from typing_extensions import Literal, TypedDict
 
 import llama_cpp
 import llama_cpp.llama_speculative as llama_speculative
 import llama_cpp.llama_tokenizer as llama_tokenizer
 
+from llama_cpp._internals import _LlamaModel
+
+from llama_cpp.llama_metrics import LlamaMetricsWriter
+
 from llama_cpp.server.settings import ModelSettings
 
 
+class ModelEvent(TypedDict):
+    """A model was loaded into or evicted from the pool."""
+
+    event: Literal["load", "evict"]
+    model: str
+    size: int
+    seconds: float
+    time: float
+
+
 class LlamaProxy:
-    def __init__(self, models: List[ModelSettings]) -> None:
+    """Serves the configured models, keeping as many of them loaded as fit
+    in `ram_budget`.
+
+    Models are loaded on first use and the least recently used ones are
+    evicted when a new one doesn't fit. The size of a model is its weights
+    plus its context state, estimated from the model file and the context
+    settings until it's loaded. Models with `preload` set are loaded in a
+    background thread at startup, as long as they fit without evicting
+    anything.
+
+    Args:
+        models: The model settings, the first is the default model.
+        ram_budget: Bytes the loaded models may take together, None to keep
+            only one model loaded.
+        on_event: Called with every `ModelEvent`.
+    """
+
+    def __init__(
+        self,
+        models: List[ModelSettings],
+        ram_budget: Optional[int] = None,
+        on_event: Optional[Callable[[ModelEvent], None]] = None,
+    ) -> None:
         assert len(models) > 0, "No models provided!"
 
         self._model_settings_dict: dict[str, ModelSettings] = {}
@@ -21,17 +63,36 @@ class LlamaProxy:
                 model.model_alias = model.model
             self._model_settings_dict[model.model_alias] = model
 
-        self._current_model: Optional[llama_cpp.Llama] = None
-        self._current_model_alias: Optional[str] = None
+        self.ram_budget = ram_budget
+        self.on_event = on_event
+
+        self._lock = threading.Lock()
+        # alias -> model, from least to most recently used
+        self._models: OrderedDict[str, llama_cpp.Llama] = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        # alias -> set once the model being loaded is in the pool (or failed)
+        self._loading: Dict[str, threading.Event] = {}
+
+        self.events: Deque[ModelEvent] = deque(maxlen=64)
+        self.n_loads = 0
+        self.n_evictions = 0
+        self.load_time_sum = 0.0
 
         self._default_model_settings: ModelSettings = models[0]
         self._default_model_alias: str = self._default_model_settings.model_alias  # type: ignore
 
         # Load default model
-        self._current_model = self.load_llama_from_model_settings(
-            self._default_model_settings
-        )
-        self._current_model_alias = self._default_model_alias
+        self._get(self._default_model_alias)
+
+        preload = [
+            alias
+            for alias, settings in self._model_settings_dict.items()
+            if settings.preload and alias != self._default_model_alias
+        ]
+        if len(preload) > 0:
+            threading.Thread(
+                target=self._preload, args=(preload,), daemon=True
+            ).start()
 
     def __call__(self, model: Optional[str] = None) -> llama_cpp.Llama:
         if model is None:
@@ -40,16 +101,9 @@ class LlamaProxy:
         if model not in self._model_settings_dict:
             model = self._default_model_alias
 
-        if model == self._current_model_alias:
-            if self._current_model is not None:
-                return self._current_model
-
-        self._current_model = None
-
-        settings = self._model_settings_dict[model]
-        self._current_model = self.load_llama_from_model_settings(settings)
-        self._current_model_alias = model
-        return self._current_model
+        llama = self._get(model)
+        assert llama is not None
+        return llama
 
     def __getitem__(self, model: str):
         return self._model_settings_dict[model].model_dump()
@@ -64,8 +118,222 @@ class LlamaProxy:
             yield model
 
     def free(self):
-        if self._current_model:
-            del self._current_model
+        with self._lock:
+            for alias in list(self._models):
+                self._evict(alias)
+
+    @property
+    def loaded(self) -> List[str]:
+        """Aliases of the loaded models, from least to most recently used."""
+        return list(self._models)
+
+    @property
+    def n_bytes(self) -> int:
+        """Bytes taken by the loaded models."""
+        return sum(self._sizes.values())
+
+    def stats(self) -> Dict[str, object]:
+        """The loaded models and the recent load and evict events."""
+        with self._lock:
+            return {
+                "ram_budget": self.ram_budget,
+                "n_bytes": self.n_bytes,
+                "loaded": [
+                    {"model": alias, "size": self._sizes[alias]}
+                    for alias in self._models
+                ],
+                "loads": self.n_loads,
+                "evictions": self.n_evictions,
+                "load_time_sum": self.load_time_sum,
+                "events": list(self.events),
+            }
+
+    def collect_metrics(self, writer: LlamaMetricsWriter):
+        """Add the pool counters and the metrics of every loaded model to `writer`."""
+        with self._lock:
+            models = list(self._models.items())
+            writer.add(
+                "llama_models_loaded",
+                "gauge",
+                "Models loaded.",
+                len(models),
+            )
+            writer.add(
+                "llama_models_bytes",
+                "gauge",
+                "Memory taken by the loaded models.",
+                self.n_bytes,
+            )
+            writer.add(
+                "llama_model_loads_total",
+                "counter",
+                "Models loaded since startup.",
+                self.n_loads,
+            )
+            writer.add(
+                "llama_model_evictions_total",
+                "counter",
+                "Models evicted since startup.",
+                self.n_evictions,
+            )
+            writer.add(
+                "llama_model_load_seconds_total",
+                "counter",
+                "Time spent loading models.",
+                self.load_time_sum,
+            )
+        for alias, llama in models:
+            llama.collect_metrics(writer, model=alias)
+
+    def _get(self, alias: str, preload: bool = False) -> Optional[llama_cpp.Llama]:
+        while True:
+            with self._lock:
+                llama = self._models.get(alias)
+                if llama is not None:
+                    if not preload:
+                        self._models.move_to_end(alias)
+                    return llama
+                loading = self._loading.get(alias)
+                if loading is None:
+                    loading = self._loading[alias] = threading.Event()
+                    break
+            # Loaded by another thread, check again once it's done
+            loading.wait()
+
+        try:
+            settings = self._model_settings_dict[alias]
+            estimate = self._estimate_size(settings)
+            with self._lock:
+                # Free memory before loading rather than after
+                fits = self._make_room(estimate, evict=not preload)
+            if preload and not fits:
+                if settings.verbose:
+                    print(
+                        f"Not preloading {alias}, it doesn't fit in the model RAM budget",
+                        file=sys.stderr,
+                    )
+                return None
+            t0 = time.perf_counter()
+            llama = self.load_llama_from_model_settings(settings)
+            seconds = time.perf_counter() - t0
+            size = self._memory_size(llama)
+            with self._lock:
+                if preload and not self._make_room(size, evict=False):
+                    # Took more than estimated, drop it rather than evict a
+                    # model in use
+                    if settings.verbose:
+                        print(
+                            f"Not preloading {alias}, it took {size / 2**20:.0f} MiB and doesn't fit in the model RAM budget",
+                            file=sys.stderr,
+                        )
+                    return None
+                self._models[alias] = llama
+                self._sizes[alias] = size
+                if preload:
+                    # Preloaded models haven't been used yet
+                    self._models.move_to_end(alias, last=False)
+                self.n_loads += 1
+                self.load_time_sum += seconds
+                self._report(ModelEvent(
+                    event="load", model=alias, size=size, seconds=seconds, time=time.time()
+                ))
+                # The context may take more than estimated
+                self._make_room(0, keep=alias)
+            return llama
+        finally:
+            with self._lock:
+                self._loading.pop(alias).set()
+
+    def _preload(self, aliases: List[str]):
+        for alias in aliases:
+            try:
+                self._get(alias, preload=True)
+            except Exception as e:
+                print(f"Failed to preload {alias}: {e}", file=sys.stderr)
+
+    def _make_room(
+        self, n_bytes: int, keep: Optional[str] = None, evict: bool = True
+    ) -> bool:
+        # Evict the least recently used models until `n_bytes` more fit
+        while True:
+            others = [alias for alias in self._models if alias != keep]
+            if self.ram_budget is None:
+                fits = len(others) == 0
+            else:
+                fits = self.n_bytes + n_bytes <= self.ram_budget
+            if fits:
+                return True
+            if len(others) == 0 or not evict:
+                return False
+            self._evict(others[0])
+
+    def _evict(self, alias: str):
+        # The model is freed once the requests using it are done
+        del self._models[alias]
+        size = self._sizes.pop(alias)
+        self.n_evictions += 1
+        self._report(ModelEvent(
+            event="evict", model=alias, size=size, seconds=0.0, time=time.time()
+        ))
+
+    def _report(self, event: ModelEvent):
+        self.events.append(event)
+        if self._model_settings_dict[event["model"]].verbose:
+            if event["event"] == "load":
+                print(
+                    f"Loaded model {event['model']} ({event['size'] / 2**20:.0f} MiB) in {event['seconds']:.2f}s",
+                    file=sys.stderr,
+                )
+            else:
+                print(
+                    f"Evicted model {event['model']} ({event['size'] / 2**20:.0f} MiB)",
+                    file=sys.stderr,
+                )
+        if self.on_event is not None:
+            self.on_event(event)
+
+    # Bytes per element of the kv cache types
+    _kv_type_sizes: Dict[int, float] = {
+        llama_cpp.GGML_TYPE_F32: 4,
+        llama_cpp.GGML_TYPE_F16: 2,
+        llama_cpp.GGML_TYPE_Q4_0: 18 / 32,
+        llama_cpp.GGML_TYPE_Q4_1: 20 / 32,
+        llama_cpp.GGML_TYPE_Q5_0: 22 / 32,
+        llama_cpp.GGML_TYPE_Q5_1: 24 / 32,
+        llama_cpp.GGML_TYPE_Q8_0: 34 / 32,
+    }
+
+    @classmethod
+    def _estimate_size(cls, settings: ModelSettings) -> int:
+        if settings.hf_model_repo_id is not None or not os.path.exists(settings.model):
+            return 0
+        size = os.path.getsize(settings.model)
+        # The context is sized from the hyperparameters, which are read
+        # without the weights
+        params = _LlamaModel.default_params()
+        params.vocab_only = True
+        try:
+            model = _LlamaModel(path_model=settings.model, params=params, verbose=False)
+        except ValueError:
+            return size
+        metadata = model.metadata()
+        arch = metadata.get("general.architecture", "")
+        n_layer = int(metadata.get(f"{arch}.block_count", 0))
+        n_head = int(metadata.get(f"{arch}.attention.head_count", 1)) or 1
+        n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+        n_embd_kv = model.n_embd() * n_head_kv // n_head
+        n_ctx = settings.n_ctx or model.n_ctx_train()
+        type_k = cls._kv_type_sizes.get(settings.type_k, 2)  # type: ignore
+        type_v = cls._kv_type_sizes.get(settings.type_v, 2)  # type: ignore
+        size += int(n_layer * n_ctx * n_embd_kv * (type_k + type_v))
+        # The logits of a batch, or of its last token
+        n_outputs = min(settings.n_batch, n_ctx) if settings.logits_all else 1
+        size += 4 * model.n_vocab() * n_outputs
+        return size
+
+    @staticmethod
+    def _memory_size(llama: llama_cpp.Llama) -> int:
+        return llama._model.size() + llama._ctx.get_state_size()
 
     @staticmethod
     def load_llama_from_model_settings(settings: ModelSettings) -> llama_cpp.Llama:
@@ -240,11 +508,15 @@ class LlamaProxy:
             yarn_orig_ctx=settings.yarn_orig_ctx,
             mul_mat_q=settings.mul_mat_q,
             logits_all=settings.logits_all,
+            logits_store=settings.logits_store,
             embedding=settings.embedding,
             offload_kqv=settings.offload_kqv,
             flash_attn=settings.flash_attn,
             # Sampling Params
             last_n_tokens_size=settings.last_n_tokens_size,
+            # Prefix Cache Params
+            prefix_cache_slots=settings.prefix_cache_slots,
+            prefix_cache_block_size=settings.prefix_cache_block_size,
             # LoRA Params
             lora_base=settings.lora_base,
             lora_path=settings.lora_path,
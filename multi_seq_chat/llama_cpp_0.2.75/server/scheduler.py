@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import math
+import time
+import threading
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Optional
+
+from llama_cpp.llama_metrics import LlamaHistogram, LlamaMetricsWriter
+
+# Priority classes, served strictly in this order
+PRIORITY_CLASSES = ("interactive", "batch")
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a request is not admitted to the queue.
+
+    Args:
+        message: What was full.
+        retry_after: Seconds after which a retry is likely to be admitted.
+        per_key: Whether the limit of the caller's key was hit, rather than
+            the limit of the whole queue.
+    """
+
+    def __init__(self, message: str, retry_after: int, per_key: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.per_key = per_key
+
+
+class QueueTimeoutError(RuntimeError):
+    """Raised when a request waited in the queue past its deadline."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SchedulerTicket:
+    """A request waiting for, or holding, a slot of the scheduler."""
+
+    def __init__(self, key: str, priority: str, deadline: Optional[float]):
+        self.key = key
+        self.priority = priority
+        self.deadline = deadline
+        self.t_enqueued = time.monotonic()
+        self.t_started: Optional[float] = None
+        self._granted = threading.Event()
+
+    @property
+    def wait_time(self) -> float:
+        """Seconds spent in the queue, so far if still waiting."""
+        end = self.t_started if self.t_started is not None else time.monotonic()
+        return end - self.t_enqueued
+
+
+class RequestScheduler:
+    """Admits requests to the models `max_concurrency` at a time.
+
+    Waiting requests are kept in a bounded queue. Higher priority classes are
+    always served first; within a class the keys (API keys or clients) take
+    turns, so one busy client can't starve the others, and the requests of a
+    key are served in order. A request that can't be queued raises
+    `QueueFullError`, one that waits past its deadline `QueueTimeoutError`.
+
+    Args:
+        max_queue_size: Maximum number of waiting requests.
+        max_queue_per_key: Maximum number of waiting requests of one key,
+            None for no limit besides `max_queue_size`.
+        queue_timeout: Default number of seconds a request may wait, None to
+            wait forever.
+        max_concurrency: Number of requests served at the same time.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 32,
+        max_queue_per_key: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+        max_concurrency: int = 1,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.max_queue_size = max_queue_size
+        self.max_queue_per_key = max_queue_per_key
+        self.queue_timeout = queue_timeout
+        self.max_concurrency = max_concurrency
+
+        self._lock = threading.Lock()
+        # priority class -> key -> waiting tickets, keys in serving order
+        self._queues: Dict[str, OrderedDict[str, Deque[SchedulerTicket]]] = {
+            priority: OrderedDict() for priority in PRIORITY_CLASSES
+        }
+        self._n_waiting = 0
+        self._n_active = 0
+
+        self.n_admitted = 0
+        self.n_rejected = 0
+        self.n_expired = 0
+        self.wait_time_sum = 0.0
+        self.wait_time_max = 0.0
+        self.service_time_sum = 0.0
+        self.n_served = 0
+        self.wait_time = LlamaHistogram()
+
+    def __len__(self) -> int:
+        """Number of waiting requests."""
+        return self._n_waiting
+
+    @property
+    def n_active(self) -> int:
+        """Number of requests being served."""
+        return self._n_active
+
+    def acquire(
+        self,
+        key: str,
+        priority: str = "interactive",
+        timeout: Optional[float] = None,
+    ) -> SchedulerTicket:
+        """Wait for a slot.
+
+        Args:
+            key: Who the request is from, for fairness.
+            priority: One of `PRIORITY_CLASSES`.
+            timeout: Seconds to wait at most, defaults to `queue_timeout`.
+
+        Raises:
+            QueueFullError: If the queue, or the share of the key, is full.
+            QueueTimeoutError: If no slot was free before the deadline.
+
+        Returns:
+            The ticket to release when done.
+        """
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class {priority!r}")
+        if timeout is None:
+            timeout = self.queue_timeout
+        ticket = SchedulerTicket(
+            key, priority, None if timeout is None else time.monotonic() + timeout
+        )
+
+        with self._lock:
+            if self._n_active < self.max_concurrency and self._n_waiting == 0:
+                self._start(ticket)
+                return ticket
+            if self._n_waiting >= self.max_queue_size:
+                self.n_rejected += 1
+                raise QueueFullError(
+                    f"Request queue is full ({self._n_waiting} waiting)",
+                    self._retry_after(),
+                )
+            waiting = self._queues[priority].get(key)
+            n_key = sum(len(q.get(key, ())) for q in self._queues.values())
+            if self.max_queue_per_key is not None and n_key >= self.max_queue_per_key:
+                self.n_rejected += 1
+                raise QueueFullError(
+                    f"Too many queued requests for this key ({n_key} waiting)",
+                    self._retry_after(),
+                    per_key=True,
+                )
+            if waiting is None:
+                waiting = self._queues[priority][key] = deque()
+            waiting.append(ticket)
+            self._n_waiting += 1
+
+        granted = ticket._granted.wait(timeout)
+        if not granted:
+            with self._lock:
+                # The slot may have been handed over while timing out
+                if not ticket._granted.is_set():
+                    self._remove(ticket)
+                    self.n_expired += 1
+                    raise QueueTimeoutError(
+                        f"Request waited {ticket.wait_time:.1f}s in the queue",
+                        self._retry_after(),
+                    )
+        return ticket
+
+    def release(self, ticket: SchedulerTicket):
+        """Free the slot of a ticket and hand it to the next waiting request."""
+        with self._lock:
+            assert ticket.t_started is not None
+            self._n_active -= 1
+            self.service_time_sum += time.monotonic() - ticket.t_started
+            self.n_served += 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(
+        self,
+        key: str,
+        priority: str = "interactive",
+        timeout: Optional[float] = None,
+    ) -> Iterator[SchedulerTicket]:
+        """Hold a slot for the duration of the block, see `acquire`."""
+        ticket = self.acquire(key, priority, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def has_waiting(self, priority: str = "batch") -> bool:
+        """Whether a request of `priority` or a higher class is waiting."""
+        for p in PRIORITY_CLASSES:
+            if len(self._queues[p]) > 0:
+                return True
+            if p == priority:
+                break
+        return False
+
+    def stats(self) -> Dict[str, object]:
+        """Queue depth and wait times."""
+        with self._lock:
+            now = time.monotonic()
+            oldest = min(
+                (
+                    waiting[0].t_enqueued
+                    for queue in self._queues.values()
+                    for waiting in queue.values()
+                ),
+                default=now,
+            )
+            return {
+                "depth": self._n_waiting,
+                "depth_by_priority": {
+                    p: sum(len(w) for w in q.values()) for p, q in self._queues.items()
+                },
+                "active": self._n_active,
+                "max_queue_size": self.max_queue_size,
+                "admitted": self.n_admitted,
+                "rejected": self.n_rejected,
+                "expired": self.n_expired,
+                "wait_time_avg": (
+                    self.wait_time_sum / self.n_admitted if self.n_admitted else 0.0
+                ),
+                "wait_time_max": self.wait_time_max,
+                "wait_time_oldest": now - oldest,
+                "service_time_avg": (
+                    self.service_time_sum / self.n_served if self.n_served else 0.0
+                ),
+            }
+
+    def collect_metrics(self, writer: LlamaMetricsWriter):
+        """Add the queue depth, counts and wait times to `writer`."""
+        with self._lock:
+            for priority, queue in self._queues.items():
+                writer.add(
+                    "llama_queue_depth",
+                    "gauge",
+                    "Requests waiting for a model.",
+                    sum(len(w) for w in queue.values()),
+                    priority=priority,
+                )
+            writer.add(
+                "llama_queue_active_requests",
+                "gauge",
+                "Requests being served.",
+                self._n_active,
+            )
+            writer.add(
+                "llama_queue_max_size",
+                "gauge",
+                "Maximum number of waiting requests.",
+                self.max_queue_size,
+            )
+            for outcome, n in (
+                ("admitted", self.n_admitted),
+                ("rejected", self.n_rejected),
+                ("expired", self.n_expired),
+            ):
+                writer.add(
+                    "llama_queue_requests_total",
+                    "counter",
+                    "Requests by queue outcome.",
+                    n,
+                    outcome=outcome,
+                )
+            writer.add(
+                "llama_queue_wait_seconds",
+                "histogram",
+                "Time requests waited in the queue.",
+                self.wait_time,
+            )
+
+    def _start(self, ticket: SchedulerTicket):
+        ticket.t_started = time.monotonic()
+        wait_time = ticket.t_started - ticket.t_enqueued
+        self._n_active += 1
+        self.n_admitted += 1
+        self.wait_time_sum += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+        self.wait_time.observe(wait_time)
+        ticket._granted.set()
+
+    def _dispatch(self):
+        while self._n_active < self.max_concurrency and self._n_waiting > 0:
+            for queue in self._queues.values():
+                if len(queue) == 0:
+                    continue
+                # The key in front gets a turn and goes to the back of the line
+                key, waiting = next(iter(queue.items()))
+                ticket = waiting.popleft()
+                if len(waiting) == 0:
+                    del queue[key]
+                else:
+                    queue.move_to_end(key)
+                self._n_waiting -= 1
+                self._start(ticket)
+                break
+
+    def _remove(self, ticket: SchedulerTicket):
+        queue = self._queues[ticket.priority]
+        waiting = queue[ticket.key]
+        waiting.remove(ticket)
+        if len(waiting) == 0:
+            del queue[ticket.key]
+        self._n_waiting -= 1
+
+    def _retry_after(self) -> int:
+        service_time = self.service_time_sum / self.n_served if self.n_served else 1.0
+        return max(
+            1,
+            math.ceil(service_time * (self._n_waiting + 1) / self.max_concurrency),
+        )
@@ -24,6 +24,10 @@ class ModelSettings(BaseSettings):
         default=None,
         description="The alias of the model to use for generating completions.",
     )
+    preload: bool = Field(
+        default=False,
+        description="Whether to load the model in the background at startup, if it fits in models_ram_budget.",
+    )
     # Model Params
     n_gpu_layers: int = Field(
         default=0,
@@ -92,6 +96,10 @@ class ModelSettings(BaseSettings):
         default=True, description="if true, use experimental mul_mat_q kernels"
     )
     logits_all: bool = Field(default=True, description="Whether to return logits.")
+    logits_store: Literal["memory", "mmap"] = Field(
+        default="memory",
+        description="Where the logits of every token are kept for requests with logprobs or echo, in memory or in a memory-mapped temporary file.",
+    )
     embedding: bool = Field(default=True, description="Whether to use embeddings.")
     offload_kqv: bool = Field(
         default=True, description="Whether to offload kqv to the GPU."
@@ -105,6 +113,17 @@ class ModelSettings(BaseSettings):
         ge=0,
         description="Last n tokens to keep for repeat penalty calculation.",
     )
+    # Prefix Cache Params
+    prefix_cache_slots: int = Field(
+        default=0,
+        ge=0,
+        description="Number of kv cache sequences reserved for parked prompt prefixes, 0 disables the paged prefix cache.",
+    )
+    prefix_cache_block_size: int = Field(
+        default=64,
+        ge=1,
+        description="Number of tokens per prefix cache block.",
+    )
     # LoRA Params
     lora_base: Optional[str] = Field(
         default=None,
@@ -211,6 +230,28 @@ class ServerSettings(BaseSettings):
         default=True,
         description="Whether to interrupt requests when a new request is received.",
     )
+    # Model Pool
+    models_ram_budget: Optional[int] = Field(
+        default=None,
+        ge=0,
+        description="Memory in bytes the loaded models may take together (weights and context state); least recently used models are unloaded to stay within it. None keeps only one model loaded.",
+    )
+    # Request Queue
+    max_queue_size: int = Field(
+        default=32,
+        ge=0,
+        description="Maximum number of requests waiting for the model, further requests get a 503. Every waiting request holds a worker thread.",
+    )
+    max_queue_per_key: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Maximum number of waiting requests per API key (or client address), further requests get a 429.",
+    )
+    queue_timeout: Optional[float] = Field(
+        default=None,
+        gt=0,
+        description="Default number of seconds a request may wait in the queue before it gets a 503, None to wait forever. Clients can set a shorter deadline with the X-Request-Timeout header.",
+    )
     disable_ping_events: bool = Field(
         default=False,
         description="Disable EventSource pings (may be needed for some clients).",
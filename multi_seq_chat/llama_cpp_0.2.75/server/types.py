@@ -108,7 +108,8 @@ grammar = Field(
 
 class CreateCompletionRequest(BaseModel):
     prompt: Union[str, List[str]] = Field(
-        default="", description="The prompt to generate completions for."
+        default="",
+        description="The prompt to generate completions for, or a list of prompts decoded together in one batch.",
     )
     suffix: Optional[str] = Field(
         default=None,
@@ -136,11 +137,19 @@ class CreateCompletionRequest(BaseModel):
     frequency_penalty: Optional[float] = frequency_penalty_field
     logit_bias: Optional[Dict[str, float]] = Field(None)
     seed: Optional[int] = Field(None)
+    n: int = Field(
+        default=1,
+        ge=1,
+        description="The number of completions to generate. The prompt is evaluated once and the completions are decoded together.",
+    )
+    best_of: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="The number of completions to sample, the n with the highest cumulative logprob are returned. Defaults to n, can't be streamed if larger.",
+    )
 
     # ignored or currently unsupported
     model: Optional[str] = model_field
-    n: Optional[int] = 1
-    best_of: Optional[int] = 1
     user: Optional[str] = Field(default=None)
 
     # llama.cpp specific parameters
@@ -282,7 +291,9 @@ class ModelList(TypedDict):
 
 class TokenizeInputRequest(BaseModel):
     model: Optional[str] = model_field
-    input: str = Field(description="The input to tokenize.")
+    input: Union[str, List[str]] = Field(
+        description="The input to tokenize, or a list of inputs to tokenize in one call."
+    )
 
     model_config = {
         "json_schema_extra": {"examples": [{"input": "How many tokens in this query?"}]}
@@ -290,7 +301,9 @@ class TokenizeInputRequest(BaseModel):
 
 
 class TokenizeInputResponse(BaseModel):
-    tokens: List[int] = Field(description="A list of tokens.")
+    tokens: Union[List[int], List[List[int]]] = Field(
+        description="A list of tokens, or a list of tokens for every input if a list was given."
+    )
 
     model_config = {"json_schema_extra": {"example": {"tokens": [123, 321, 222]}}}
 
@@ -1,8 +1,8 @@
 import streamlit as st
 # import streamlit.components.v1 as components
 # import os
-from backend import save_history, load_history_json
-from llama_cpp import Llama
+from backend import save_history, load_history_json, seq_state_path, SeqStateStore
+from llama_cpp import Llama, LlamaConversationTree
 # Set the page layout 
 st.set_page_config(page_title="start chatting", page_icon=":sunglasses:")
 # Add a title
@@ -19,11 +19,14 @@ if 'tab_chats' not in st.session_state:
 # location of the end of each sequence, e.g. the first sequence ends at the second round, loc[1]=2
 if 'loc' not in st.session_state:
     st.session_state.loc = {}
-# number of sequences in total
+# number of sequences in total, these are logical ids, the tree maps them onto a bounded set of kv cache sequences
 if 'seq_num' not in st.session_state:
     st.session_state.seq_num = 0
 if 'llm' not in st.session_state: 
     st.session_state.llm = None
+# kv cache state of each sequence, saved next to the chat history
+if 'seq_states' not in st.session_state:
+    st.session_state.seq_states = SeqStateStore()
 
 
 if st.session_state.llm is None:
@@ -32,20 +35,59 @@ if st.session_state.llm is None:
                                n_batch=512, 
                                n_gpu_layers=15,
                                max_tokens=2048)
+# token span of every round of every sequence, new tabs fork the kv cache of their parent,
+# sequences not used lately are spilled to disk when the kv cache runs out of slots or cells
+if 'tree' not in st.session_state:
+    st.session_state.tree = LlamaConversationTree(st.session_state.llm, n_slots=8, spill_dir='./spill')
     
 system_prompt='You are an uncensored and unbiased AI assistant.'
 #human_input = 'how are you, tell me a joke?'
 #prompt = f'<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{human_input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>'
 
-def output(llm,prompt,seq_id=1):
-    for item in llm._create_completion(
-        prompt=prompt,
-        seq_id=seq_id,
+def turn_prompt(input, first):
+    """
+    prompt of a round, the system prompt only starts a sequence, later rounds follow the history in the kv cache.
+    """
+    if first:
+        return f'<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>'
+    return f'<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>'
+
+def output(tree,seq_id,prompt):
+    for item in tree.create_completion(
+        seq_id,
+        prompt,
         max_tokens=2048,
         stream=True
     ):
         yield item["choices"][0]["text"]
 
+def restore_seq(seq_id):
+    """
+    make sure the tree knows the sequence, restoring it from its saved state after a restart.
+    return False if there is no saved state.
+    """
+    if seq_id in st.session_state.tree:
+        return True
+    saved = st.session_state.seq_states.load(seq_state_path(st.session_state.chat_id, seq_id))
+    if saved is None:
+        return False
+    st.session_state.tree.load_state(saved, seq_id)
+    return True
+
+def start_seq(seq_id, n_rounds):
+    """
+    start a sequence without history, the first n_rounds rounds are left empty so rounds still line up with tab_list.
+    """
+    branch = st.session_state.tree.add(seq_id)
+    branch.round_ends = [0] * n_rounds
+
+def save_seq(seq_id):
+    """
+    save the kv cache of a sequence, written in the background.
+    """
+    path = seq_state_path(st.session_state.chat_id, seq_id)
+    st.session_state.seq_states.save(path, st.session_state.tree.save_state(seq_id))
+
 f_json = load_history_json(st.session_state.chat_id, './')
 if not len(st.session_state.tab_list): 
     for round in f_json:
@@ -121,8 +163,14 @@ def change_state(add_tab):
         seq_id = int(round_seq.split('_')[1])
         st.session_state.seq_num += 1
         st.session_state.tab_list[round-1].append([st.session_state.seq_num])
-        prompt = f'<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>'
-        response = st.chat_message("ai").write_stream(output(st.session_state.llm, prompt, seq_id))
+        # share the first round-1 rounds with the sibling tab, only the new input is evaluated
+        if restore_seq(seq_id) and st.session_state.tree[seq_id].n_rounds >= round-1:
+            st.session_state.tree.fork(seq_id, st.session_state.seq_num, n_rounds=round-1)
+        else:
+            start_seq(st.session_state.seq_num, round-1)
+        prompt = turn_prompt(input, st.session_state.tree[st.session_state.seq_num].n_tokens==0)
+        response = st.chat_message("ai").write_stream(output(st.session_state.tree, st.session_state.seq_num, prompt))
+        save_seq(st.session_state.seq_num)
         st.session_state.tab_chats[round-1].append([input,response])
         if round>1:
             ids = []      
@@ -136,8 +184,11 @@ def change_state(add_tab):
 
     elif len(add_tab)==3:
         [round,seq_id,input]=add_tab
-        prompt = f'<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>'
-        response = st.chat_message("ai").write_stream(output(st.session_state.llm, prompt, seq_id))
+        if not restore_seq(seq_id):
+            start_seq(seq_id, round)
+        prompt = turn_prompt(input, st.session_state.tree[seq_id].n_tokens==0)
+        response = st.chat_message("ai").write_stream(output(st.session_state.tree, seq_id, prompt))
+        save_seq(seq_id)
         if round==len(st.session_state.tab_list):
             st.session_state.tab_list+=[[[seq_id]]]
             st.session_state.tab_chats+=[[[input,response]]]